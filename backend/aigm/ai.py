@@ -0,0 +1,219 @@
+"""
+OpenAI 调用的统一入口
+
+所有 chat.completions.create / images.generate 调用都经过这里，
+先向并发调度器 (governor) 申请名额，再使用共享连接池中的客户端发出请求。
+
+identity 为请求方标识（见 views.client_identity），用于按用户限流和公平排队；
+endpoint 为发起调用的接口名称，用于按接口统计提示词缓存命中情况。
+每次调用（包括被调度器拒绝和失败的调用）都会写入用量记录（见 metering）。
+"""
+import asyncio
+import os
+import time
+import weakref
+from contextlib import contextmanager
+
+from backend.metrics import observe_upstream
+from django.conf import settings
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from .governor import Governor, GovernorRejected
+from .metering import usage_ledger
+from .models import AIUsageRecord
+from .prompt_cache import PromptCacheStats, cached_tokens
+from .transport import get_async_http_client, get_http_client, pool_timeout
+
+# Load .env configuration
+load_dotenv()
+
+# Get API Key; requests go through the shared keep-alive connection pool
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=get_http_client("openai"),
+    timeout=pool_timeout("openai"),
+)
+
+# AsyncOpenAI 使用的连接池绑定在事件循环上，因此每个事件循环各自持有一个客户端
+_async_clients = weakref.WeakKeyDictionary()
+
+# 当前worker进程内所有上游AI调用共用的调度器
+governor = Governor(
+    max_concurrent=settings.AIGM_GOVERNOR_MAX_CONCURRENT,
+    max_queue=settings.AIGM_GOVERNOR_MAX_QUEUE,
+    max_wait=settings.AIGM_GOVERNOR_MAX_WAIT,
+    user_rate=settings.AIGM_GOVERNOR_USER_RATE,
+    user_burst=settings.AIGM_GOVERNOR_USER_BURST,
+)
+
+# 按接口统计的提示词缓存命中情况
+prompt_cache_stats = PromptCacheStats()
+
+
+def get_async_client():
+    """获取当前事件循环对应的AsyncOpenAI客户端"""
+    loop = asyncio.get_running_loop()
+    async_client = _async_clients.get(loop)
+    if async_client is None:
+        async_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_async_http_client("openai"),
+            timeout=pool_timeout("openai"),
+        )
+        _async_clients[loop] = async_client
+    return async_client
+
+
+class MeteredCall:
+    """一次上游调用的计量信息；finish() 只生效一次"""
+
+    def __init__(self, identity, endpoint, options, image=False):
+        self.identity = identity
+        self.endpoint = endpoint
+        self.options = options
+        self.image = image
+        self.response = None
+        self.started = time.monotonic()
+        self._finished = False
+
+    def start(self):
+        """获得并发名额、即将发出请求时调用，之后的时间计入上游耗时"""
+        self.started = time.monotonic()
+
+    def finish(self, outcome, usage=None):
+        if self._finished:
+            return
+        self._finished = True
+        latency = time.monotonic() - self.started
+        if outcome != AIUsageRecord.OUTCOME_REJECTED:
+            observe_upstream("openai", self.endpoint, latency, outcome)
+
+        if self.image:
+            usage_ledger.record(
+                self.identity, self.endpoint, self.options.get("model", ""),
+                image_size=self.options.get("size", ""),
+                image_quality=self.options.get("quality", "standard"),
+                image_count=self.options.get("n", 1) if outcome == AIUsageRecord.OUTCOME_OK else 0,
+                latency=latency, outcome=outcome)
+            return
+
+        if usage is None and self.response is not None:
+            usage = self.response.usage
+        if outcome == AIUsageRecord.OUTCOME_OK:
+            prompt_cache_stats.record(self.endpoint, usage, latency)
+        usage_ledger.record(
+            self.identity, self.endpoint, self.options.get("model", ""),
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            cached_tokens=cached_tokens(usage),
+            latency=latency, outcome=outcome)
+
+
+@contextmanager
+def metered_call(identity, endpoint, options, image=False):
+    """计量 with 块中的上游调用；块内抛出的异常按结果记录后继续抛出"""
+    call = MeteredCall(identity, endpoint, options, image)
+    try:
+        yield call
+    except GovernorRejected:
+        call.finish(AIUsageRecord.OUTCOME_REJECTED)
+        raise
+    except Exception:
+        call.finish(AIUsageRecord.OUTCOME_ERROR)
+        raise
+    call.finish(AIUsageRecord.OUTCOME_OK)
+
+
+class GovernedStream:
+    """
+    包装OpenAI异步流式响应：关闭时同时关闭上游连接并归还并发名额（可重复调用）
+
+    收到带 usage 的最后一个分片时完成计量（需要 stream_options={"include_usage": True}）；
+    在此之前关闭（例如客户端断开）记为 aborted。
+    """
+
+    def __init__(self, stream, started_at, call):
+        self._stream = stream
+        self._started_at = started_at
+        self._call = call
+        self._closed = False
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                if chunk.usage is not None:
+                    self._call.finish(AIUsageRecord.OUTCOME_OK, chunk.usage)
+                yield chunk
+        except Exception:
+            self._call.finish(AIUsageRecord.OUTCOME_ERROR)
+            raise
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._stream.close()
+        finally:
+            self._call.finish(AIUsageRecord.OUTCOME_ABORTED)
+            governor.release(self._started_at)
+
+
+def create_chat_completion(identity, endpoint="other", **kwargs):
+    """调用 chat.completions.create"""
+    with metered_call(identity, endpoint, kwargs) as call:
+        with governor.slot(identity):
+            call.start()
+            call.response = client.chat.completions.create(**kwargs)
+    return call.response
+
+
+def generate_image(identity, endpoint="other", **kwargs):
+    """调用 images.generate"""
+    with metered_call(identity, endpoint, kwargs, image=True) as call:
+        with governor.slot(identity):
+            call.start()
+            call.response = client.images.generate(**kwargs)
+    return call.response
+
+
+async def acreate_chat_completion(identity, endpoint="other", **kwargs):
+    """create_chat_completion 的异步版本"""
+    with metered_call(identity, endpoint, kwargs) as call:
+        async with governor.aslot(identity):
+            call.start()
+            call.response = await get_async_client().chat.completions.create(**kwargs)
+    return call.response
+
+
+async def aopen_chat_stream(identity, endpoint="other", **kwargs):
+    """
+    以流式模式调用 chat.completions.create；名额在返回的流关闭时归还
+
+    调用方必须在 try/finally 中 await stream.aclose()，例如在消费它的异步生成器内打开流。
+    """
+    call = MeteredCall(identity, endpoint, kwargs)
+    try:
+        started_at = await governor.aacquire(identity)
+    except GovernorRejected:
+        call.finish(AIUsageRecord.OUTCOME_REJECTED)
+        raise
+    call.start()
+    try:
+        stream = await get_async_client().chat.completions.create(stream=True, **kwargs)
+    except BaseException:
+        # 包括等待上游响应时客户端断开（CancelledError）
+        call.finish(AIUsageRecord.OUTCOME_ERROR)
+        governor.release(started_at)
+        raise
+    return GovernedStream(stream, started_at, call)
+
+
+async def agenerate_image(identity, endpoint="other", **kwargs):
+    """generate_image 的异步版本"""
+    with metered_call(identity, endpoint, kwargs, image=True) as call:
+        async with governor.aslot(identity):
+            call.start()
+            call.response = await get_async_client().images.generate(**kwargs)
+    return call.response
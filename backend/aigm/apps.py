@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class AigmConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "aigm"
+
+    def ready(self):
+        # Cloudinary 上传/删除（包括用户头像上传）统一使用共享的长连接池
+        from .transport import install_cloudinary_pool
+        install_cloudinary_pool()
+
+        # 设定资料在worker启动时加载，格式错误时尽早失败
+        from . import lore  # noqa: F401
@@ -0,0 +1,712 @@
+"""
+AIGM 接口的原生异步版本
+
+在ASGI服务器(uvicorn)下运行时，等待OpenAI、图片下载和Cloudinary调用期间不会占用工作线程，
+单个worker即可同时处理大量进行中的AI请求。提示词构建逻辑与同步视图共用。
+"""
+import asyncio
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework.authtoken.models import Token
+
+from .ai import acreate_chat_completion, agenerate_image, aopen_chat_stream, governor
+from .governor import GovernorRejected
+from .jobs import await_job, job_payload
+from .models import PortraitJob
+from .renderers import format_sse
+from .sessions import SessionNotFound
+from .transport import get_async_http_client
+from .utils import upload_dalle_image, delete_cloudinary_image
+from .views import (
+    BACKGROUND_COMPLETION_OPTIONS,
+    PORTRAIT_FOLDER,
+    PORTRAIT_IMAGE_OPTIONS,
+    PortraitGenerationError,
+    background_cache,
+    background_cache_key,
+    background_flight,
+    background_flight_key,
+    bulk_delete_images,
+    bulk_delete_result,
+    build_background_messages,
+    build_chat_messages,
+    build_portrait_prompt,
+    chat_completion_options,
+    client_identity,
+    foreign_public_ids,
+    load_chat_history,
+    parse_public_ids,
+    portrait_flight,
+    portrait_flight_key,
+    portrait_folder,
+    portrait_result,
+    save_variant_set,
+    save_chat_turn,
+)
+
+def governor_rejected_response(error):
+    """上游AI调用被并发调度器拒绝时返回 429 和 Retry-After"""
+    response = JsonResponse({
+        "error": "AI service is busy, please retry later",
+        "reason": error.reason,
+        "retry_after": error.retry_after
+    }, status=429)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+async def aget_request_user(request):
+    """
+    按 TokenAuthentication 的规则解析 Authorization: Token <key> 请求头
+
+    异步视图不经过DRF的认证流程，这里只做最基本的解析；无效或缺失时返回None。
+    """
+    auth = request.headers.get("Authorization", "").split()
+    if len(auth) != 2 or auth[0].lower() != "token":
+        return None
+    try:
+        token = await Token.objects.select_related("user").aget(key=auth[1])
+    except Token.DoesNotExist:
+        return None
+    return token.user if token.user.is_active else None
+
+
+def parse_json_body(request):
+    """解析请求体JSON，格式错误时返回None"""
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def ai_gm_chat(request):
+    """API endpoint for interacting with AI GM (async)"""
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+    user_input = data.get("message", "")
+
+    if not user_input:
+        return JsonResponse({"error": "Message cannot be empty"}, status=400)
+
+    try:
+        user = await aget_request_user(request)
+        session, history = await sync_to_async(load_chat_history)(data, user)
+    except SessionNotFound:
+        return JsonResponse({"error": "Session not found"}, status=404)
+    except (KeyError, TypeError):
+        # 客户端发送的 history 缺少 role / text 字段或不是列表
+        return JsonResponse({"error": "Invalid history format"}, status=400)
+    identity = client_identity(request, user)
+
+    try:
+        # 超出预算时需要同步调用模型生成摘要，因此放到线程中执行
+        messages, context_info = await sync_to_async(build_chat_messages)(
+            user_input, history, session, identity)
+        response = await acreate_chat_completion(
+            identity,
+            endpoint="chat",
+            messages=messages,
+            **chat_completion_options(context_info)
+        )
+        ai_reply = response.choices[0].message.content
+        await sync_to_async(save_chat_turn)(session, user_input, ai_reply)
+
+        result = {"reply": ai_reply, "context": context_info}
+        if session is not None:
+            result["session_id"] = str(session.id)
+        return JsonResponse(result, status=200)
+
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+
+    except Exception as e:
+        print(f"AI GM async request error: {str(e)}")
+        return JsonResponse({"error": f"Error communicating with AI: {str(e)}"}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def ai_gm_chat_stream(request):
+    """
+    流式版本的AI GM聊天接口 (Server-Sent Events)
+
+    事件格式:
+        event: delta  -> {"content": "..."}  每收到一段增量文本就立即转发
+        event: done   -> {"reply": "...", "finish_reason": "...", "usage": {...}, "context": {...}}
+        event: error  -> {"error": "..."}  被调度器拒绝时另带 reason 和 retry_after
+    在ASGI服务器下以异步生成器逐段发送；客户端断开连接时Django关闭生成器，
+    此时同时关闭上游的OpenAI流，停止继续生成。
+    并发名额和上游流都在生成器内获取，由生成器的 finally 归还，因此被调度器拒绝时
+    响应状态仍为200，以 error 事件（带 reason 和 retry_after）通知客户端。
+    """
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+    user_input = data.get("message", "")
+
+    if not user_input:
+        return JsonResponse({"error": "Message cannot be empty"}, status=400)
+
+    try:
+        user = await aget_request_user(request)
+        session, history = await sync_to_async(load_chat_history)(data, user)
+    except SessionNotFound:
+        return JsonResponse({"error": "Session not found"}, status=404)
+    except (KeyError, TypeError):
+        # 客户端发送的 history 缺少 role / text 字段或不是列表
+        return JsonResponse({"error": "Invalid history format"}, status=400)
+    identity = client_identity(request, user)
+
+    try:
+        messages, context_info = await sync_to_async(build_chat_messages)(
+            user_input, history, session, identity)
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+    except Exception as e:
+        print(f"AI GM stream request error: {str(e)}")
+        return JsonResponse({"error": f"Error communicating with AI: {str(e)}"}, status=500)
+
+    def open_stream():
+        return aopen_chat_stream(
+            identity,
+            endpoint="chat_stream",
+            messages=messages,
+            stream_options={"include_usage": True},
+            **chat_completion_options(context_info)
+        )
+
+    async def on_complete(ai_reply):
+        await sync_to_async(save_chat_turn)(session, user_input, ai_reply)
+
+    response = StreamingHttpResponse(
+        stream_chat_events(open_stream, on_complete, context_info),
+        content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # 禁止nginx等反向代理缓冲，保证增量及时到达客户端
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def stream_chat_events(open_stream, on_complete=None, context_info=None):
+    """
+    把OpenAI的流式响应转换为SSE事件
+
+    open_stream: 返回 GovernedStream 的协程函数。流在生成器内打开，生成器结束、被关闭或取消时
+    （客户端断开）由 finally 关闭上游流并归还并发名额；生成器从未开始时什么也不占用。
+    on_complete: 完整回复生成后、发送done事件前等待的协程函数，参数为完整回复文本；中途断开时不会调用
+    """
+    reply_parts = []
+    finish_reason = None
+    usage = None
+    stream = None
+    try:
+        stream = await open_stream()
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if choice.delta and choice.delta.content:
+                reply_parts.append(choice.delta.content)
+                yield format_sse("delta", {"content": choice.delta.content})
+
+        ai_reply = "".join(reply_parts)
+        if on_complete is not None:
+            await on_complete(ai_reply)
+
+        yield format_sse("done", {
+            "reply": ai_reply,
+            "finish_reason": finish_reason,
+            "usage": usage,
+            "context": context_info
+        })
+    except (GeneratorExit, asyncio.CancelledError):
+        print("AI GM stream aborted: client disconnected")
+        raise
+    except GovernorRejected as e:
+        yield format_sse("error", {
+            "error": "AI service is busy, please retry later",
+            "reason": e.reason,
+            "retry_after": e.retry_after
+        })
+    except Exception as e:
+        print(f"AI GM stream error: {str(e)}")
+        yield format_sse("error", {"error": f"Error communicating with AI: {str(e)}"})
+    finally:
+        if stream is not None:
+            await stream.aclose()
+
+
+def background_spec(data):
+    """从请求数据中取出角色背景生成的参数，种族或职业缺失时返回None"""
+    spec = {
+        "name": data.get("name", ""),
+        "race": data.get("race", ""),
+        "class": data.get("class", ""),
+        "background": data.get("background", ""),
+        "alignment": data.get("alignment", ""),
+        "keywords": data.get("keywords", []),
+        "tone": data.get("tone", "balanced"),
+        "language": data.get("language", "chinese"),
+    }
+    if not spec["race"] or not spec["class"]:
+        return None
+    return spec
+
+
+def background_spec_key(spec):
+    """角色背景参数的缓存键"""
+    return background_cache_key(
+        spec["name"], spec["race"], spec["class"], spec["background"],
+        spec["alignment"], spec["keywords"], spec["tone"], spec["language"])
+
+
+def background_payload(spec, background_story, cached):
+    """角色背景接口的返回数据"""
+    return {
+        "background": background_story,
+        "name": spec["name"],
+        "race": spec["race"],
+        "class": spec["class"],
+        "alignment": spec["alignment"],
+        "background_type": spec["background"],
+        "language": spec["language"],
+        "cached": cached
+    }
+
+
+async def agenerate_background(identity, spec, force_regenerate=False):
+    """
+    生成（或从缓存读取）角色背景
+
+    返回:
+        (background_story, cached)
+    """
+    cache_key = background_spec_key(spec)
+    cached = None
+    if force_regenerate:
+        background_cache.bypass()
+    else:
+        cached = await sync_to_async(background_cache.get)(cache_key)
+    if cached is not None:
+        return cached["background"], True
+
+    async def generate():
+        messages = build_background_messages(
+            spec["name"], spec["race"], spec["class"], spec["background"],
+            spec["alignment"], spec["keywords"], spec["tone"], spec["language"])
+        response = await acreate_chat_completion(
+            identity,
+            endpoint="background",
+            messages=messages,
+            **BACKGROUND_COMPLETION_OPTIONS
+        )
+        result = {"background": response.choices[0].message.content}
+        await sync_to_async(background_cache.set)(cache_key, result)
+        return result
+
+    result, _ = await background_flight.ado(
+        background_flight_key(identity, cache_key), generate)
+    return result["background"], False
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_character_background(request):
+    """根据D&D规则生成角色背景故事（异步版本）"""
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "请求体不是有效的JSON"}, status=400)
+
+    spec = background_spec(data)
+    force_regenerate = bool(data.get("force_regenerate", False))
+
+    if spec is None:
+        return JsonResponse({"error": "角色种族和职业是必需的"}, status=400)
+
+    identity = client_identity(request, await aget_request_user(request))
+
+    try:
+        background_story, cached = await agenerate_background(identity, spec, force_regenerate)
+        return JsonResponse(background_payload(spec, background_story, cached), status=200)
+
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+
+    except Exception as e:
+        return JsonResponse({"error": f"生成角色背景时出错: {str(e)}"}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_character_backgrounds_batch(request):
+    """
+    批量生成角色背景（例如整个队伍或一批NPC），以 Server-Sent Events 逐个返回
+
+    请求体: {"characters": [{name, race, class, ...}, ...], "force_regenerate": false}
+    完全相同的角色只生成一次，已缓存的角色直接返回；需要生成的角色最多
+    AIGM_BACKGROUND_BATCH_CONCURRENCY 个并发生成，开始前一次性从用户令牌桶预留整批所需的令牌，
+    令牌不足时整批返回 429，而不是生成到一半后逐个被拒绝。
+
+    事件格式:
+        event: start -> {"total": N, "unique": M}
+        event: item  -> {"index": i, "status": "ok", ...与单个接口相同的字段}
+                        或 {"index": i, "status": "error", "error": "...", "retry_after": ...}
+        event: done  -> {"total": N, "succeeded": x, "failed": y}
+    客户端断开时取消尚未完成的生成。
+    """
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "请求体不是有效的JSON"}, status=400)
+
+    characters = data.get("characters")
+    if not isinstance(characters, list) or not characters:
+        return JsonResponse({"error": "characters 必须是非空列表"}, status=400)
+    if len(characters) > settings.AIGM_BACKGROUND_BATCH_MAX_ITEMS:
+        return JsonResponse({
+            "error": f"一次最多生成 {settings.AIGM_BACKGROUND_BATCH_MAX_ITEMS} 个角色背景"
+        }, status=400)
+
+    force_regenerate = bool(data.get("force_regenerate", False))
+    identity = client_identity(request, await aget_request_user(request))
+
+    # 按缓存键合并完全相同的角色：键 -> (参数, 原始序号列表)
+    groups = {}
+    invalid = []
+    for index, item in enumerate(characters):
+        spec = background_spec(item) if isinstance(item, dict) else None
+        if spec is None:
+            invalid.append(index)
+            continue
+        groups.setdefault(background_spec_key(spec), (spec, []))[1].append(index)
+
+    # 先读取缓存，只有未命中的角色才需要调用上游
+    def cached_backgrounds():
+        hits = {}
+        for key in groups:
+            cached = background_cache.get(key)
+            if cached is not None:
+                hits[key] = cached["background"]
+        return hits
+
+    hits = {} if force_regenerate else await sync_to_async(cached_backgrounds)()
+    uncached = len(groups) - len(hits)
+
+    # 每个需要生成的角色消耗一个调度器令牌，超过令牌桶容量的批次永远无法完成
+    if uncached > governor.user_burst:
+        return JsonResponse({
+            "error": f"一次最多生成 {governor.user_burst} 个不同的角色背景"
+        }, status=400)
+    try:
+        reservation = governor.reserve(identity, uncached)
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+
+    semaphore = asyncio.Semaphore(settings.AIGM_BACKGROUND_BATCH_CONCURRENCY)
+
+    async def run(key):
+        spec, _ = groups[key]
+        if key in hits:
+            return key, dict(background_payload(spec, hits[key], True), status="ok")
+        async with semaphore:
+            try:
+                with reservation.use():
+                    background_story, cached = await agenerate_background(
+                        identity, spec, force_regenerate)
+            except GovernorRejected as e:
+                return key, {"status": "error", "error": "AI service is busy, please retry later",
+                             "retry_after": e.retry_after}
+            except Exception as e:
+                print(f"批量生成角色背景出错: {str(e)}")
+                return key, {"status": "error", "error": f"生成角色背景时出错: {str(e)}"}
+        return key, dict(background_payload(spec, background_story, cached), status="ok")
+
+    async def events():
+        succeeded = 0
+        yield format_sse("start", {"total": len(characters), "unique": len(groups)})
+        for index in invalid:
+            yield format_sse("item", {"index": index, "status": "error", "error": "角色种族和职业是必需的"})
+
+        tasks = [asyncio.ensure_future(run(key)) for key in groups]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, result = await next_done
+                for index in groups[key][1]:
+                    succeeded += result["status"] == "ok"
+                    yield format_sse("item", dict(result, index=index))
+        finally:
+            # 客户端断开时取消剩余的生成，并退回没有用到的令牌
+            for task in tasks:
+                task.cancel()
+            reservation.close()
+
+        yield format_sse("done", {
+            "total": len(characters),
+            "succeeded": succeeded,
+            "failed": len(characters) - succeeded,
+        })
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_character_portrait(request):
+    """生成角色立绘并保存到Cloudinary（异步版本）"""
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "请求体不是有效的JSON"}, status=400)
+
+    character_name = data.get("name", "")
+    character_race = data.get("race", "")
+    character_subrace = data.get("subrace", "")
+    character_class = data.get("class", "")
+    character_gender = data.get("gender", "")
+    character_style = data.get("style", "fantasy")
+    features = data.get("features", [])
+
+    if not character_race or not character_class:
+        return JsonResponse({"error": "角色种族和职业是必需的"}, status=400)
+
+    try:
+        identity = client_identity(request, await aget_request_user(request))
+        flight_key = portrait_flight_key(
+            identity, character_name, character_race, character_subrace, character_class,
+            character_gender, character_style, features)
+        result, shared = await portrait_flight.ado(flight_key, lambda: arun_portrait_pipeline(
+            identity, character_name, character_race, character_subrace, character_class,
+            character_gender, character_style, features))
+
+        return JsonResponse(dict(result, shared=shared), status=200)
+
+    except PortraitGenerationError as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+
+    except Exception as e:
+        print(f"异步生成角色立绘时出错: {str(e)}")
+        return JsonResponse({"error": f"生成角色立绘时出错: {str(e)}"}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_character_portrait_variants(request):
+    """
+    同时生成多张候选立绘，以 Server-Sent Events 逐张返回
+
+    请求体与 /character-portrait/ 相同，另加 "variants": 候选数量（2 到 AIGM_PORTRAIT_MAX_VARIANTS）。
+    各候选并发生成并各自上传到Cloudinary，玩家选定后调用
+    POST /api/aigm/character-portrait/variants/<variant_set>/select/，其余候选在后台删除。
+
+    事件格式:
+        event: start   -> {"variant_set": "...", "variants": K}
+        event: variant -> {"index": i, "status": "ok", ...与单张立绘接口相同的字段}
+                          或 {"index": i, "status": "error", "error": "..."}
+        event: done    -> {"variant_set": "...", "succeeded": x, "failed": y}
+    客户端中途断开时取消尚未完成的候选，已上传的候选仍可选择。
+    """
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "请求体不是有效的JSON"}, status=400)
+
+    character_name = data.get("name", "")
+    character_race = data.get("race", "")
+    character_subrace = data.get("subrace", "")
+    character_class = data.get("class", "")
+    character_gender = data.get("gender", "")
+    character_style = data.get("style", "fantasy")
+    features = data.get("features", [])
+
+    if not character_race or not character_class:
+        return JsonResponse({"error": "角色种族和职业是必需的"}, status=400)
+    try:
+        variants = int(data.get("variants", 3))
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "variants 必须是整数"}, status=400)
+    if not 2 <= variants <= settings.AIGM_PORTRAIT_MAX_VARIANTS:
+        return JsonResponse({
+            "error": f"variants 必须在 2 到 {settings.AIGM_PORTRAIT_MAX_VARIANTS} 之间"
+        }, status=400)
+
+    identity = client_identity(request, await aget_request_user(request))
+    variant_set_id = uuid.uuid4().hex
+
+    async def run(index):
+        try:
+            result = await arun_portrait_pipeline(
+                identity, character_name, character_race, character_subrace, character_class,
+                character_gender, character_style, features)
+        except GovernorRejected as e:
+            return index, {"status": "error", "error": "AI service is busy, please retry later",
+                           "retry_after": e.retry_after}
+        except Exception as e:
+            print(f"生成候选立绘时出错: {str(e)}")
+            return index, {"status": "error", "error": f"生成角色立绘时出错: {str(e)}"}
+        return index, dict(result, status="ok")
+
+    async def events():
+        public_ids = []
+        yield format_sse("start", {"variant_set": variant_set_id, "variants": variants})
+
+        tasks = [asyncio.ensure_future(run(index)) for index in range(variants)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, result = await next_done
+                if result["status"] == "ok":
+                    public_ids.append(result["public_id"])
+                yield format_sse("variant", dict(result, index=index))
+        finally:
+            for task in tasks:
+                task.cancel()
+            # 包括中途断开的情况：已上传的候选都登记下来，选定后才能清理其余候选
+            await sync_to_async(save_variant_set)(variant_set_id, identity, public_ids)
+
+        yield format_sse("done", {
+            "variant_set": variant_set_id,
+            "succeeded": len(public_ids),
+            "failed": variants - len(public_ids),
+        })
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def arun_portrait_pipeline(identity, character_name, character_race, character_subrace, character_class,
+                                 character_gender, character_style, features):
+    """run_portrait_pipeline 的异步版本"""
+    portrait_prompt = build_portrait_prompt(
+        character_name, character_race, character_subrace, character_class,
+        character_gender, character_style, features)
+
+    response = await agenerate_image(
+        identity,
+        endpoint="portrait",
+        prompt=portrait_prompt,
+        **PORTRAIT_IMAGE_OPTIONS
+    )
+    upload_result = await atransfer_portrait_image(response.data[0], portrait_folder(identity))
+
+    if not upload_result['success']:
+        raise PortraitGenerationError(
+            f"图像上传到Cloudinary失败: {upload_result['error']}")
+
+    return portrait_result(upload_result, character_name, character_race, character_class)
+
+
+async def atransfer_portrait_image(image, folder=PORTRAIT_FOLDER):
+    """transfer_portrait_image 的异步版本（Cloudinary SDK 只有同步接口，上传放到线程池中执行）"""
+    upload = sync_to_async(upload_dalle_image, thread_sensitive=False)
+
+    if image.b64_json:
+        return await upload(image.b64_json, folder=folder)
+
+    if settings.AIGM_PORTRAIT_TRANSFER == "fetch":
+        upload_result = await upload(image.url, folder=folder)
+        if upload_result['success']:
+            return upload_result
+        print(f"Cloudinary拉取DALL-E图像失败，改为下载后上传: {upload_result['error']}")
+
+    # 异步下载DALL-E生成的图像（复用当前事件循环的共享连接池）；与同步版本一样整张读入内存，
+    # 见 transfer_portrait_image
+    image_response = await get_async_http_client("images").get(image.url)
+    if image_response.status_code != 200:
+        raise PortraitGenerationError(
+            f"无法下载DALL-E生成的图像，状态码: {image_response.status_code}")
+
+    return await upload(image_response.content, folder=folder)
+
+
+@require_http_methods(["GET"])
+async def portrait_job_status(request, job_id):
+    """
+    查询立绘任务状态
+
+    ?wait=<秒> 时长轮询：任务结束或等待超时（最长 AIGM_PORTRAIT_JOB_MAX_WAIT 秒）才返回，
+    等待期间不占用工作线程
+    """
+    try:
+        wait = min(max(float(request.GET.get("wait", 0)), 0),
+                   settings.AIGM_PORTRAIT_JOB_MAX_WAIT)
+    except ValueError:
+        return JsonResponse({"error": "wait 必须是数字"}, status=400)
+
+    user = await aget_request_user(request)
+    try:
+        job = await PortraitJob.objects.aget(id=job_id)
+    except (PortraitJob.DoesNotExist, ValidationError):
+        return JsonResponse({"error": "任务不存在"}, status=404)
+    if job.identity != client_identity(request, user):
+        return JsonResponse({"error": "任务不存在"}, status=404)
+
+    if wait > 0:
+        job = await await_job(job.id, wait)
+    return JsonResponse(job_payload(job), status=200)
+
+
+@csrf_exempt
+@require_http_methods(["DELETE"])
+async def delete_image(request, public_id):
+    """从Cloudinary删除指定的图片（异步版本）"""
+    try:
+        result = await sync_to_async(delete_cloudinary_image, thread_sensitive=False)(public_id)
+
+        if result['success']:
+            return JsonResponse({
+                "message": f"图片 {public_id} 已成功删除"
+            }, status=200)
+        return JsonResponse({
+            "error": f"删除图片失败: {result.get('error')}"
+        }, status=400)
+
+    except Exception as e:
+        return JsonResponse({"error": f"删除图片时出错: {str(e)}"}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def delete_images(request):
+    """批量从Cloudinary删除当前用户的图片（异步版本）"""
+    user = await aget_request_user(request)
+    if user is None:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+
+    data = parse_json_body(request)
+    if data is None:
+        return JsonResponse({"error": "请求体不是有效的JSON"}, status=400)
+
+    public_ids, error = parse_public_ids(data)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+    forbidden = foreign_public_ids(user, public_ids)
+    if forbidden:
+        return JsonResponse({"error": "不能删除不属于当前用户的图片", "public_ids": forbidden}, status=403)
+
+    try:
+        results = await sync_to_async(bulk_delete_images, thread_sensitive=False)(public_ids)
+        return JsonResponse(bulk_delete_result(results), status=200)
+
+    except Exception as e:
+        return JsonResponse({"error": f"批量删除图片时出错: {str(e)}"}, status=500)
@@ -0,0 +1,174 @@
+"""
+AI 生成结果缓存
+
+两级缓存：
+    1. 进程内LRU：命中时不访问数据库
+    2. 数据库 (GenerationCacheEntry)：各worker之间共享，重启后仍然有效
+
+缓存键是规范化输入与模型参数的SHA-256哈希，相同的输入（忽略空白、关键词顺序等差异）命中同一条缓存。
+两级都有TTL；LRU按条数淘汰，数据库层在写入时定期清理过期条目并按最近使用时间淘汰超出上限的条目。
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import GenerationCacheEntry
+
+# 每写入多少次执行一次数据库层清理
+PRUNE_EVERY_SETS = 50
+
+
+def normalize_text(value):
+    """去除首尾空白并合并连续空白"""
+    return " ".join(str(value).split())
+
+
+def make_cache_key(kind, inputs, options):
+    """
+    根据规范化输入和模型参数计算缓存键
+
+    参数:
+        kind: 缓存类别，例如 "background"
+        inputs: 已规范化的输入字典
+        options: 模型参数（model、temperature 等）
+    """
+    raw = json.dumps([kind, inputs, options], ensure_ascii=False,
+                     sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """
+    进程内LRU + 数据库两级缓存
+
+    参数:
+        kind: 缓存类别，用于区分不同接口的条目
+        ttl: 条目有效期（秒）
+        lru_size: 进程内LRU的最大条数
+        max_entries: 数据库层该类别的最大条数
+    """
+
+    def __init__(self, kind, ttl, lru_size, max_entries):
+        self.kind = kind
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._sets_since_prune = 0
+        self._stats = {
+            "lru_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "bypassed": 0,
+            "lru_evictions": 0,
+            "db_evictions": 0,
+            "errors": 0,
+        }
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        now = time.time()
+        with self._lock:
+            item = self._lru.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > now:
+                    self._lru.move_to_end(key)
+                    self._stats["lru_hits"] += 1
+                    return value
+                del self._lru[key]
+
+        try:
+            entry = GenerationCacheEntry.objects.filter(
+                key=key, kind=self.kind, expires_at__gt=timezone.now()).first()
+            if entry is not None:
+                GenerationCacheEntry.objects.filter(key=key).update(
+                    hit_count=F("hit_count") + 1, last_used_at=timezone.now())
+        except Exception as e:
+            print(f"生成缓存读取错误: {str(e)}")
+            entry = None
+            self._incr("errors")
+
+        if entry is None:
+            self._incr("misses")
+            return None
+
+        self._incr("db_hits")
+        self._remember(key, entry.value, entry.expires_at.timestamp())
+        return entry.value
+
+    def set(self, key, value):
+        """写入两级缓存"""
+        expires_at = timezone.now() + timedelta(seconds=self.ttl)
+        self._remember(key, value, expires_at.timestamp())
+        self._incr("sets")
+
+        try:
+            GenerationCacheEntry.objects.update_or_create(
+                key=key,
+                defaults={
+                    "kind": self.kind,
+                    "value": value,
+                    "expires_at": expires_at,
+                    "last_used_at": timezone.now(),
+                },
+            )
+            with self._lock:
+                self._sets_since_prune += 1
+                should_prune = self._sets_since_prune >= PRUNE_EVERY_SETS
+                if should_prune:
+                    self._sets_since_prune = 0
+            if should_prune:
+                self.prune()
+        except Exception as e:
+            print(f"生成缓存写入错误: {str(e)}")
+            self._incr("errors")
+
+    def bypass(self):
+        """记录一次被 force_regenerate 跳过的读取"""
+        self._incr("bypassed")
+
+    def prune(self):
+        """删除过期条目，并按最近使用时间淘汰超出上限的条目"""
+        entries = GenerationCacheEntry.objects.filter(kind=self.kind)
+        deleted, _ = entries.filter(expires_at__lte=timezone.now()).delete()
+
+        overflow = entries.count() - self.max_entries
+        if overflow > 0:
+            stale_keys = list(entries.order_by("last_used_at").values_list(
+                "key", flat=True)[:overflow])
+            deleted += GenerationCacheEntry.objects.filter(
+                key__in=stale_keys).delete()[0]
+
+        self._incr("db_evictions", deleted)
+        return deleted
+
+    def stats(self):
+        """返回命中/未命中计数（当前worker进程）"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["lru_entries"] = len(self._lru)
+        lookups = stats["lru_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_ratio"] = round(
+            (stats["lru_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _remember(self, key, value, expires):
+        with self._lock:
+            self._lru[key] = (value, expires)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+                self._stats["lru_evictions"] += 1
+
+    def _incr(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
@@ -0,0 +1,224 @@
+"""
+AI GM 对话上下文窗口
+
+保证每次请求的提示词不超过配置的token预算：
+    [系统提示词] + [较早对话的摘要] + [最近若干轮对话] + [本轮玩家输入]
+
+较早的对话会被折叠进一段增量更新的摘要。摘要只在窗口滑动时重新生成，
+并且每次滑动都会折叠到预算的一半左右，因此不会每一轮都调用模型：
+    - 服务器端会话：摘要保存在 GameSession.summary / summary_upto
+    - 客户端传入的 history：按历史前缀的哈希缓存在 Django cache 中
+"""
+import hashlib
+import json
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .ai import create_chat_completion
+from .models import GameSession
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时使用近似估算
+    tiktoken = None
+
+# 每条消息的格式开销，以及回复前缀的开销（与OpenAI的计算方式一致）
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+# 摘要的最大长度，同时作为折叠时为摘要预留的预算
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_CACHE_PREFIX = "aigm:summary:"
+SUMMARY_CACHE_TIMEOUT = 60 * 60 * 24
+
+SUMMARY_PROMPT = """You maintain the running summary of a tabletop role-playing campaign run by an AI Game Master.
+Merge the new conversation into the existing summary. Keep every fact a Game Master needs to continue the story:
+player characters, NPCs and their attitudes, locations, quests, items, promises, unresolved threads and the current scene.
+Drop flavour text and repeated descriptions. Write in the language the players use. Reply with the updated summary only."""
+
+# 中日韩字符大约每个字符一个token
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = False
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                # 编码文件无法加载（例如离线环境）时退回近似估算
+                print(f"tiktoken encoding unavailable, using estimate: {str(e)}")
+    return _encoding or None
+
+
+def count_tokens(text):
+    """在本地计算文本的token数量"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages):
+    """计算一组聊天消息作为提示词时的token数量"""
+    total = REPLY_PRIMING_TOKENS
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"])
+    return total
+
+
+def _summary_message(summary):
+    return {"role": "system", "content": f"Summary of the campaign so far:\n{summary}"}
+
+
+def _prefix_cache_keys(history):
+    """计算每个历史前缀的缓存键，keys[i] 对应 history[:i]"""
+    digest = hashlib.sha256()
+    keys = [None]
+    for message in history:
+        digest.update(json.dumps(
+            [message["role"], message["content"]], ensure_ascii=False).encode("utf-8"))
+        keys.append(SUMMARY_CACHE_PREFIX + digest.copy().hexdigest())
+    return keys
+
+
+class ContextWindow:
+    """
+    按token预算构建聊天提示词
+
+    参数:
+        token_budget: 整个提示词（含系统提示词和本轮输入）的token上限
+        max_turns: 最多保留的最近对话轮数（每轮为玩家消息 + GM回复）
+        summary_model: 生成摘要使用的模型
+    """
+
+    def __init__(self, token_budget=None, max_turns=None, summary_model=None):
+        self.token_budget = token_budget or settings.AIGM_CONTEXT_TOKEN_BUDGET
+        self.max_turns = max_turns or settings.AIGM_CONTEXT_MAX_TURNS
+        self.summary_model = summary_model or settings.AIGM_SUMMARY_MODEL
+
+    def build(self, system_prompt, history, user_input, session=None, identity=None, references=None,
+              history_offset=0):
+        """
+        构建提示词
+
+        参数:
+            system_prompt: 系统提示词
+            history: OpenAI 格式的历史消息，从会话的第 history_offset 条消息开始
+            user_input: 本轮玩家输入
+            session: 服务器端会话（有则摘要保存在会话上）
+            identity: 请求方标识，生成摘要的调用计入该用户的并发配额
+            references: 本轮的参考资料（例如规则书摘录），紧挨在玩家输入之前发送，不进入历史
+            history_offset: history[0] 在会话中的序号；服务器端会话只加载未折叠进摘要的消息时使用，
+                下文的 summary_upto / cutoff 都是 history 内的下标，保存时再加回偏移
+
+        返回:
+            (messages, info): info 包含本次提示词的token数等信息
+        """
+        keys = None if session is not None else _prefix_cache_keys(history)
+        summary, summary_upto = self._load_summary(history, session, keys, history_offset)
+
+        fixed_messages = [{"role": "system", "content": system_prompt},
+                          {"role": "user", "content": user_input}]
+        if references:
+            fixed_messages.insert(1, {"role": "system", "content": references})
+        fixed_tokens = count_message_tokens(fixed_messages)
+        pending = history[summary_upto:]
+
+        summary_tokens = count_message_tokens([_summary_message(summary)]) if summary else 0
+        if not self._fits(pending, fixed_tokens + summary_tokens):
+            # 窗口滑动：把较早的消息折叠进摘要，只保留大约一半预算的最近消息
+            cutoff = summary_upto + self._fold_point(pending, fixed_tokens)
+            if cutoff > summary_upto:
+                new_summary = self._summarize(
+                    summary, history[summary_upto:cutoff], identity)
+                if new_summary is not None:
+                    summary = new_summary
+                    self._store_summary(session, keys, summary, cutoff, history_offset)
+                summary_upto = cutoff
+                pending = history[summary_upto:]
+
+        messages = [fixed_messages[0]]
+        if summary:
+            messages.append(_summary_message(summary))
+        messages.extend(pending)
+        messages.extend(fixed_messages[1:])
+
+        return messages, {
+            "prompt_tokens": count_message_tokens(messages),
+            "token_budget": self.token_budget,
+            "history_messages": len(pending),
+            "summarized_messages": history_offset + summary_upto,
+        }
+
+    def _fits(self, pending, reserved_tokens):
+        if len(pending) > self.max_turns * 2:
+            return False
+        return reserved_tokens + count_message_tokens(pending) - REPLY_PRIMING_TOKENS <= self.token_budget
+
+    def _fold_point(self, pending, fixed_tokens):
+        """从末尾向前保留约一半的轮数和预算，返回需要折叠的消息数量（至少折叠到只剩最后一条）"""
+        keep_budget = max(self.token_budget - fixed_tokens - SUMMARY_MAX_TOKENS, 0) // 2
+        keep_messages = self.max_turns  # 即 max_turns * 2 条消息的一半
+        kept = 0
+        used = 0
+        for message in reversed(pending):
+            cost = MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"])
+            if kept >= keep_messages or used + cost > keep_budget:
+                break
+            kept += 1
+            used += cost
+        return len(pending) - max(kept, 1) if kept < len(pending) else 0
+
+    def _load_summary(self, history, session, keys, history_offset=0):
+        if session is not None:
+            upto = min(max(session.summary_upto - history_offset, 0), len(history))
+            return session.summary, upto
+
+        # 查找已缓存摘要的最长历史前缀
+        candidates = cache.get_many(keys[1:])
+        for upto in range(len(history), 0, -1):
+            summary = candidates.get(keys[upto])
+            if summary is not None:
+                return summary, upto
+        return "", 0
+
+    def _store_summary(self, session, keys, summary, summary_upto, history_offset=0):
+        if session is not None:
+            summary_upto += history_offset
+            GameSession.objects.filter(pk=session.pk).update(
+                summary=summary, summary_upto=summary_upto)
+            session.summary = summary
+            session.summary_upto = summary_upto
+        else:
+            cache.set(keys[summary_upto], summary, SUMMARY_CACHE_TIMEOUT)
+
+    def _summarize(self, previous_summary, folded, identity=None):
+        """把新折叠的消息合并进已有摘要；失败时返回None（本次直接丢弃较早消息）"""
+        transcript = "\n".join(
+            f"{'GM' if m['role'] == 'assistant' else 'Player'}: {m['content']}" for m in folded)
+        try:
+            response = create_chat_completion(
+                identity,
+                endpoint="summary",
+                model=self.summary_model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew conversation:\n{transcript}"}
+                ],
+                temperature=0.3,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"AI GM summary error: {str(e)}")
+            return None
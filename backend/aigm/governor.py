@@ -0,0 +1,331 @@
+"""
+上游AI调用的并发调度器
+
+所有 OpenAI 调用在发出前都要先获得一个并发名额：
+    - 全局并发上限：同一时间最多 max_concurrent 个进行中的上游调用
+    - 每个用户一个令牌桶：超过速率限制时立即拒绝
+    - 公平排队：名额用完时按用户轮询分配，单个用户的大量请求不会饿死其他用户
+    - 有界等待：队列已满或等待超过 max_wait 时以 GovernorRejected 拒绝，
+      视图返回 429 并带上 Retry-After
+
+批量接口可以用 reserve() 预先一次性扣除整批调用所需的令牌，批内的调用在
+reservation.use() 中获取名额时消耗预留的令牌而不再扣除令牌桶。
+
+同步线程和异步协程共用同一个调度器实例。队列深度、排队时间和拒绝次数除了 stats() 之外
+还导出为 Prometheus 指标（见 backend/metrics.py）。
+"""
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from backend.metrics import (
+    observe_governor_rejection, observe_governor_state, observe_governor_wait,
+)
+
+# 令牌桶数量超过该值时清理已回满的桶
+MAX_IDLE_BUCKETS = 10000
+
+# 当前上下文（线程或异步任务）中生效的令牌预留
+_current_reservation = contextvars.ContextVar("governor_reservation", default=None)
+
+
+class GovernorRejected(Exception):
+    """请求被调度器拒绝"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class _Waiter:
+    """排队中的一个请求；同步请求等待 Event，异步请求等待事件循环中的 Future"""
+
+    def __init__(self, identity, loop=None):
+        self.identity = identity
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class Reservation:
+    """
+    预先从用户令牌桶扣除的一批令牌
+
+    在 use() 中获取名额时优先消耗预留的令牌；close() 把没有用到的令牌退回令牌桶。
+    """
+
+    def __init__(self, governor, identity, count):
+        self.governor = governor
+        self.identity = identity
+        self.remaining = count
+
+    @contextmanager
+    def use(self):
+        token = _current_reservation.set(self)
+        try:
+            yield self
+        finally:
+            _current_reservation.reset(token)
+
+    def close(self):
+        """退回未使用的令牌（可重复调用）"""
+        with self.governor._lock:
+            for _ in range(self.remaining):
+                self.governor._refund_token(self.identity)
+            self.remaining = 0
+
+
+class Governor:
+    """
+    参数:
+        max_concurrent: 全局最大并发上游调用数
+        max_queue: 最大排队请求数
+        max_wait: 最长排队时间（秒）
+        user_rate: 每个用户的令牌补充速率（次/秒）
+        user_burst: 每个用户令牌桶容量
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait, user_rate, user_burst):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict()
+        self._buckets = {}
+        self._avg_hold = 5.0
+        self._stats = {
+            "granted": 0,
+            "granted_after_wait": 0,
+            "rejected_rate_limit": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def acquire(self, identity):
+        """获取一个并发名额（阻塞），返回需传给 release() 的开始时间"""
+        waiter = self._admit(identity, loop=None)
+        if waiter is None:
+            return time.monotonic()
+
+        waiter.event.wait(self.max_wait)
+        return self._finish_wait(waiter)
+
+    async def aacquire(self, identity):
+        """acquire() 的异步版本"""
+        waiter = self._admit(identity, loop=asyncio.get_running_loop())
+        if waiter is None:
+            return time.monotonic()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # 客户端断开：放弃排队，已分配的名额需要归还
+            if self._abandon(waiter):
+                self.release(time.monotonic())
+            raise
+        return self._finish_wait(waiter)
+
+    def release(self, started_at):
+        """归还名额，并按用户轮询把它交给下一个排队的请求"""
+        held = time.monotonic() - started_at
+        with self._lock:
+            self._avg_hold = self._avg_hold * 0.9 + held * 0.1
+            waiter = self._next_waiter()
+            if waiter is None:
+                self._active -= 1
+                self._observe_state()
+                return
+            # 名额直接转交，_active 不变
+            self._record_grant(waiter)
+            self._observe_state()
+        waiter.grant()
+
+    def reserve(self, identity, count):
+        """
+        一次性从用户令牌桶扣除 count 个令牌，返回 Reservation
+
+        令牌不足时整批以 rate_limited 拒绝，不扣除任何令牌。
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(identity, (self.user_burst, now))
+            tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+            if tokens < count:
+                self._buckets[identity] = (tokens, now)
+                self._stats["rejected_rate_limit"] += 1
+                observe_governor_rejection("rate_limited")
+                raise GovernorRejected("rate_limited", (count - tokens) / self.user_rate)
+            self._buckets[identity] = (tokens - count, now)
+        return Reservation(self, identity, count)
+
+    @contextmanager
+    def slot(self, identity):
+        started_at = self.acquire(identity)
+        try:
+            yield
+        finally:
+            self.release(started_at)
+
+    @asynccontextmanager
+    async def aslot(self, identity):
+        started_at = await self.aacquire(identity)
+        try:
+            yield
+        finally:
+            self.release(started_at)
+
+    def stats(self):
+        """返回队列深度、等待时间和拒绝次数（当前worker进程）"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "active": self._active,
+                "queued": self._queued,
+                "queued_users": len(self._queues),
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "avg_hold_seconds": round(self._avg_hold, 3),
+            })
+        waited = stats["granted_after_wait"]
+        stats["wait_seconds_avg"] = round(
+            stats["wait_seconds_total"] / waited, 3) if waited else 0.0
+        return stats
+
+    def _admit(self, identity, loop):
+        """检查速率限制并尝试立即获得名额；需要排队时返回 _Waiter"""
+        with self._lock:
+            retry_after = self._take_token(identity)
+            if retry_after is not None:
+                self._stats["rejected_rate_limit"] += 1
+                observe_governor_rejection("rate_limited")
+                raise GovernorRejected("rate_limited", retry_after)
+
+            if self._active < self.max_concurrent and self._queued == 0:
+                self._active += 1
+                self._stats["granted"] += 1
+                self._observe_state()
+                return None
+
+            if self._queued >= self.max_queue:
+                self._refund_token(identity)
+                self._stats["rejected_queue_full"] += 1
+                observe_governor_rejection("queue_full")
+                raise GovernorRejected("queue_full", self._estimate_wait())
+
+            waiter = _Waiter(identity, loop)
+            self._queues.setdefault(identity, deque()).append(waiter)
+            self._queued += 1
+            self._observe_state()
+            return waiter
+
+    def _finish_wait(self, waiter):
+        if self._abandon(waiter):
+            return time.monotonic()
+        self._stats_incr("rejected_timeout")
+        observe_governor_rejection("queue_timeout")
+        raise GovernorRejected("queue_timeout", self._estimate_wait())
+
+    def _abandon(self, waiter):
+        """从队列中移除等待者；返回它是否已经获得名额"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            queue = self._queues.get(waiter.identity)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self._queued -= 1
+                if not queue:
+                    del self._queues[waiter.identity]
+                self._observe_state()
+            self._refund_token(waiter.identity)
+            return False
+
+    def _next_waiter(self):
+        # 轮询：取队首用户的第一个请求，该用户还有请求时移到队尾
+        while self._queues:
+            identity, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(identity)
+            else:
+                del self._queues[identity]
+            return waiter
+        return None
+
+    def _record_grant(self, waiter):
+        waited = time.monotonic() - waiter.enqueued_at
+        self._stats["granted"] += 1
+        self._stats["granted_after_wait"] += 1
+        self._stats["wait_seconds_total"] += waited
+        self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+        observe_governor_wait(waited)
+        waiter.granted = True
+
+    def _observe_state(self):
+        """把名额占用和排队深度导出到 Prometheus（调用时持有 self._lock）"""
+        observe_governor_state(self._active, self._queued)
+
+    def _take_token(self, identity):
+        """从用户令牌桶取一个令牌；令牌不足时返回需要等待的秒数"""
+        reservation = _current_reservation.get()
+        if (reservation is not None and reservation.governor is self
+                and reservation.identity == identity and reservation.remaining > 0):
+            reservation.remaining -= 1
+            return None
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(identity, (self.user_burst, now))
+        tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+        if tokens < 1:
+            self._buckets[identity] = (tokens, now)
+            return (1 - tokens) / self.user_rate
+        self._buckets[identity] = (tokens - 1, now)
+        if len(self._buckets) > MAX_IDLE_BUCKETS:
+            self._prune_buckets(now)
+        return None
+
+    def _refund_token(self, identity):
+        tokens, updated = self._buckets.get(identity, (self.user_burst, time.monotonic()))
+        self._buckets[identity] = (min(self.user_burst, tokens + 1), updated)
+
+    def _prune_buckets(self, now):
+        full_after = self.user_burst / self.user_rate
+        for identity, (_, updated) in list(self._buckets.items()):
+            if now - updated >= full_after:
+                del self._buckets[identity]
+
+    def _estimate_wait(self):
+        return self._avg_hold * (self._queued + 1) / self.max_concurrent
+
+    def _stats_incr(self, name):
+        with self._lock:
+            self._stats[name] += 1
@@ -0,0 +1,233 @@
+"""
+立绘生成任务队列
+
+立绘生成（DALL-E生成、下载图像、上传Cloudinary）耗时较长，不适合在HTTP请求中完成：
+    - 提交接口写入一条 PortraitJob 后立即返回任务ID
+    - 立绘worker从数据库领取任务并执行，无需额外的消息队列
+    - 状态接口支持长轮询，任务完成时返回与同步接口相同的结果数据
+
+领取任务使用带条件的 UPDATE，多个worker进程同时领取时每个任务只会被一个worker拿到。
+worker在每个阶段续租；进程崩溃后租约过期，任务会被其他worker重新领取（最多 AIGM_PORTRAIT_JOB_MAX_ATTEMPTS 次）。
+
+worker可以单独运行（python manage.py run_portrait_workers），
+也可以通过 AIGM_PORTRAIT_INLINE_WORKERS 在web进程内启动。
+"""
+import asyncio
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .governor import GovernorRejected
+from .models import PortraitJob
+
+TERMINAL_STATUSES = (PortraitJob.STATUS_SUCCEEDED, PortraitJob.STATUS_FAILED)
+
+# 每次领取时尝试的候选任务数（前面的候选被其他worker抢走时继续尝试下一个）
+CLAIM_CANDIDATES = 5
+
+# 清理已结束任务的间隔（秒）
+PRUNE_INTERVAL = 600
+
+_inline_pool = None
+_inline_lock = threading.Lock()
+
+
+def submit_job(user, identity, dedupe_key, params):
+    """
+    提交立绘任务
+
+    返回:
+        (job, existing): 已有相同的排队或执行中任务时直接返回该任务，existing 为True
+    """
+    job = PortraitJob.objects.filter(
+        identity=identity, dedupe_key=dedupe_key,
+        status__in=[PortraitJob.STATUS_QUEUED, PortraitJob.STATUS_RUNNING],
+    ).order_by("-created_at").first()
+    if job is not None:
+        return job, True
+
+    job = PortraitJob.objects.create(
+        user=user, identity=identity, dedupe_key=dedupe_key, params=params)
+    if _inline_pool is not None:
+        _inline_pool.wake()
+    return job, False
+
+
+def job_payload(job):
+    """任务状态接口的返回数据"""
+    payload = {
+        "job_id": str(job.id),
+        "status": job.status,
+        "stage": job.stage,
+        "attempts": job.attempts,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == PortraitJob.STATUS_SUCCEEDED:
+        payload["result"] = job.result
+    elif job.status == PortraitJob.STATUS_FAILED:
+        payload["error"] = job.error
+    return payload
+
+
+async def await_job(job_id, timeout, poll_interval=None):
+    """等待任务结束或超时，返回最新的任务记录；等待期间不占用线程"""
+    poll_interval = poll_interval or settings.AIGM_PORTRAIT_JOB_POLL_INTERVAL
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await PortraitJob.objects.aget(id=job_id)
+        if job.status in TERMINAL_STATUSES or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+
+def claim_job(worker_id):
+    """领取一个可执行的任务（排队中，或租约已过期的执行中任务），没有时返回None"""
+    now = timezone.now()
+    claimable = (Q(status=PortraitJob.STATUS_QUEUED, available_at__lte=now)
+                 | Q(status=PortraitJob.STATUS_RUNNING, lease_expires_at__lt=now))
+    candidates = PortraitJob.objects.filter(claimable).order_by(
+        "created_at").values_list("id", flat=True)[:CLAIM_CANDIDATES]
+
+    for job_id in list(candidates):
+        claimed = PortraitJob.objects.filter(claimable, id=job_id).update(
+            status=PortraitJob.STATUS_RUNNING,
+            stage="",
+            worker=worker_id,
+            attempts=F("attempts") + 1,
+            started_at=now,
+            lease_expires_at=now + timedelta(seconds=settings.AIGM_PORTRAIT_JOB_LEASE),
+        )
+        if claimed:
+            return PortraitJob.objects.get(id=job_id)
+    return None
+
+
+def run_job(job, worker_id):
+    """执行已领取的任务；所有状态更新都以 worker 为条件，任务被重新领取后旧worker的写入无效"""
+    from .views import run_portrait_pipeline
+
+    owned = PortraitJob.objects.filter(id=job.id, worker=worker_id)
+
+    if job.attempts > settings.AIGM_PORTRAIT_JOB_MAX_ATTEMPTS:
+        owned.update(status=PortraitJob.STATUS_FAILED, error="立绘生成超时，请重试",
+                     finished_at=timezone.now())
+        return
+
+    def on_stage(stage):
+        owned.update(stage=stage, lease_expires_at=timezone.now() + timedelta(
+            seconds=settings.AIGM_PORTRAIT_JOB_LEASE))
+
+    params = job.params
+    try:
+        result = run_portrait_pipeline(
+            job.identity, params["name"], params["race"], params["subrace"], params["class"],
+            params["gender"], params["style"], params["features"], on_stage=on_stage)
+    except GovernorRejected as e:
+        # 被限流时放回队列，稍后重试（不计入尝试次数）
+        owned.update(status=PortraitJob.STATUS_QUEUED, stage="", worker="",
+                     attempts=F("attempts") - 1, lease_expires_at=None,
+                     available_at=timezone.now() + timedelta(seconds=e.retry_after))
+        return
+    except Exception as e:
+        print(f"立绘任务 {job.id} 执行出错: {str(e)}")
+        owned.update(status=PortraitJob.STATUS_FAILED, error=str(e),
+                     finished_at=timezone.now())
+        return
+
+    owned.update(status=PortraitJob.STATUS_SUCCEEDED, stage="", result=result,
+                 finished_at=timezone.now())
+
+
+def prune_jobs():
+    """删除超过保留时间的已结束任务"""
+    cutoff = timezone.now() - timedelta(seconds=settings.AIGM_PORTRAIT_JOB_RETENTION)
+    deleted, _ = PortraitJob.objects.filter(
+        status__in=TERMINAL_STATUSES, finished_at__lt=cutoff).delete()
+    return deleted
+
+
+class PortraitWorkerPool:
+    """
+    在当前进程中运行若干个立绘worker线程
+
+    参数:
+        size: worker线程数
+        poll_interval: 队列为空时的轮询间隔（秒）
+    """
+
+    def __init__(self, size, poll_interval=None):
+        self.size = size
+        self.poll_interval = poll_interval or settings.AIGM_PORTRAIT_JOB_POLL_INTERVAL
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for index in range(self.size):
+            thread = threading.Thread(
+                target=self._run, args=(f"{prefix}:portrait-{index}",),
+                name=f"portrait-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """停止领取新任务，并等待进行中的任务完成"""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def wake(self):
+        """有新任务时唤醒空闲的worker"""
+        self._wake.set()
+
+    def _run(self, worker_id):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                self._maybe_prune()
+                job = claim_job(worker_id)
+                if job is not None:
+                    run_job(job, worker_id)
+                    continue
+            except Exception as e:
+                print(f"立绘worker出错: {str(e)}")
+
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        close_old_connections()
+
+    def _maybe_prune(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_prune < PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+        from .views import prune_variant_sets
+        prune_jobs()
+        prune_variant_sets()
+
+
+def start_inline_workers():
+    """按 AIGM_PORTRAIT_INLINE_WORKERS 在当前web进程内启动worker（只启动一次）"""
+    global _inline_pool
+    if settings.AIGM_PORTRAIT_INLINE_WORKERS <= 0 or _inline_pool is not None:
+        return _inline_pool
+    with _inline_lock:
+        if _inline_pool is None:
+            pool = PortraitWorkerPool(settings.AIGM_PORTRAIT_INLINE_WORKERS)
+            pool.start()
+            _inline_pool = pool
+    return _inline_pool
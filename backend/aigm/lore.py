@@ -0,0 +1,139 @@
+"""
+D&D 设定资料（背景、阵营、种族、职业）注册表
+
+资料保存在 aigm/lore_data/*.json（每个文件带 version 字段），worker启动时加载一次：
+    - 描述文本在加载时就去除缩进和首尾空白，生成提示词时直接使用
+    - 别名索引：完整键（如 "精灵 (Elf)"）、中文名、英文名、slug 及 aliases，均不区分大小写
+    - 种族的亚种各自建立同样的索引
+
+前端通过 /api/aigm/lore/ 获取同一份数据，响应带 ETag（由资料文件内容计算）。
+"""
+import hashlib
+import json
+import re
+import textwrap
+from pathlib import Path
+
+from .cache import normalize_text
+
+LORE_DIR = Path(__file__).resolve().parent / "lore_data"
+
+LORE_KINDS = ("backgrounds", "alignments", "races", "classes")
+
+
+def slugify(value):
+    """转换为 slug：小写，非字母数字字符替换为连字符"""
+    return re.sub(r"[^a-z0-9]+", "-", normalize_text(value).casefold()).strip("-")
+
+
+def alias_key(value):
+    """别名索引使用的规范化形式"""
+    return normalize_text(value).casefold()
+
+
+class LoreTable:
+    """
+    一类设定资料及其别名索引
+
+    参数:
+        kind: 资料类别，例如 "races"
+        version: 资料文件的版本号
+        entries: 资料条目列表
+    """
+
+    def __init__(self, kind, version, entries):
+        self.kind = kind
+        self.version = version
+        self.entries = [self._prepare(entry) for entry in entries]
+        self._index = self._build_index(self.entries)
+        # 亚种索引：上级条目的 key -> {别名: 亚种条目}
+        self._subindex = {
+            entry["key"]: self._build_index(entry["subraces"])
+            for entry in self.entries if entry.get("subraces")
+        }
+
+    @staticmethod
+    def _prepare(entry):
+        entry = dict(entry)
+        entry["text"] = textwrap.dedent(entry["text"]).strip()
+        entry["aliases"] = list(entry.get("aliases", []))
+        if "subraces" in entry:
+            entry["subraces"] = [LoreTable._prepare(sub) for sub in entry["subraces"]]
+        return entry
+
+    def _build_index(self, entries):
+        index = {}
+        for entry in entries:
+            names = [entry["key"], entry.get("name_zh"), entry.get("name_en"),
+                     entry.get("slug")] + entry["aliases"]
+            for name in names:
+                if not name:
+                    continue
+                key = alias_key(name)
+                other = index.setdefault(key, entry)
+                if other is not entry:
+                    raise ValueError(
+                        f"设定资料 {self.kind} 中别名重复: {name!r} ({other['key']} / {entry['key']})")
+        return index
+
+    @staticmethod
+    def _lookup(index, name):
+        if not name:
+            return None
+        entry = index.get(alias_key(name))
+        if entry is None and slugify(name):
+            # "Half Orc"、"half_orc" 等写法按 slug 匹配
+            entry = index.get(slugify(name))
+        return entry
+
+    def get(self, name):
+        """按任意别名查找条目，找不到时返回None"""
+        return self._lookup(self._index, name)
+
+    def get_subrace(self, name, subrace):
+        """查找某个条目下的亚种，找不到时返回None"""
+        entry = self.get(name)
+        if entry is None or entry["key"] not in self._subindex:
+            return None
+        return self._lookup(self._subindex[entry["key"]], subrace)
+
+    def text(self, name, default=""):
+        entry = self.get(name)
+        return entry["text"] if entry is not None else default
+
+    def as_dict(self):
+        return {"kind": self.kind, "version": self.version, "entries": self.entries}
+
+
+class LoreRegistry:
+    """所有类别的设定资料，以及整份数据的版本和 ETag"""
+
+    def __init__(self, tables, etag):
+        self.tables = tables
+        self.etag = etag
+
+    @classmethod
+    def load(cls, directory=LORE_DIR):
+        tables = {}
+        digest = hashlib.sha256()
+        for kind in LORE_KINDS:
+            raw = (Path(directory) / f"{kind}.json").read_bytes()
+            digest.update(raw)
+            data = json.loads(raw)
+            tables[kind] = LoreTable(kind, data["version"], data["entries"])
+        return cls(tables, f'"{digest.hexdigest()[:32]}"')
+
+    @property
+    def version(self):
+        """各类资料版本号，用于缓存键"""
+        return {kind: table.version for kind, table in self.tables.items()}
+
+    def __getitem__(self, kind):
+        return self.tables[kind]
+
+    def as_dict(self):
+        return {kind: table.as_dict() for kind, table in self.tables.items()}
+
+
+# worker启动（导入本模块）时加载一次
+registry = LoreRegistry.load()
@@ -0,0 +1,29 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from aigm.jobs import PortraitWorkerPool
+
+
+class Command(BaseCommand):
+    help = "运行立绘生成worker，从数据库队列领取并执行 PortraitJob"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=settings.AIGM_PORTRAIT_WORKERS,
+            help="worker线程数")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+
+        pool = PortraitWorkerPool(options["workers"])
+        pool.start()
+        self.stdout.write(f"立绘worker已启动 ({options['workers']} 个线程)")
+
+        stop.wait()
+        self.stdout.write("正在等待进行中的任务完成...")
+        pool.stop()
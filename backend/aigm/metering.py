@@ -0,0 +1,198 @@
+"""
+上游AI调用的用量计量
+
+每次 OpenAI 调用（见 aigm/ai.py）都会产生一条 AIUsageRecord：模型、输入/输出/缓存token数、
+图像尺寸和质量、上游耗时、结果和估算费用。
+
+记录先写入进程内缓冲区，由后台线程按 AIGM_USAGE_FLUSH_SIZE 条或 AIGM_USAGE_FLUSH_INTERVAL 秒
+批量插入数据库，调用方（包括异步视图）不会因此访问数据库。进程退出时写入剩余记录。
+"""
+import atexit
+import threading
+from datetime import datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Avg, Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import AIUsageRecord
+
+# 缓冲区最多保留的批次数，数据库长时间不可用时丢弃最早的记录
+MAX_BUFFERED_BATCHES = 10
+
+# 统计接口支持的分组维度
+GROUP_FIELDS = {
+    "identity": "identity",
+    "endpoint": "endpoint",
+    "model": "model",
+    "day": "day",
+}
+
+_MILLION = Decimal(1000000)
+
+
+def estimate_cost(model, prompt_tokens=0, cached_tokens=0, completion_tokens=0,
+                  image_size="", image_quality="", image_count=0):
+    """按 settings.AIGM_MODEL_PRICES 估算一次调用的费用（美元），未配置价格的模型为0"""
+    prices = settings.AIGM_MODEL_PRICES.get(model)
+    if not prices:
+        return Decimal(0)
+
+    if image_count:
+        price = prices.get(f"{image_quality or 'standard'}:{image_size}", 0)
+        return Decimal(str(price)) * image_count
+
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    cost = (Decimal(str(prices.get("input", 0))) * uncached
+            + Decimal(str(prices.get("cached_input", prices.get("input", 0)))) * cached_tokens
+            + Decimal(str(prices.get("output", 0))) * completion_tokens) / _MILLION
+    return cost.quantize(Decimal("0.000001"))
+
+
+class UsageLedger:
+    """
+    用量记录的缓冲批量写入
+
+    参数:
+        batch_size: 缓冲区达到该条数时立即写入
+        flush_interval: 最长写入间隔（秒）
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or settings.AIGM_USAGE_FLUSH_SIZE
+        self.flush_interval = flush_interval or settings.AIGM_USAGE_FLUSH_INTERVAL
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stats = {"recorded": 0, "written": 0, "dropped": 0, "flush_errors": 0}
+
+    def record(self, identity, endpoint, model, prompt_tokens=0, completion_tokens=0,
+               cached_tokens=0, image_size="", image_quality="", image_count=0,
+               latency=0.0, outcome=AIUsageRecord.OUTCOME_OK):
+        """追加一条记录（不访问数据库）"""
+        entry = AIUsageRecord(
+            created_at=timezone.now(),
+            identity=(identity or "")[:128],
+            endpoint=endpoint[:32],
+            model=(model or "")[:32],
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            image_size=image_size or "",
+            image_quality=image_quality or "",
+            image_count=image_count,
+            latency_ms=int(latency * 1000),
+            outcome=outcome,
+            cost=estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens,
+                               image_size, image_quality, image_count),
+        )
+        self._ensure_thread()
+        with self._lock:
+            self._buffer.append(entry)
+            self._stats["recorded"] += 1
+            overflow = len(self._buffer) - self.batch_size * MAX_BUFFERED_BATCHES
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self._stats["dropped"] += overflow
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """把缓冲区中的记录写入数据库，返回写入条数（只能在同步上下文中调用）"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                AIUsageRecord.objects.bulk_create(batch, batch_size=self.batch_size)
+            except Exception as e:
+                print(f"AI用量记录写入失败: {str(e)}")
+                with self._lock:
+                    # 放回缓冲区，下次再试（超出上限的部分在 record 时丢弃）
+                    self._buffer[:0] = batch
+                    self._stats["flush_errors"] += 1
+                return 0
+            with self._lock:
+                self._stats["written"] += len(batch)
+            return len(batch)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._buffer)
+        return stats
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="aigm-usage-ledger", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"AI用量记录线程出错: {str(e)}")
+
+
+def parse_date(value):
+    """解析 YYYY-MM-DD，格式错误时抛出 ValueError"""
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def aggregate_usage(group_by, since, until, identity=None, endpoint=None):
+    """
+    按指定维度汇总用量
+
+    参数:
+        group_by: GROUP_FIELDS 中的维度列表
+        since / until: 日期范围（包含两端）
+        identity / endpoint: 可选的过滤条件
+    """
+    start = timezone.make_aware(datetime.combine(since, dt_time.min))
+    end = timezone.make_aware(datetime.combine(until + timedelta(days=1), dt_time.min))
+    records = AIUsageRecord.objects.filter(created_at__gte=start, created_at__lt=end)
+    if identity:
+        records = records.filter(identity=identity)
+    if endpoint:
+        records = records.filter(endpoint=endpoint)
+
+    if "day" in group_by:
+        records = records.annotate(day=TruncDate("created_at"))
+    rows = records.values(*[GROUP_FIELDS[field] for field in group_by]).annotate(
+        requests=Count("id"),
+        failures=Count("id", filter=~Q(outcome=AIUsageRecord.OUTCOME_OK)),
+        prompt_tokens=Sum("prompt_tokens"),
+        completion_tokens=Sum("completion_tokens"),
+        cached_tokens=Sum("cached_tokens"),
+        images=Sum("image_count"),
+        avg_latency_ms=Avg("latency_ms"),
+        cost=Sum("cost"),
+    ).order_by(*[f"-{field}" if field == "day" else field for field in group_by])
+
+    result = []
+    for row in rows:
+        if "day" in row:
+            row["day"] = row["day"].isoformat()
+        row["avg_latency_ms"] = int(row["avg_latency_ms"] or 0)
+        row["cost"] = float(row["cost"] or 0)
+        result.append(row)
+    return result
+
+
+usage_ledger = UsageLedger()
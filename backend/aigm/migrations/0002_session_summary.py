@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aigm', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamesession',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='gamesession',
+            name='summary_upto',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-17 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aigm', '0005_portrait_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIUsageRecord',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('identity', models.CharField(max_length=128)),
+                ('endpoint', models.CharField(max_length=32)),
+                ('model', models.CharField(max_length=32)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0)),
+                ('image_size', models.CharField(blank=True, default='', max_length=16)),
+                ('image_quality', models.CharField(blank=True, default='', max_length=16)),
+                ('image_count', models.PositiveSmallIntegerField(default=0)),
+                ('latency_ms', models.PositiveIntegerField(default=0)),
+                ('outcome', models.CharField(choices=[('ok', 'OK'), ('error', 'Error'), ('rejected', 'Rejected'), ('aborted', 'Aborted')], default='ok', max_length=10)),
+                ('cost', models.DecimalField(decimal_places=6, default=0, max_digits=12)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['identity', 'created_at'], name='ai_usage_identity_idx'), models.Index(fields=['endpoint', 'created_at'], name='ai_usage_endpoint_idx')],
+            },
+        ),
+    ]
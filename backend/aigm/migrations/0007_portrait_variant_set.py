@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-17 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aigm', '0006_ai_usage_record'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortraitVariantSet',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('identity', models.CharField(max_length=128)),
+                ('public_ids', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,184 @@
+import uuid
 from django.db import models
+from django.contrib.auth.models import User
+from django.utils import timezone
 
-# Create your models here.
+
+class GameSession(models.Model):
+    """AI GM 战役会话，在服务器端保存对话历史，客户端每次只需发送新消息"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='game_sessions', blank=True, null=True)
+    title = models.CharField(max_length=200, blank=True, default='')
+    # 已写入的消息数量，同时作为下一条消息的序号
+    message_count = models.IntegerField(default=0)
+    # 较早对话的滚动摘要，覆盖前 summary_upto 条消息
+    summary = models.TextField(blank=True, default='')
+    summary_upto = models.IntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.title or self.id} ({self.message_count} messages)"
+
+
+class SessionMessage(models.Model):
+    """会话中的一条消息，只追加不修改；role 直接使用 OpenAI 的角色名"""
+    ROLE_CHOICES = [
+        ('user', 'Player'),
+        ('assistant', 'GM'),
+    ]
+
+    session = models.ForeignKey(
+        GameSession, on_delete=models.CASCADE, related_name='messages')
+    seq = models.IntegerField()
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['session', 'seq'], name='unique_session_message_seq'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} #{self.seq} {self.role}"
+
+
+class GenerationCacheEntry(models.Model):
+    """AI 生成结果的持久化缓存（进程内LRU之后的数据库层）"""
+    key = models.CharField(max_length=64, primary_key=True)
+    kind = models.CharField(max_length=32, db_index=True)
+    value = models.JSONField()
+    hit_count = models.IntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.kind}:{self.key[:12]}"
+
+
+class InflightLock(models.Model):
+    """进行中的生成请求锁，用于在多个worker之间合并相同的请求"""
+    key = models.CharField(max_length=64, primary_key=True)
+    owner = models.CharField(max_length=128)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key[:12]} ({self.owner})"
+
+
+class PortraitJob(models.Model):
+    """立绘生成任务；数据库同时作为任务队列，由立绘worker领取执行"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='portrait_jobs', blank=True, null=True)
+    # 请求方标识（见 views.client_identity），用于权限检查和并发配额
+    identity = models.CharField(max_length=128)
+    # 相同请求的合并键，排队或执行中的相同任务直接复用
+    dedupe_key = models.CharField(max_length=64, db_index=True)
+    params = models.JSONField()
+
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    # 当前执行阶段：generating / downloading / uploading
+    stage = models.CharField(max_length=20, blank=True, default='')
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True, default='')
+    attempts = models.IntegerField(default=0)
+
+    # 领取任务的worker，以及租约到期时间（worker崩溃后任务可被重新领取）
+    worker = models.CharField(max_length=128, blank=True, default='')
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    # 在此时间之前不会被领取（被限流后延迟重试）
+    available_at = models.DateTimeField(default=timezone.now)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'],
+                         name='portrait_job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+
+class PortraitVariantSet(models.Model):
+    """一组等待玩家选择的候选立绘；过期未选择时整组图片被清理"""
+    id = models.CharField(max_length=32, primary_key=True)
+    # 请求方标识（见 views.client_identity），只有同一请求方可以选择
+    identity = models.CharField(max_length=128)
+    public_ids = models.JSONField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.id} ({len(self.public_ids)} variants)"
+
+
+class AIUsageRecord(models.Model):
+    """上游AI调用的用量记录（只追加），用于按用户、接口和日期统计耗时和费用"""
+    OUTCOME_OK = 'ok'
+    OUTCOME_ERROR = 'error'
+    OUTCOME_REJECTED = 'rejected'
+    OUTCOME_ABORTED = 'aborted'
+    OUTCOME_CHOICES = [
+        (OUTCOME_OK, 'OK'),
+        (OUTCOME_ERROR, 'Error'),
+        (OUTCOME_REJECTED, 'Rejected'),
+        (OUTCOME_ABORTED, 'Aborted'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    created_at = models.DateTimeField(db_index=True)
+    # 请求方标识（见 views.client_identity）
+    identity = models.CharField(max_length=128)
+    endpoint = models.CharField(max_length=32)
+    model = models.CharField(max_length=32)
+
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+    # 图像生成参数（文本调用时为空）
+    image_size = models.CharField(max_length=16, blank=True, default='')
+    image_quality = models.CharField(max_length=16, blank=True, default='')
+    image_count = models.PositiveSmallIntegerField(default=0)
+
+    latency_ms = models.PositiveIntegerField(default=0)
+    outcome = models.CharField(
+        max_length=10, choices=OUTCOME_CHOICES, default=OUTCOME_OK)
+    # 按 settings.AIGM_MODEL_PRICES 估算的费用（美元）
+    cost = models.DecimalField(max_digits=12, decimal_places=6, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['identity', 'created_at'],
+                         name='ai_usage_identity_idx'),
+            models.Index(fields=['endpoint', 'created_at'],
+                         name='ai_usage_endpoint_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.model} ({self.outcome})"
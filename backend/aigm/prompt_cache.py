@@ -0,0 +1,79 @@
+"""
+提示词缓存命中统计
+
+OpenAI 会缓存提示词的公共前缀（至少1024个token且逐字节相同），命中部分在 usage 中报告为
+prompt_tokens_details.cached_tokens，计费按折扣价并且首token延迟更低。
+提示词构建函数把静态内容放在最前面，但静态部分本身都不到1024个token：只有聊天接口在会话历史
+累积到足够长之后才会命中，角色背景等单轮接口预期命中率为0。
+本模块按接口统计每次调用报告的缓存token数和上游耗时，用于观察命中率以及命中/未命中时的延迟差异。
+"""
+import threading
+
+# 缓存命中的输入token相对原价节省的比例
+CACHED_INPUT_DISCOUNT = 0.5
+
+
+def cached_tokens(usage):
+    """从 usage 中取出命中缓存的token数（没有报告时为0）"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class PromptCacheStats:
+    """按接口累计的提示词缓存统计（当前worker进程）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, usage, latency):
+        """
+        记录一次调用
+
+        参数:
+            endpoint: 接口名称，例如 "chat"
+            usage: OpenAI 返回的 usage（为None时不记录）
+            latency: 上游调用耗时（秒）
+        """
+        if usage is None:
+            return
+        cached = cached_tokens(usage)
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "hit_requests": 0,
+                "hit_latency": 0.0,
+                "miss_latency": 0.0,
+            })
+            entry["requests"] += 1
+            entry["prompt_tokens"] += usage.prompt_tokens or 0
+            entry["cached_tokens"] += cached
+            if cached:
+                entry["hit_requests"] += 1
+                entry["hit_latency"] += latency
+            else:
+                entry["miss_latency"] += latency
+
+    def stats(self):
+        with self._lock:
+            endpoints = {name: dict(entry) for name, entry in self._endpoints.items()}
+
+        result = {}
+        for name, entry in endpoints.items():
+            misses = entry["requests"] - entry["hit_requests"]
+            result[name] = {
+                "requests": entry["requests"],
+                "prompt_tokens": entry["prompt_tokens"],
+                "cached_tokens": entry["cached_tokens"],
+                "cached_token_ratio": round(
+                    entry["cached_tokens"] / entry["prompt_tokens"], 4) if entry["prompt_tokens"] else 0.0,
+                "hit_request_ratio": round(entry["hit_requests"] / entry["requests"], 4),
+                "avg_latency_hit": round(
+                    entry["hit_latency"] / entry["hit_requests"], 3) if entry["hit_requests"] else None,
+                "avg_latency_miss": round(entry["miss_latency"] / misses, 3) if misses else None,
+                # 按折扣价折算，相当于少付了多少个输入token
+                "saved_input_tokens": int(entry["cached_tokens"] * CACHED_INPUT_DISCOUNT),
+            }
+        return result
@@ -0,0 +1,7 @@
+import json
+
+
+def format_sse(event, data):
+    """将一个事件编码为Server-Sent Events格式的字节串"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
@@ -0,0 +1,100 @@
+"""
+AI GM 规则问答的本地检索
+
+玩家消息是规则问题时，从规则书全文索引（rules.search）中检索得分最高的几页，
+只把命中位置附近的简短摘录连同书名页码放进提示词，并要求模型依据摘录简短作答、注明出处。
+这样模型不必凭记忆长篇解释规则，回复更短，也更准确。索引尚未建立时跳过检索。
+
+玩家的剧情行动经常也是问句（"Can I sneak past the guards?"、"我能不能打开这扇门"），
+因此只有两种消息会触发检索：
+    - 明确询问规则的说法（"rules"、"how does ... work"、"规则"、"怎么算" 等）
+    - 以问句形式提到具体的规则术语（"Does grappling provoke an opportunity attack?"）
+摘录的得分还必须同时达到绝对下限和最高分的一定比例，避免只沾边的页面被注入。
+"""
+import re
+
+from django.conf import settings
+
+from rules.search import IndexNotBuilt, rulebook_index
+
+# 明确询问规则的说法（中英文）
+EXPLICIT_RULES_RE = re.compile(
+    r"\brules?\b|\brules as written\b|\bRAW\b|\bmechanics?\b|\bhow (?:does|do) .{1,40}\bwork\b"
+    r"|\bis it (?:legal|allowed) to\b|\bwhat(?:'s| is) the (?:dc|modifier|range|duration)\b"
+    r"|规则|怎么算|如何计算|怎样计算|怎么判定|如何判定|机制",
+    re.IGNORECASE)
+
+# 具体的规则术语；只有出现在问句中时才算规则问题（"我们先短休一下再走" 是剧情行动）
+RULES_TERM_RE = re.compile(
+    r"\bspell slots?\b|\bcantrips?\b|\bsaving throws?\b|\bsave dc\b|\b(?:dis)?advantage\b"
+    r"|\bopportunity attacks?\b|\bbonus actions?\b|\breactions?\b|\bconcentration\b|\bproficiency\b"
+    r"|\barmou?r class\b|\bhit (?:points|dice)\b|\binitiative\b|\bgrappl\w*|\bexhaustion\b"
+    r"|\bmulticlass\w*|\blevel(?:ing)? up\b|\b(?:short|long) rest\b|\bstat block\b|\bchallenge rating\b"
+    r"|法术位|戏法|豁免|优势骰|劣势骰|(?:具有|获得)(?:优势|劣势)|借机攻击|附赠动作|反应动作|专注检定"
+    r"|熟练加值|护甲等级|生命骰|先攻|擒抱|力竭|兼职|短休|长休|怪物数据|挑战等级",
+    re.IGNORECASE)
+
+QUESTION_RE = re.compile(
+    r"[?？]|^\s*(?:how|what|when|which|why|does|do|is|are|can|could)\b|吗|么|多少|如何|怎么|怎样|是否|什么",
+    re.IGNORECASE)
+
+RULES_REFERENCE_HEADER = """Rulebook excerpts relevant to the player's question (retrieved from the local rulebooks).
+Answer the rules question from these excerpts, briefly, and cite the source as (Book p.N).
+If the excerpts do not cover the question, say so instead of guessing, then continue the game."""
+
+
+def is_explicit_rules_question(text):
+    """玩家消息是否明确在问规则（这时GM只需依据摘录简短作答）"""
+    return bool(EXPLICIT_RULES_RE.search(text or ""))
+
+
+def is_rules_question(text):
+    """判断玩家消息是否是规则问题：明确询问规则，或以问句形式提到规则术语"""
+    text = text or ""
+    if is_explicit_rules_question(text):
+        return True
+    return bool(RULES_TERM_RE.search(text) and QUESTION_RE.search(text))
+
+
+def retrieve_rule_passages(text):
+    """
+    检索与玩家消息相关的规则书摘录
+
+    返回 [{"book", "title", "page", "score", "snippet"}]，不是规则问题、未启用或索引未建立时返回空列表
+    """
+    if not settings.AIGM_RULES_RETRIEVAL or not is_rules_question(text):
+        return []
+    try:
+        results = rulebook_index.search(
+            text, limit=settings.AIGM_RULES_PASSAGES, snippet_chars=settings.AIGM_RULES_EXCERPT_CHARS)
+    except IndexNotBuilt:
+        return []
+    except Exception as e:
+        print(f"规则书检索出错: {str(e)}")
+        return []
+    if not results:
+        return []
+    # BM25 得分没有固定的尺度，除绝对下限外还要求接近最高分
+    threshold = max(settings.AIGM_RULES_MIN_SCORE,
+                    results[0]["score"] * settings.AIGM_RULES_RELATIVE_SCORE)
+    return [result for result in results if result["score"] >= threshold]
+
+
+def format_rule_passages(passages):
+    """把摘录整理为提示词中的参考资料"""
+    excerpts = "\n\n".join(
+        f"[{passage['title']} p.{passage['page']}]\n{passage['snippet']}" for passage in passages)
+    return f"{RULES_REFERENCE_HEADER}\n\n{excerpts}"
+
+
+def cited_pages(passages):
+    """返回给客户端的引用信息"""
+    return [
+        {
+            "book": passage["book"],
+            "title": passage["title"],
+            "page": passage["page"],
+            "url": f"/api/rules/pdf/{passage['book']}#page={passage['page']}",
+        }
+        for passage in passages
+    ]
@@ -0,0 +1,11 @@
+from rest_framework import serializers
+from .models import GameSession
+
+
+class GameSessionSerializer(serializers.ModelSerializer):
+    """战役会话序列化器（不包含消息内容）"""
+
+    class Meta:
+        model = GameSession
+        fields = ['id', 'title', 'message_count', 'created_at', 'updated_at']
+        read_only_fields = fields
@@ -0,0 +1,85 @@
+"""
+服务器端战役会话的读写辅助函数
+
+消息按会话内序号(seq)只追加存储；每一轮对话（玩家消息 + GM回复）在一个事务内批量写入，
+读取时直接得到 OpenAI 格式的消息列表，无需再做角色映射。
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import GameSession, SessionMessage
+
+
+class SessionNotFound(Exception):
+    """会话不存在或不属于当前用户"""
+
+
+def client_role(role):
+    """把存储的 OpenAI 角色名转换为前端使用的角色名"""
+    return "gm" if role == "assistant" else "user"
+
+
+def convert_client_history(conversation_history):
+    """把前端格式的历史记录 ({role, text}) 转换为 OpenAI 消息格式"""
+    messages = []
+    for msg in conversation_history:
+        role = "assistant" if msg["role"] == "gm" else "user"
+        messages.append({"role": role, "content": msg["text"]})
+    return messages
+
+
+def get_session(session_id, user=None):
+    """
+    获取会话；绑定了用户的会话只允许该用户访问
+
+    参数:
+        session_id: 会话ID (UUID)
+        user: 当前请求的用户，匿名时为None
+    """
+    try:
+        session = GameSession.objects.get(pk=session_id)
+    except (GameSession.DoesNotExist, ValidationError, ValueError):
+        # 非法的UUID字符串会抛出ValidationError
+        raise SessionNotFound(session_id)
+
+    if session.user_id is not None and (user is None or session.user_id != user.pk):
+        raise SessionNotFound(session_id)
+    return session
+
+
+def load_session_messages(session, start=0):
+    """按顺序读取会话中序号不小于 start 的消息，返回 OpenAI 消息格式列表"""
+    rows = SessionMessage.objects.filter(
+        session=session, seq__gte=start).order_by('seq').values_list('role', 'content')
+    return [{"role": role, "content": content} for role, content in rows]
+
+
+def append_session_messages(session, messages):
+    """
+    在一个事务内批量追加消息
+
+    参数:
+        session: GameSession 实例
+        messages: OpenAI 格式的消息列表 [{"role": ..., "content": ...}]
+    """
+    if not messages:
+        return []
+
+    with transaction.atomic():
+        # 锁定会话行以分配连续的序号
+        locked = GameSession.objects.select_for_update().only(
+            'message_count').get(pk=session.pk)
+        start = locked.message_count
+        rows = [
+            SessionMessage(session_id=session.pk, seq=start + offset,
+                           role=msg["role"], content=msg["content"])
+            for offset, msg in enumerate(messages)
+        ]
+        SessionMessage.objects.bulk_create(rows)
+        GameSession.objects.filter(pk=session.pk).update(
+            message_count=F('message_count') + len(rows), updated_at=timezone.now())
+
+    session.message_count = start + len(rows)
+    return rows
@@ -0,0 +1,252 @@
+"""
+相同生成请求的合并 (single-flight)
+
+同一用户对同一规范化输入的并发请求只调用一次上游接口，所有等待者得到同一个结果：
+    - worker内部：第一个请求执行，其余线程/协程等待它的结果
+    - worker之间：通过数据库锁表 (InflightLock) 选出执行者，其他worker轮询结果；
+      结果以较短的有效期写入 GenerationCacheEntry，供其他worker读取
+
+执行者失败时，其他worker会在锁释放后自行重试；锁在 lock_ttl 后过期，避免进程崩溃后永久占用。
+"""
+import asyncio
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import GenerationCacheEntry, InflightLock
+
+RESULT_KIND = "singleflight"
+
+
+class _Call:
+    """worker内部一次进行中的调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.aborted = False
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用
+
+    参数:
+        kind: 类别名称，用于统计
+        lock_ttl: 跨worker锁的最长持有时间（秒），应大于一次生成的最长耗时
+        result_ttl: 结果对其他worker可见的时间（秒）
+        poll_interval: 其他worker轮询结果的间隔（秒）
+    """
+
+    def __init__(self, kind, lock_ttl, result_ttl, poll_interval=0.5):
+        self.kind = kind
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "upstream_calls": 0,
+            "coalesced_local": 0,
+            "coalesced_remote": 0,
+            "lock_errors": 0,
+        }
+
+    def do(self, key, fn):
+        """
+        执行 fn() 或等待相同键的进行中调用
+
+        返回:
+            (result, shared): shared 为True表示结果来自其他请求的调用
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+
+            if leader:
+                break
+            call.event.wait()
+            if call.aborted:
+                # 执行者被中断（未得到结果也没有异常），由本请求重新竞争执行
+                continue
+            self._incr("coalesced_local")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._run_across_workers(key, fn)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.aborted = True
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def ado(self, key, coro_fn):
+        """do() 的异步版本，coro_fn 为返回协程的函数"""
+        loop = asyncio.get_running_loop()
+        local_key = (id(loop), key)
+        while True:
+            with self._lock:
+                future = self._async_calls.get(local_key)
+                leader = future is None
+                if leader:
+                    future = loop.create_future()
+                    self._async_calls[local_key] = future
+
+            if leader:
+                break
+            # asyncio.wait 不会因执行者被取消而抛出 CancelledError，只有本请求被取消时才会
+            await asyncio.wait([future])
+            if future.cancelled():
+                # 执行者的请求被取消（例如客户端断开），由本请求重新竞争执行
+                continue
+            self._incr("coalesced_local")
+            return future.result(), True
+
+        try:
+            result, shared = await self._arun_across_workers(key, coro_fn)
+            future.set_result(result)
+            return result, shared
+        except Exception as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        except BaseException:
+            # 包括 CancelledError：取消共享的 future，等待者重新竞争执行而不是永久挂起
+            future.cancel()
+            raise
+        finally:
+            with self._lock:
+                self._async_calls.pop(local_key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls) + len(self._async_calls)
+        return stats
+
+    def _run_across_workers(self, key, fn):
+        owner = _new_owner_id()
+        while True:
+            if self._try_lock(key, owner):
+                try:
+                    self._incr("upstream_calls")
+                    result = fn()
+                    self._publish(key, result)
+                    return result, False
+                finally:
+                    self._unlock(key, owner)
+
+            # 其他worker正在执行，等待它的结果
+            while True:
+                time.sleep(self.poll_interval)
+                result, running = self._poll(key)
+                if result is not None:
+                    self._incr("coalesced_remote")
+                    return result, True
+                if not running:
+                    break
+
+    async def _arun_across_workers(self, key, coro_fn):
+        owner = _new_owner_id()
+        while True:
+            if await sync_to_async(self._try_lock, thread_sensitive=False)(key, owner):
+                try:
+                    self._incr("upstream_calls")
+                    result = await coro_fn()
+                    await sync_to_async(self._publish, thread_sensitive=False)(key, result)
+                    return result, False
+                finally:
+                    await sync_to_async(self._unlock, thread_sensitive=False)(key, owner)
+
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                result, running = await sync_to_async(self._poll, thread_sensitive=False)(key)
+                if result is not None:
+                    self._incr("coalesced_remote")
+                    return result, True
+                if not running:
+                    break
+
+    def _try_lock(self, key, owner):
+        """尝试获取跨worker锁；锁表不可用时直接放行（退化为仅worker内合并）"""
+        now = timezone.now()
+        try:
+            InflightLock.objects.filter(key=key, expires_at__lte=now).delete()
+            with transaction.atomic():
+                InflightLock.objects.create(
+                    key=key, owner=owner, expires_at=now + timedelta(seconds=self.lock_ttl))
+            # 清除上一次调用留下的结果，避免等待者读到旧结果
+            GenerationCacheEntry.objects.filter(key=key, kind=RESULT_KIND).delete()
+            return True
+        except IntegrityError:
+            return False
+        except Exception as e:
+            print(f"请求合并锁错误: {str(e)}")
+            self._incr("lock_errors")
+            return True
+
+    def _unlock(self, key, owner):
+        try:
+            InflightLock.objects.filter(key=key, owner=owner).delete()
+        except Exception as e:
+            print(f"请求合并解锁错误: {str(e)}")
+            self._incr("lock_errors")
+
+    def _publish(self, key, result):
+        """把结果短暂地写入数据库，供正在等待的其他worker读取"""
+        now = timezone.now()
+        try:
+            GenerationCacheEntry.objects.filter(
+                kind=RESULT_KIND, expires_at__lte=now).delete()
+            GenerationCacheEntry.objects.update_or_create(
+                key=key,
+                defaults={
+                    "kind": RESULT_KIND,
+                    "value": result,
+                    "expires_at": now + timedelta(seconds=self.result_ttl),
+                },
+            )
+        except Exception as e:
+            print(f"请求合并结果写入错误: {str(e)}")
+            self._incr("lock_errors")
+
+    def _poll(self, key):
+        """返回 (结果, 锁是否仍被持有)"""
+        now = timezone.now()
+        entry = GenerationCacheEntry.objects.filter(
+            key=key, kind=RESULT_KIND, expires_at__gt=now).first()
+        if entry is not None:
+            return entry.value, False
+        running = InflightLock.objects.filter(key=key, expires_at__gt=now).exists()
+        return None, running
+
+    def _incr(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+def _new_owner_id():
+    """每次加锁使用唯一的持有者标识（异步调用中加锁和解锁可能在不同线程）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
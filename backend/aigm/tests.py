@@ -1,3 +1,875 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from . import transport
+from .async_views import background_spec, background_spec_key
+from .cache import GenerationCache
+from .context import ContextWindow, count_message_tokens
+from .governor import Governor, GovernorRejected
+from .jobs import claim_job, run_job, submit_job
+from .lore import LoreTable, registry as lore_registry
+from .models import GameSession, GenerationCacheEntry, InflightLock, PortraitJob, PortraitVariantSet
+from .retrieval import is_explicit_rules_question, is_rules_question, retrieve_rule_passages
+from .sessions import append_session_messages, load_session_messages
+from .singleflight import SingleFlight
+from .views import (
+    background_cache,
+    background_cache_key,
+    chat_completion_options,
+    client_identity,
+    portrait_folder,
+    prune_variant_sets,
+    save_variant_set,
+)
+
+
+def fake_completion(content):
+    """返回只带 choices[0].message.content 的假响应"""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def make_history(turns, text="The party walks down the corridor and looks around carefully."):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"{i}: {text}"})
+        history.append({"role": "assistant", "content": f"{i}: {text}"})
+    return history
+
+
+# 使用近似估算计数，不依赖 tiktoken 编码文件
+@mock.patch("aigm.context._encoding", False)
+class ContextWindowTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_short_history_is_sent_unchanged(self, completion):
+        window = ContextWindow(token_budget=2000, max_turns=10, summary_model="test")
+        history = make_history(2)
+
+        messages, info = window.build("system", history, "hello")
+
+        self.assertEqual(messages, [{"role": "system", "content": "system"}, *history,
+                                    {"role": "user", "content": "hello"}])
+        self.assertEqual(info["summarized_messages"], 0)
+        self.assertEqual(info["prompt_tokens"], count_message_tokens(messages))
+        completion.assert_not_called()
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_folds_old_turns_into_summary(self, completion):
+        completion.return_value = fake_completion("the story so far")
+        window = ContextWindow(token_budget=2000, max_turns=4, summary_model="test")
+        history = make_history(6)
+
+        messages, info = window.build("system", history, "hello", identity="user:1")
+
+        completion.assert_called_once()
+        self.assertEqual(completion.call_args.args[0], "user:1")
+        self.assertEqual(messages[1]["role"], "system")
+        self.assertIn("the story so far", messages[1]["content"])
+        # 折叠到最多轮数的一半
+        self.assertEqual(info["history_messages"], 4)
+        self.assertEqual(info["summarized_messages"], len(history) - 4)
+        self.assertEqual(messages[2:-1], history[-4:])
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_summary_is_reused_until_window_slides_again(self, completion):
+        completion.return_value = fake_completion("the story so far")
+        window = ContextWindow(token_budget=2000, max_turns=4, summary_model="test")
+        history = make_history(6)
+        window.build("system", history, "hello")
+
+        # 下一轮历史多了一轮对话，仍在窗口内，不再生成摘要
+        history += make_history(1, text="next")
+        messages, info = window.build("system", history, "hello")
+
+        completion.assert_called_once()
+        self.assertIn("the story so far", messages[1]["content"])
+        self.assertEqual(info["summarized_messages"], 8)
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_session_summary_is_persisted(self, completion):
+        completion.return_value = fake_completion("saved summary")
+        window = ContextWindow(token_budget=2000, max_turns=4, summary_model="test")
+        session = GameSession.objects.create(title="test")
+        history = make_history(6)
+
+        window.build("system", history, "hello", session=session)
+
+        session.refresh_from_db()
+        self.assertEqual(session.summary, "saved summary")
+        self.assertEqual(session.summary_upto, len(history) - 4)
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_token_budget_triggers_folding(self, completion):
+        completion.return_value = fake_completion("short")
+        window = ContextWindow(token_budget=700, max_turns=50, summary_model="test")
+        history = make_history(10, text="word " * 40)
+
+        messages, info = window.build("system", history, "hello")
+
+        completion.assert_called_once()
+        self.assertLessEqual(info["prompt_tokens"], 700)
+        self.assertEqual(messages[-1], {"role": "user", "content": "hello"})
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_failed_summary_drops_old_turns(self, completion):
+        completion.side_effect = RuntimeError("upstream down")
+        window = ContextWindow(token_budget=2000, max_turns=4, summary_model="test")
+        history = make_history(6)
+
+        messages, info = window.build("system", history, "hello")
+
+        self.assertEqual(len(messages), 1 + 4 + 1)
+        self.assertEqual(info["summarized_messages"], len(history) - 4)
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_references_are_sent_before_player_input(self, completion):
+        window = ContextWindow(token_budget=2000, max_turns=10, summary_model="test")
+        history = make_history(1)
+
+        messages, _ = window.build("system", history, "hello", references="PHB p.12")
+
+        self.assertEqual(messages[-2], {"role": "system", "content": "PHB p.12"})
+        self.assertEqual(messages[1:-2], history)
+
+    @mock.patch("aigm.context.create_chat_completion")
+    def test_session_loads_only_unsummarized_messages(self, completion):
+        completion.return_value = fake_completion("second summary")
+        window = ContextWindow(token_budget=2000, max_turns=4, summary_model="test")
+        session = GameSession.objects.create(title="test", summary="first summary", summary_upto=4)
+        append_session_messages(session, make_history(8))
+
+        history = load_session_messages(session, start=session.summary_upto)
+        self.assertEqual(len(history), 12)
+
+        messages, info = window.build(
+            "system", history, "hello", session=session, history_offset=session.summary_upto)
+
+        session.refresh_from_db()
+        self.assertEqual(session.summary_upto, 16 - 4)
+        self.assertEqual(info["summarized_messages"], 16 - 4)
+        self.assertIn("5: ", completion.call_args.kwargs["messages"][1]["content"])
+        self.assertNotIn("1: ", completion.call_args.kwargs["messages"][1]["content"])
+        self.assertEqual(messages[2:-1], history[-4:])
+
+
+class GenerationCacheTests(TestCase):
+    def setUp(self):
+        background_cache._lru.clear()
+
+    def test_normalized_inputs_share_a_key(self):
+        key = background_cache_key("Aria", "Elf", "Wizard", "Sage", "Neutral Good",
+                                   ["brave", "curious"], "balanced", "english")
+
+        self.assertEqual(key, background_cache_key(
+            "  Aria ", "ELF", "wizard ", "sage", "neutral  good",
+            ["Curious", " brave", ""], "Balanced", "English"))
+        # 姓名区分大小写，会原样出现在故事中
+        self.assertNotEqual(key, background_cache_key(
+            "aria", "Elf", "Wizard", "Sage", "Neutral Good", ["brave", "curious"], "balanced", "english"))
+
+    def test_lru_miss_falls_through_to_database(self):
+        GenerationCache("test", ttl=60, lru_size=1, max_entries=10).set("key1", {"value": 1})
+        other_worker = GenerationCache("test", ttl=60, lru_size=1, max_entries=10)
+
+        self.assertEqual(other_worker.get("key1"), {"value": 1})
+        self.assertEqual(other_worker.get("key1"), {"value": 1})
+
+        stats = other_worker.stats()
+        self.assertEqual((stats["db_hits"], stats["lru_hits"]), (1, 1))
+        self.assertEqual(GenerationCacheEntry.objects.get(key="key1").hit_count, 1)
+
+    def test_lru_eviction_keeps_database_entry(self):
+        cache_ = GenerationCache("test", ttl=60, lru_size=1, max_entries=10)
+        cache_.set("key1", {"value": 1})
+        cache_.set("key2", {"value": 2})
+        self.assertEqual(cache_.stats()["lru_evictions"], 1)
+
+        self.assertEqual(cache_.get("key1"), {"value": 1})
+        self.assertEqual(cache_.stats()["db_hits"], 1)
+
+    def test_entries_expire_after_ttl(self):
+        cache_ = GenerationCache("test", ttl=60, lru_size=10, max_entries=10)
+        cache_.set("key1", {"value": 1})
+        later = timezone.now() + timedelta(seconds=61)
+
+        with mock.patch("aigm.cache.time.time", return_value=time.time() + 61), \
+                mock.patch("aigm.cache.timezone.now", return_value=later):
+            self.assertIsNone(cache_.get("key1"))
+        self.assertEqual(cache_.stats()["misses"], 1)
+
+    @mock.patch("aigm.views.create_chat_completion")
+    def test_force_regenerate_bypasses_cache(self, completion):
+        completion.return_value = fake_completion("fresh story")
+        data = {"name": "Aria", "race": "Elf", "class": "Wizard"}
+        key = background_cache_key("Aria", "Elf", "Wizard", "", "", [], "balanced", "chinese")
+        background_cache.set(key, {"background": "cached story"})
+
+        cached = self.client.post("/api/aigm/character-background/", data,
+                                  content_type="application/json")
+        forced = self.client.post("/api/aigm/character-background/",
+                                  dict(data, force_regenerate=True), content_type="application/json")
+
+        self.assertEqual((cached.json()["background"], cached.json()["cached"]), ("cached story", True))
+        self.assertEqual((forced.json()["background"], forced.json()["cached"]), ("fresh story", False))
+        completion.assert_called_once()
+        # 重新生成的结果覆盖旧缓存
+        self.assertEqual(background_cache.get(key), {"background": "fresh story"})
+
+
+def local_only(flight):
+    """跳过跨worker锁表，只测试worker内部的合并"""
+    async def arun(key, coro_fn):
+        return await coro_fn(), False
+    flight._run_across_workers = lambda key, fn: (fn(), False)
+    flight._arun_across_workers = arun
+    return flight
+
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "result"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do("key", fn)))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(flight.do("key", fn)))
+                   for _ in range(3)]
+        for thread in waiters:
+            thread.start()
+        # 等待者都进入等待后再让执行者返回
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *waiters]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("result", False)] + [("result", True)] * 3)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_leader_error_is_raised(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+
+        with self.assertRaises(ValueError):
+            flight.do("key", lambda: (_ for _ in ()).throw(ValueError("boom")))
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    async def test_async_calls_share_one_result(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+        calls = []
+
+        async def coro_fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        results = await asyncio.gather(*[flight.ado("key", coro_fn) for _ in range(4)])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("result", False)] + [("result", True)] * 3)
+
+    async def test_async_leader_error_is_raised_to_waiters(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+
+        async def coro_fn():
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            *[flight.ado("key", coro_fn) for _ in range(3)], return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    async def test_cancelled_leader_hands_over_to_waiter(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+        calls = []
+
+        async def coro_fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+
+        leader = asyncio.ensure_future(flight.ado("key", coro_fn))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(flight.ado("key", coro_fn))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+
+        # 等待者不会挂起，而是自己重新执行
+        self.assertEqual(await asyncio.wait_for(waiter, 2), ("result", False))
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    async def test_cancelled_waiter_does_not_affect_leader(self):
+        flight = local_only(SingleFlight("test", lock_ttl=10, result_ttl=10))
+
+        async def coro_fn():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        leader = asyncio.ensure_future(flight.ado("key", coro_fn))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(flight.ado("key", coro_fn))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+
+        self.assertEqual(await leader, ("result", False))
+        self.assertTrue(waiter.cancelled())
+
+
+class InflightLockTests(TestCase):
+    def setUp(self):
+        self.flight = SingleFlight("test", lock_ttl=10, result_ttl=10)
+
+    def test_only_one_owner_holds_the_lock(self):
+        self.assertTrue(self.flight._try_lock("key", "worker-a"))
+        self.assertFalse(self.flight._try_lock("key", "worker-b"))
+        self.assertEqual(InflightLock.objects.get(key="key").owner, "worker-a")
+
+        # 只有持有者可以解锁
+        self.flight._unlock("key", "worker-b")
+        self.assertTrue(InflightLock.objects.filter(key="key").exists())
+        self.flight._unlock("key", "worker-a")
+        self.assertTrue(self.flight._try_lock("key", "worker-b"))
+
+    def test_expired_lock_is_taken_over(self):
+        InflightLock.objects.create(
+            key="key", owner="crashed", expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertTrue(self.flight._try_lock("key", "worker-a"))
+        self.assertEqual(InflightLock.objects.get(key="key").owner, "worker-a")
+
+    def test_waiting_worker_reads_published_result(self):
+        self.flight._try_lock("key", "worker-a")
+        self.assertEqual(self.flight._poll("key"), (None, True))
+
+        self.flight._publish("key", {"story": "done"})
+        self.flight._unlock("key", "worker-a")
+        self.assertEqual(self.flight._poll("key"), ({"story": "done"}, False))
+
+    def test_new_lock_clears_previous_result(self):
+        self.flight._publish("key", "old")
+
+        self.flight._try_lock("key", "worker-a")
+        self.assertEqual(self.flight._poll("key"), (None, True))
+
+    def test_do_coalesces_with_result_of_other_worker(self):
+        flight = SingleFlight("test", lock_ttl=10, result_ttl=10, poll_interval=0.01)
+        InflightLock.objects.create(
+            key="key", owner="other", expires_at=timezone.now() + timedelta(seconds=10))
+        flight._publish("key", "from other worker")
+
+        result = flight.do("key", lambda: self.fail("should not run"))
+
+        self.assertEqual(result, ("from other worker", True))
+        self.assertEqual(flight.stats()["coalesced_remote"], 1)
+
+
+class TransportTests(TestCase):
+    def test_sync_client_is_shared(self):
+        client = transport.get_http_client("images")
+
+        self.assertIs(transport.get_http_client("images"), client)
+        _, read_timeout = transport.pool_config("images")
+        self.assertEqual(client.timeout.read, read_timeout)
+        self.assertEqual(client.timeout.connect, settings.AIGM_HTTP_CONNECT_TIMEOUT)
+
+    def test_async_clients_are_per_event_loop(self):
+        async def get_clients():
+            return transport.get_async_http_client("images"), transport.get_async_http_client("images")
+
+        first, same = asyncio.run(get_clients())
+        second, _ = asyncio.run(get_clients())
+
+        self.assertIs(first, same)
+        self.assertIsNot(first, second)
+
+    def test_requests_and_server_errors_are_counted(self):
+        client = httpx.Client(
+            event_hooks=transport._event_hooks("test"),
+            transport=httpx.MockTransport(
+                lambda request: httpx.Response(503 if request.url.path == "/fail" else 200)))
+        before = dict(transport._counters.get("test", {"requests": 0, "errors": 0}))
+
+        client.get("http://upstream.test/ok")
+        client.get("http://upstream.test/fail")
+
+        counters = transport._counters["test"]
+        self.assertEqual(counters["requests"] - before["requests"], 2)
+        self.assertEqual(counters["errors"] - before["errors"], 1)
+
+    def test_pool_stats_lists_configured_pools(self):
+        transport.get_http_client("openai")
+
+        stats = transport.pool_stats()
+
+        for name in settings.AIGM_HTTP_POOLS:
+            self.assertEqual(stats[name]["max_connections"], transport.pool_config(name)[0])
+        self.assertIn("connections", stats["openai"])
+
+
+def make_governor(**options):
+    defaults = dict(max_concurrent=1, max_queue=10, max_wait=2, user_rate=100, user_burst=100)
+    return Governor(**dict(defaults, **options))
+
+
+class GovernorTests(TestCase):
+    def test_rate_limit_rejects_after_burst(self):
+        governor = make_governor(max_concurrent=10, user_rate=0.5, user_burst=2)
+        for _ in range(2):
+            governor.release(governor.acquire("user:1"))
+
+        with self.assertRaises(GovernorRejected) as rejected:
+            governor.acquire("user:1")
+        self.assertEqual(rejected.exception.reason, "rate_limited")
+        self.assertEqual(rejected.exception.retry_after, 2)
+        # 其他用户有自己的令牌桶
+        governor.release(governor.acquire("user:2"))
+        self.assertEqual(governor.stats()["rejected_rate_limit"], 1)
+
+    def test_tokens_refill_over_time(self):
+        governor = make_governor(max_concurrent=10, user_rate=1, user_burst=1)
+        with mock.patch("aigm.governor.time.monotonic", return_value=100.0):
+            governor.release(governor.acquire("user:1"))
+            with self.assertRaises(GovernorRejected):
+                governor.acquire("user:1")
+        with mock.patch("aigm.governor.time.monotonic", return_value=101.0):
+            governor.release(governor.acquire("user:1"))
+
+    def test_queue_full_refunds_token(self):
+        governor = make_governor(max_queue=0, user_burst=1, user_rate=0.001)
+        started_at = governor.acquire("user:1")
+
+        with self.assertRaises(GovernorRejected) as rejected:
+            governor.acquire("user:2")
+        self.assertEqual(rejected.exception.reason, "queue_full")
+        governor.release(started_at)
+        # 被拒绝的请求没有消耗 user:2 的令牌
+        governor.release(governor.acquire("user:2"))
+
+    def test_queue_timeout(self):
+        governor = make_governor(max_wait=0.05)
+        governor.acquire("user:1")
+
+        with self.assertRaises(GovernorRejected) as rejected:
+            governor.acquire("user:2")
+        self.assertEqual(rejected.exception.reason, "queue_timeout")
+        stats = governor.stats()
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["rejected_timeout"], 1)
+
+    def test_slots_are_shared_round_robin_between_users(self):
+        governor = make_governor()
+        order = []
+
+        async def run():
+            started_at = await governor.aacquire("holder")
+
+            async def request(identity):
+                async with governor.aslot(identity):
+                    order.append(identity)
+
+            # user:1 先排了三个请求，user:2 后到的请求不应排在它们全部之后
+            tasks = []
+            for identity in ["user:1", "user:1", "user:1", "user:2"]:
+                tasks.append(asyncio.ensure_future(request(identity)))
+                await asyncio.sleep(0)
+            self.assertEqual(governor.stats()["queued"], 4)
+            governor.release(started_at)
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        self.assertEqual(order, ["user:1", "user:2", "user:1", "user:1"])
+        self.assertEqual(governor.stats()["active"], 0)
+
+    def test_sync_waiter_gets_released_slot(self):
+        governor = make_governor()
+        started_at = governor.acquire("user:1")
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(governor.acquire("user:2")))
+        thread.start()
+        time.sleep(0.05)
+
+        governor.release(started_at)
+        thread.join(2)
+
+        self.assertEqual(len(acquired), 1)
+        stats = governor.stats()
+        self.assertEqual(stats["active"], 1)
+        self.assertEqual(stats["granted_after_wait"], 1)
+
+    def test_cancelled_waiter_leaves_queue(self):
+        governor = make_governor()
+
+        async def run():
+            started_at = await governor.aacquire("user:1")
+            waiter = asyncio.ensure_future(governor.aacquire("user:2"))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertEqual(governor.stats()["queued"], 0)
+            governor.release(started_at)
+
+        asyncio.run(run())
+        self.assertEqual(governor.stats()["active"], 0)
+
+    def test_reserve_is_all_or_nothing(self):
+        governor = make_governor(max_concurrent=10, user_rate=0.001, user_burst=3)
+        governor.release(governor.acquire("user:1"))
+
+        with self.assertRaises(GovernorRejected) as rejected:
+            governor.reserve("user:1", 3)
+        self.assertEqual(rejected.exception.reason, "rate_limited")
+        # 被拒绝的预留没有扣除令牌
+        governor.reserve("user:1", 2)
+
+    def test_reserved_tokens_are_used_then_refunded(self):
+        governor = make_governor(max_concurrent=10, user_rate=0.001, user_burst=3)
+        reservation = governor.reserve("user:1", 2)
+
+        with reservation.use():
+            governor.release(governor.acquire("user:1"))
+        self.assertEqual(reservation.remaining, 1)
+        # 预留之外只剩一个令牌
+        governor.release(governor.acquire("user:1"))
+        with self.assertRaises(GovernorRejected):
+            governor.acquire("user:1")
+
+        reservation.close()
+        governor.release(governor.acquire("user:1"))
+        with self.assertRaises(GovernorRejected):
+            governor.acquire("user:1")
+
+
+class BackgroundBatchTests(TestCase):
+    def post_batch(self, characters):
+        async def run():
+            response = await self.async_client.post(
+                "/api/aigm/character-background/batch/", {"characters": characters},
+                content_type="application/json")
+            body = b"".join([chunk async for chunk in response.streaming_content]) \
+                if response.streaming else response.content
+            return response, body.decode()
+        return asyncio.run(run())
+
+    @mock.patch("aigm.async_views.agenerate_background")
+    @mock.patch("aigm.async_views.background_cache")
+    def test_cached_characters_need_no_tokens(self, background_cache, generate):
+        background_cache.get.side_effect = lambda key: (
+            {"background": "cached"} if key != self.uncached_key else None)
+        generate.return_value = ("fresh", False)
+        characters = [{"name": f"npc {i}", "race": "Elf", "class": "Bard"} for i in range(3)]
+        self.uncached_key = background_spec_key(background_spec(characters[0]))
+        governor = make_governor(max_concurrent=10, user_rate=0.001, user_burst=1)
+
+        with mock.patch("aigm.async_views.governor", governor):
+            response, body = self.post_batch(characters)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('"succeeded": 3', body)
+        generate.assert_called_once()
+
+    @mock.patch("aigm.async_views.agenerate_background")
+    def test_batch_is_rejected_when_tokens_are_spent(self, generate):
+        characters = [{"name": f"npc {i}", "race": "Elf", "class": "Bard"} for i in range(2)]
+        governor = make_governor(max_concurrent=10, user_rate=0.001, user_burst=2)
+        governor.release(governor.acquire("ip:127.0.0.1"))
+
+        with mock.patch("aigm.async_views.governor", governor):
+            response, _ = self.post_batch(characters)
+
+        self.assertEqual(response.status_code, 429)
+        generate.assert_not_called()
+
+
+class LoreTests(TestCase):
+    def test_aliases_resolve_to_the_same_entry(self):
+        races = lore_registry["races"]
+        elf = races.get("精灵 (Elf)")
+
+        for name in ["精灵", "Elf", "  ELF ", "elf"]:
+            self.assertIs(races.get(name), elf, name)
+        for name in ["Half-Orc", "Half Orc", "half_orc", "半兽人"]:
+            self.assertEqual(races.get(name)["key"], "半兽人 (Half-Orc)", name)
+        self.assertIsNone(races.get("Warforged"))
+
+    def test_subrace_lookup(self):
+        races = lore_registry["races"]
+
+        self.assertEqual(races.get_subrace("Dragonborn", "red")["key"], "红龙")
+        self.assertEqual(races.get_subrace("龙裔", "Red Dragon")["key"], "红龙")
+        self.assertIsNone(races.get_subrace("Human", "red"))
+
+    def test_duplicate_alias_is_rejected(self):
+        entries = [{"key": "a", "text": "", "aliases": ["Same"]},
+                   {"key": "b", "text": "", "aliases": ["same"]}]
+        with self.assertRaises(ValueError):
+            LoreTable("test", 1, entries)
+
+    def test_repeated_request_gets_304(self):
+        response = self.client.get("/api/aigm/lore/races/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], lore_registry.etag)
+
+        repeated = self.client.get("/api/aigm/lore/races/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(repeated.status_code, 304)
+        self.assertEqual(repeated.content, b"")
+
+        self.assertEqual(self.client.get("/api/aigm/lore/spells/").status_code, 404)
+
+
+class RulesRetrievalTests(TestCase):
+    def test_in_fiction_actions_are_not_rules_questions(self):
+        for text in ["Can I sneak past the guards?", "How many guards are there?",
+                     "我能不能打开这扇门", "我们先短休一下再走", "My reaction is to scream"]:
+            self.assertFalse(is_rules_question(text), text)
+
+    def test_rules_questions(self):
+        for text in ["How does grappling work?", "Does casting a spell provoke an opportunity attack?",
+                     "What are the rules for falling?", "短休能恢复多少生命骰？", "先攻怎么判定"]:
+            self.assertTrue(is_rules_question(text), text)
+        self.assertTrue(is_explicit_rules_question("How does grappling work?"))
+        self.assertFalse(is_explicit_rules_question("Can I use my bonus action to hide?"))
+
+    @override_settings(AIGM_RULES_RETRIEVAL=True, AIGM_RULES_MIN_SCORE=6.0, AIGM_RULES_RELATIVE_SCORE=0.6)
+    @mock.patch("aigm.retrieval.rulebook_index")
+    def test_passages_must_be_close_to_the_top_score(self, index):
+        index.search.return_value = [{"score": score} for score in (20.0, 13.0, 11.0, 5.0)]
+
+        passages = retrieve_rule_passages("What are the rules for grappling?")
+
+        self.assertEqual([passage["score"] for passage in passages], [20.0, 13.0])
+
+    def test_only_explicit_rules_answers_are_shortened(self):
+        self.assertEqual(chat_completion_options(
+            {"rules_references": [{"page": 1}], "rules_answer": False})["max_tokens"], 800)
+        self.assertEqual(chat_completion_options(
+            {"rules_references": [{"page": 1}], "rules_answer": True})["max_tokens"],
+            settings.AIGM_RULES_MAX_TOKENS)
+
+
+class ClientIdentityTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get(
+            "/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="6.6.6.6, 1.2.3.4")
+
+    def test_authenticated_user(self):
+        self.assertEqual(client_identity(self.request, SimpleNamespace(pk=7)), "user:7")
+
+    @override_settings(AIGM_TRUSTED_PROXY_COUNT=0)
+    def test_forwarded_header_ignored_without_trusted_proxies(self):
+        self.assertEqual(client_identity(self.request, None), "ip:10.0.0.1")
+
+    @override_settings(AIGM_TRUSTED_PROXY_COUNT=1)
+    def test_uses_address_added_by_trusted_proxy(self):
+        # 客户端自己填写的最左边的值被忽略
+        self.assertEqual(client_identity(self.request, None), "ip:1.2.3.4")
+
+    @override_settings(AIGM_TRUSTED_PROXY_COUNT=2)
+    def test_multiple_trusted_proxies(self):
+        self.assertEqual(client_identity(self.request, None), "ip:6.6.6.6")
+
+
+PORTRAIT_PARAMS = {"name": "Aria", "race": "Elf", "subrace": "", "class": "Wizard",
+                   "gender": "", "style": "fantasy", "features": []}
+
+
+class PortraitJobTests(TestCase):
+    def make_job(self, **fields):
+        return PortraitJob.objects.create(
+            identity="user:1", dedupe_key="key", params=PORTRAIT_PARAMS, **fields)
+
+    def test_submit_reuses_pending_job(self):
+        job, existing = submit_job(None, "user:1", "key", PORTRAIT_PARAMS)
+        again, again_existing = submit_job(None, "user:1", "key", PORTRAIT_PARAMS)
+
+        self.assertFalse(existing)
+        self.assertTrue(again_existing)
+        self.assertEqual(again.id, job.id)
+        # 其他用户的相同请求是独立的任务
+        self.assertNotEqual(submit_job(None, "user:2", "key", PORTRAIT_PARAMS)[0].id, job.id)
+
+    def test_claim_takes_each_job_once(self):
+        job = self.make_job()
+
+        claimed = claim_job("worker-a")
+
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, PortraitJob.STATUS_RUNNING)
+        self.assertEqual(claimed.worker, "worker-a")
+        self.assertEqual(claimed.attempts, 1)
+        self.assertGreater(claimed.lease_expires_at, timezone.now())
+        self.assertIsNone(claim_job("worker-b"))
+
+    def test_claim_oldest_available_job_first(self):
+        first = self.make_job()
+        self.make_job(available_at=timezone.now() + timedelta(minutes=5))
+        second = self.make_job()
+
+        self.assertEqual(claim_job("worker-a").id, first.id)
+        self.assertEqual(claim_job("worker-a").id, second.id)
+        self.assertIsNone(claim_job("worker-a"))
+
+    def test_expired_lease_is_reclaimed(self):
+        job = self.make_job(status=PortraitJob.STATUS_RUNNING, worker="crashed", attempts=1,
+                            lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        claimed = claim_job("worker-b")
+
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.worker, "worker-b")
+        self.assertEqual(claimed.attempts, 2)
+
+    @mock.patch("aigm.views.run_portrait_pipeline")
+    def test_run_records_result(self, pipeline):
+        pipeline.return_value = {"image_url": "https://example.com/a.png"}
+        self.make_job()
+
+        run_job(claim_job("worker-a"), "worker-a")
+
+        job = PortraitJob.objects.get()
+        self.assertEqual(job.status, PortraitJob.STATUS_SUCCEEDED)
+        self.assertEqual(job.result, {"image_url": "https://example.com/a.png"})
+
+    @mock.patch("aigm.views.run_portrait_pipeline")
+    def test_stale_worker_cannot_overwrite_reclaimed_job(self, pipeline):
+        self.make_job()
+        job = claim_job("worker-a")
+        # 租约过期后被 worker-b 重新领取
+        PortraitJob.objects.filter(id=job.id).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1))
+        claim_job("worker-b")
+        pipeline.return_value = {"image_url": "stale"}
+
+        run_job(job, "worker-a")
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, PortraitJob.STATUS_RUNNING)
+        self.assertEqual(job.worker, "worker-b")
+        self.assertIsNone(job.result)
+
+    @mock.patch("aigm.views.run_portrait_pipeline")
+    def test_rate_limited_job_is_requeued(self, pipeline):
+        pipeline.side_effect = GovernorRejected("rate_limited", 30)
+        self.make_job()
+
+        run_job(claim_job("worker-a"), "worker-a")
+
+        job = PortraitJob.objects.get()
+        self.assertEqual(job.status, PortraitJob.STATUS_QUEUED)
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.available_at, timezone.now() + timedelta(seconds=20))
+        self.assertIsNone(claim_job("worker-a"))
+
+    @override_settings(AIGM_PORTRAIT_JOB_MAX_ATTEMPTS=2)
+    @mock.patch("aigm.views.run_portrait_pipeline")
+    def test_job_fails_after_max_attempts(self, pipeline):
+        self.make_job(status=PortraitJob.STATUS_RUNNING, worker="crashed", attempts=2,
+                      lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        run_job(claim_job("worker-a"), "worker-a")
+
+        job = PortraitJob.objects.get()
+        self.assertEqual(job.status, PortraitJob.STATUS_FAILED)
+        pipeline.assert_not_called()
+
+
+@mock.patch("aigm.views.bulk_delete_images")
+class DeleteImagesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="pw")
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {Token.objects.create(user=self.user).key}"}
+        self.own = f"character_portraits/user_{self.user.pk}/dalle_1"
+
+    def post(self, url, public_ids, **extra):
+        return self.client.post(url, {"public_ids": public_ids},
+                                content_type="application/json", **extra)
+
+    def test_requires_authentication(self, bulk_delete):
+        for url in ("/api/aigm/delete-images/", "/api/aigm/async/delete-images/"):
+            response = self.post(url, [self.own])
+            self.assertEqual(response.status_code, 401)
+        bulk_delete.assert_not_called()
+
+    def test_rejects_images_of_other_users(self, bulk_delete):
+        other = "character_portraits/user_999/dalle_2"
+        for url in ("/api/aigm/delete-images/", "/api/aigm/async/delete-images/"):
+            response = self.post(url, [self.own, other, "character_portraits/dalle_3"], **self.auth)
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(response.json()["public_ids"], [other, "character_portraits/dalle_3"])
+        bulk_delete.assert_not_called()
+
+    def test_deletes_own_images(self, bulk_delete):
+        bulk_delete.return_value = {self.own: "deleted"}
+
+        response = self.post("/api/aigm/delete-images/", [self.own], **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        bulk_delete.assert_called_once_with([self.own])
+
+    def test_portrait_folder_follows_identity(self, bulk_delete):
+        self.assertEqual(portrait_folder("user:7"), "character_portraits/user_7")
+        self.assertEqual(portrait_folder("ip:10.0.0.1"), "character_portraits/anonymous")
+
+
+@mock.patch("aigm.views.delete_in_background")
+class PortraitVariantSetTests(TestCase):
+    def select(self, variant_set_id, public_id):
+        return self.client.post(f"/api/aigm/character-portrait/variants/{variant_set_id}/select/",
+                                {"public_id": public_id}, content_type="application/json",
+                                REMOTE_ADDR="10.0.0.1")
+
+    def test_select_keeps_chosen_and_deletes_the_rest(self, delete):
+        save_variant_set("set1", "ip:10.0.0.1", ["a", "b", "c"])
+
+        response = self.select("set1", "b")
+
+        self.assertEqual(response.status_code, 200)
+        delete.assert_called_once_with(["a", "c"])
+        self.assertFalse(PortraitVariantSet.objects.exists())
+        # 已选择过的集合不能再次选择
+        self.assertEqual(self.select("set1", "a").status_code, 404)
+
+    def test_other_requester_cannot_select(self, delete):
+        save_variant_set("set1", "ip:10.0.0.2", ["a", "b"])
+
+        self.assertEqual(self.select("set1", "a").status_code, 404)
+        delete.assert_not_called()
+
+    def test_expired_sets_are_pruned_with_their_images(self, delete):
+        save_variant_set("old", "ip:10.0.0.1", ["a", "b"])
+        save_variant_set("new", "ip:10.0.0.1", ["c"])
+        PortraitVariantSet.objects.filter(pk="old").update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.select("old", "a").status_code, 404)
+        self.assertEqual(prune_variant_sets(), 1)
+
+        delete.assert_called_once_with(["a", "b"])
+        self.assertEqual(list(PortraitVariantSet.objects.values_list("pk", flat=True)), ["new"])
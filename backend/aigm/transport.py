@@ -0,0 +1,194 @@
+"""
+出站HTTP连接池
+
+OpenAI接口、DALL-E图片下载和Cloudinary上传/删除共用本模块提供的长连接池，
+避免每次请求都重新建立TCP/TLS连接：
+    - openai / images: httpx 客户端（安装了 h2 时启用HTTP/2）
+    - cloudinary: 替换 Cloudinary SDK 内部的 urllib3 PoolManager（SDK默认每个主机只保留1个连接）
+
+每个连接池的大小和读取超时在 settings.AIGM_HTTP_POOLS 中配置，连接超时统一为 AIGM_HTTP_CONNECT_TIMEOUT。
+异步客户端的连接绑定在事件循环上，因此按事件循环分别创建。
+"""
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import urllib3
+from backend.metrics import observe_upstream
+from django.conf import settings
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 空闲连接保持时间（秒）
+KEEPALIVE_EXPIRY = 30.0
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_cloudinary_manager = None
+_lock = threading.Lock()
+_counters = {}
+
+
+def pool_config(name):
+    """返回连接池配置 (max_connections, read_timeout)"""
+    config = settings.AIGM_HTTP_POOLS[name]
+    return config["max_connections"], config["read_timeout"]
+
+
+def pool_timeout(name):
+    """返回连接池对应的 httpx 超时设置"""
+    _, read_timeout = pool_config(name)
+    return httpx.Timeout(read_timeout, connect=settings.AIGM_HTTP_CONNECT_TIMEOUT)
+
+
+def _client_options(name):
+    max_connections, _ = pool_config(name)
+    return {
+        "timeout": pool_timeout(name),
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        "http2": HTTP2_AVAILABLE,
+    }
+
+
+def _count(name, key):
+    with _lock:
+        counters = _counters.setdefault(name, {"requests": 0, "errors": 0})
+        counters[key] += 1
+
+
+def _event_hooks(name):
+    def on_request(request):
+        _count(name, "requests")
+
+    def on_response(response):
+        if response.status_code >= 500:
+            _count(name, "errors")
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def _async_event_hooks(name):
+    async def on_request(request):
+        _count(name, "requests")
+
+    async def on_response(response):
+        if response.status_code >= 500:
+            _count(name, "errors")
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def get_http_client(name):
+    """获取指定上游的共享同步 httpx 客户端（线程安全）"""
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = httpx.Client(
+                    event_hooks=_event_hooks(name), **_client_options(name))
+                _clients[name] = client
+    return client
+
+
+def get_async_http_client(name):
+    """获取当前事件循环中指定上游的共享异步 httpx 客户端"""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(name)
+    if client is None:
+        client = httpx.AsyncClient(
+            event_hooks=_async_event_hooks(name), **_client_options(name))
+        clients[name] = client
+    return client
+
+
+def install_cloudinary_pool():
+    """用配置好大小和超时的长连接池替换 Cloudinary SDK 的 HTTP 连接器"""
+    global _cloudinary_manager
+    import cloudinary
+    import cloudinary.uploader
+    from cloudinary.api_client import call_api
+    from cloudinary.api_client.tcp_keep_alive_manager import TCPKeepAlivePoolManager
+
+    class TimedPoolManager(TCPKeepAlivePoolManager):
+        """记录每次Cloudinary调用的耗时"""
+
+        def urlopen(self, method, url, *args, **kwargs):
+            started = time.monotonic()
+            outcome = "error"
+            try:
+                response = super().urlopen(method, url, *args, **kwargs)
+                outcome = "ok" if response.status < 500 else "error"
+                return response
+            finally:
+                observe_upstream("cloudinary", method, time.monotonic() - started, outcome)
+
+    max_connections, read_timeout = pool_config("cloudinary")
+    with _lock:
+        if _cloudinary_manager is None:
+            _cloudinary_manager = TimedPoolManager(
+                num_pools=4,
+                maxsize=max_connections,
+                timeout=urllib3.Timeout(
+                    connect=settings.AIGM_HTTP_CONNECT_TIMEOUT, read=read_timeout),
+                **cloudinary.CERT_KWARGS
+            )
+        # 上传接口 (uploader) 和管理接口 (api) 各自持有一个模块级连接器
+        cloudinary.uploader._http = _cloudinary_manager
+        call_api._http = _cloudinary_manager
+    return _cloudinary_manager
+
+
+def _httpx_pool_stats(client):
+    # httpx 没有公开连接池状态，这里读取底层 httpcore 连接池
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", None) or [])
+    return {
+        "connections": len(connections),
+        "idle": sum(1 for connection in connections if connection.is_idle()),
+    }
+
+
+def _cloudinary_pool_stats(manager):
+    hosts = {}
+    for key in list(manager.pools.keys()):
+        pool = manager.pools.get(key)
+        if pool is None:
+            continue
+        hosts[pool.host] = {
+            "requests": pool.num_requests,
+            "connections_created": pool.num_connections,
+            "idle": pool.pool.qsize() if pool.pool is not None else 0,
+        }
+    return hosts
+
+
+def pool_stats():
+    """返回各连接池的请求数、连接数和空闲连接数（当前worker进程）"""
+    with _lock:
+        counters = {name: dict(values) for name, values in _counters.items()}
+        clients = dict(_clients)
+
+    stats = {"http2": HTTP2_AVAILABLE}
+    for name in settings.AIGM_HTTP_POOLS:
+        max_connections, _ = pool_config(name)
+        entry = {"max_connections": max_connections}
+        entry.update(counters.get(name, {"requests": 0, "errors": 0}))
+        if name in clients:
+            entry.update(_httpx_pool_stats(clients[name]))
+        stats[name] = entry
+
+    if _cloudinary_manager is not None:
+        stats["cloudinary"]["hosts"] = _cloudinary_pool_stats(_cloudinary_manager)
+    return stats
@@ -1,12 +1,52 @@
 from django.urls import path
-from .views import ai_gm_chat, generate_character_background, generate_character_portrait, delete_image
+from .views import (
+    ai_gm_chat, generate_character_background, generate_character_portrait, delete_image,
+    delete_images, lore_detail,
+    game_sessions, game_session_detail, aigm_stats, aigm_usage, submit_portrait_job,
+    select_portrait_variant,
+)
+from . import async_views
 
 urlpatterns = [
     path("chat/", ai_gm_chat),  # 访问 /api/aigm/chat/
+    # 流式聊天 (Server-Sent Events)，访问 /api/aigm/chat/stream/
+    # 原生异步视图：在ASGI服务器下逐段发送，客户端断开时关闭上游流
+    path("chat/stream/", async_views.ai_gm_chat_stream),
+    # 服务器端战役会话：聊天时只需发送 {session_id, message}
+    path("sessions/", game_sessions),
+    path("sessions/<str:session_id>/", game_session_detail),
     # Access via /api/aigm/character-background
     path("character-background/", generate_character_background),
+    # 批量生成角色背景，以SSE逐个返回（原生异步视图）
+    path("character-background/batch/",
+         async_views.generate_character_backgrounds_batch),
     # Access via /api/aigm/character-portrait
     path("character-portrait/", generate_character_portrait),
+    # 多候选立绘：并发生成并以SSE逐张返回，选定后其余候选在后台删除
+    path("character-portrait/variants/",
+         async_views.generate_character_portrait_variants),
+    path("character-portrait/variants/<str:variant_set_id>/select/",
+         select_portrait_variant),
+    # 立绘异步任务：提交后返回任务ID，再长轮询 portrait-jobs/<job_id>/?wait=25 获取结果
+    path("portrait-jobs/", submit_portrait_job),
+    path("portrait-jobs/<str:job_id>/", async_views.portrait_job_status),
     # 删除Cloudinary上的图片
     path("delete-image/<str:public_id>/", delete_image),
+    # 批量删除Cloudinary上的图片：{"public_ids": [...]}
+    path("delete-images/", delete_images),
+    # D&D设定资料（带ETag），访问 /api/aigm/lore/ 或 /api/aigm/lore/races/
+    path("lore/", lore_detail),
+    path("lore/<str:kind>/", lore_detail),
+    # 运行统计（仅管理员）
+    path("stats/", aigm_stats),
+    # AI用量和费用汇总（仅管理员），例如 /api/aigm/usage/?group_by=identity,day
+    path("usage/", aigm_usage),
+
+    # 原生异步版本（在ASGI服务器下运行时不会占用工作线程），访问 /api/aigm/async/...
+    path("async/chat/", async_views.ai_gm_chat),
+    path("async/character-background/",
+         async_views.generate_character_background),
+    path("async/character-portrait/", async_views.generate_character_portrait),
+    path("async/delete-image/<str:public_id>/", async_views.delete_image),
+    path("async/delete-images/", async_views.delete_images),
 ]
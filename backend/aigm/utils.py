@@ -1,36 +1,33 @@
-import os
 import uuid
-import base64
+from concurrent.futures import ThreadPoolExecutor
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from datetime import datetime
-import io
 
+# Cloudinary 服务器端直接拉取/解码的来源前缀
+REMOTE_PREFIXES = ("http://", "https://", "data:")
 
-def upload_dalle_image(base64_image, folder="dalle_images"):
+# Cloudinary Admin API 每次 delete_resources 最多接受的 public_id 数
+DELETE_BATCH_LIMIT = 100
+
+
+def upload_dalle_image(image, folder="dalle_images"):
     """
-    将DALL-E生成的base64编码图片上传到Cloudinary
+    将DALL-E生成的图片上传到Cloudinary
 
     参数:
-        base64_image: DALL-E返回的base64编码图片字符串
+        image: 要上传的图片，支持以下形式（都不会在本地做base64编解码或额外复制）:
+            - bytes / bytearray / memoryview: 原始图片数据
+            - 文件类对象（有 read 方法）: 例如打开的文件或下载响应的流
+            - http(s) URL: 由Cloudinary服务器端直接拉取，本服务不经手图片数据
+            - base64编码字符串（可带 data:image/png;base64, 前缀）: 作为data URI交给Cloudinary解码
         folder: Cloudinary上存储的文件夹名称
 
     返回:
         dict: 包含上传结果的字典，成功时包含URL等信息
     """
     try:
-        # 处理base64字符串 (处理可能的data:image/png;base64,前缀)
-        if ',' in base64_image:
-            # 从完整的base64字符串(如data:image/png;base64,xxxxx)中提取实际内容
-            image_data = base64_image.split(',')[1]
-        else:
-            # 已经是纯base64内容
-            image_data = base64_image
-
-        # 解码base64为二进制数据
-        decoded_image = base64.b64decode(image_data)
-
         # 生成唯一的文件名
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         unique_id = uuid.uuid4().hex[:8]
@@ -38,7 +35,7 @@ def upload_dalle_image(base64_image, folder="dalle_images"):
 
         # 上传到Cloudinary
         upload_result = cloudinary.uploader.upload(
-            io.BytesIO(decoded_image),
+            upload_source(image, filename),
             public_id=filename,
             folder=folder,
             resource_type="image",
@@ -66,6 +63,27 @@ def upload_dalle_image(base64_image, folder="dalle_images"):
         }
 
 
+def upload_source(image, filename):
+    """把 upload_dalle_image 接受的图片形式转换为 Cloudinary SDK 的 file 参数"""
+    if isinstance(image, str):
+        if image.startswith(REMOTE_PREFIXES):
+            # URL和data URI原样交给Cloudinary
+            return image
+        # 纯base64内容，补上data URI前缀
+        return f"data:image/png;base64,{image}"
+
+    if isinstance(image, (bytearray, memoryview)):
+        image = bytes(image)
+    if isinstance(image, bytes):
+        # (文件名, 数据) 元组会被SDK直接写入multipart请求体，不再经过BytesIO
+        return (filename, image)
+
+    if hasattr(image, "read"):
+        return image
+
+    raise TypeError(f"不支持的图片类型: {type(image).__name__}")
+
+
 def delete_cloudinary_image(public_id):
     """
     从Cloudinary删除图片
@@ -87,3 +105,42 @@ def delete_cloudinary_image(public_id):
             'success': False,
             'error': str(e)
         }
+
+
+def delete_cloudinary_images(public_ids, chunk_size=DELETE_BATCH_LIMIT, max_workers=4):
+    """
+    批量从Cloudinary删除图片
+
+    public_ids 按 chunk_size 分组，每组调用一次 Admin API 的 delete_resources，
+    各组在最多 max_workers 个线程中并发执行。
+
+    参数:
+        public_ids: 要删除的图片public_id列表（重复的只删除一次）
+        chunk_size: 每次调用删除的数量，不超过 DELETE_BATCH_LIMIT
+        max_workers: 并发调用数
+
+    返回:
+        dict: public_id -> 结果（deleted / not_found，调用失败时为 error: <原因>）
+    """
+    public_ids = list(dict.fromkeys(public_ids))
+    chunk_size = max(1, min(chunk_size, DELETE_BATCH_LIMIT))
+    chunks = [public_ids[i:i + chunk_size]
+              for i in range(0, len(public_ids), chunk_size)]
+
+    results = {}
+    if not chunks:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        for chunk_results in executor.map(_delete_resources_chunk, chunks):
+            results.update(chunk_results)
+    return results
+
+
+def _delete_resources_chunk(public_ids):
+    try:
+        result = cloudinary.api.delete_resources(public_ids, resource_type="image")
+    except Exception as e:
+        return {public_id: f"error: {str(e)}" for public_id in public_ids}
+
+    deleted = result.get('deleted', {})
+    return {public_id: deleted.get(public_id, "not_found") for public_id in public_ids}
@@ -1,18 +1,42 @@
-import os
-import json
-from openai import OpenAI
-from dotenv import load_dotenv
-from rest_framework.decorators import api_view
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.views.decorators.http import etag
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
-from .utils import upload_dalle_image, delete_cloudinary_image
-
-# Load .env configuration
-load_dotenv()
-
-# Get API Key
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from .ai import create_chat_completion, generate_image, governor, prompt_cache_stats
+from .cache import GenerationCache, make_cache_key, normalize_text
+from .context import ContextWindow
+from .governor import GovernorRejected
+from .jobs import job_payload, start_inline_workers, submit_job
+from .lore import registry as lore_registry
+from .metering import GROUP_FIELDS, aggregate_usage, parse_date, usage_ledger
+from .models import GameSession, PortraitVariantSet
+from .retrieval import (
+    cited_pages,
+    format_rule_passages,
+    is_explicit_rules_question,
+    retrieve_rule_passages,
+)
+from .serializers import GameSessionSerializer
+from .singleflight import SingleFlight
+from .transport import get_http_client, pool_stats
+from .sessions import (
+    SessionNotFound,
+    append_session_messages,
+    client_role,
+    convert_client_history,
+    get_session,
+    load_session_messages,
+)
+from .utils import upload_dalle_image, delete_cloudinary_image, delete_cloudinary_images
 
 # System prompt - Detailed Game Master role definition
+# 作为第一条消息逐字节不变地发送，摘要和对话历史都排在它之后。它本身只有约260个token，
+# 达不到上游提示词缓存的1024个token下限；同一会话中历史只追加，规则书摘录插在最新一条玩家消息之前，
+# 因此提示词加上历史超过1024个token后，后续轮次可以命中缓存
 SYSTEM_PROMPT = """You are an experienced Game Master (GM) for tabletop role-playing games (TRPG).
 Your task is to create engaging fantasy worlds, tell vivid stories, manage game rules, and play all NPCs except the player characters.
 
@@ -33,44 +57,157 @@ Follow the classic TRPG format, including scene setting, NPC dialogue, and comba
 """
 
 
+# 对话上下文窗口：限制提示词token数量，较早的对话折叠为摘要
+context_window = ContextWindow()
+
+# 聊天补全的公共参数，普通模式与流式模式共用
+CHAT_COMPLETION_OPTIONS = {
+    "model": "gpt-4o",  # Use latest model
+    "temperature": 0.7,  # Moderate creativity
+    "max_tokens": 800,   # Increased reply length
+    "top_p": 1,
+    "frequency_penalty": 0.2,  # Slightly reduce repetition
+    "presence_penalty": 0.2    # Encourage topic variation
+}
+
+
+def build_chat_messages(user_input, history_messages, session=None, identity=None):
+    """
+    Build the OpenAI message list within the configured token budget
+
+    Rules questions get the top rulebook excerpts injected right before the player's message.
+    Returns (messages, context_info); context_info["prompt_tokens"] is the locally counted prompt size,
+    context_info["rules_references"] lists the cited rulebook pages and context_info["rules_answer"]
+    is set when the message is explicitly a rules question answered from those pages.
+    """
+    passages = retrieve_rule_passages(user_input)
+    # 会话历史从 summary_upto 开始加载（见 load_chat_history）
+    messages, context_info = context_window.build(
+        SYSTEM_PROMPT, history_messages, user_input, session, identity,
+        references=format_rule_passages(passages) if passages else None,
+        history_offset=session.summary_upto if session is not None else 0)
+    context_info["rules_references"] = cited_pages(passages)
+    context_info["rules_answer"] = bool(passages) and is_explicit_rules_question(user_input)
+    return messages, context_info
+
+
+def chat_completion_options(context_info):
+    """聊天补全参数；明确的规则问题依据摘录简短作答，降低回复长度上限，其余保持正常长度"""
+    if context_info.get("rules_answer"):
+        return dict(CHAT_COMPLETION_OPTIONS, max_tokens=settings.AIGM_RULES_MAX_TOKENS)
+    return CHAT_COMPLETION_OPTIONS
+
+
+def get_request_user(request):
+    """返回已登录用户，匿名请求返回None"""
+    user = getattr(request, "user", None)
+    return user if user is not None and user.is_authenticated else None
+
+
+def client_identity(request, user):
+    """
+    请求方标识：已登录用户使用用户ID，匿名请求使用客户端IP
+
+    X-Forwarded-For 最左边的值由客户端任意填写，不能用于限流。只有配置了
+    AIGM_TRUSTED_PROXY_COUNT 时才使用它，并取从右往左第N个值（最外层可信代理看到的地址）；
+    否则使用 REMOTE_ADDR。
+    """
+    if user is not None:
+        return f"user:{user.pk}"
+    address = request.META.get("REMOTE_ADDR", "")
+    trusted_proxies = settings.AIGM_TRUSTED_PROXY_COUNT
+    if trusted_proxies > 0:
+        forwarded = [
+            part.strip() for part in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",")
+            if part.strip()
+        ]
+        if forwarded:
+            # 经过的代理少于配置数量时，所有值都由可信代理添加，取最左边的值
+            address = forwarded[-min(trusted_proxies, len(forwarded))]
+    return "ip:" + address
+
+
+def governor_rejected_response(error):
+    """上游AI调用被并发调度器拒绝时返回 429 和 Retry-After"""
+    response = Response({
+        "error": "AI service is busy, please retry later",
+        "reason": error.reason,
+        "retry_after": error.retry_after
+    }, status=429)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def load_chat_history(data, user):
+    """
+    获取本轮对话的历史消息
+
+    请求中带有 session_id 时从服务器端会话重建历史，否则使用客户端发送的 history。
+    会话只读取尚未折叠进摘要的消息（从 session.summary_upto 开始），较早的消息由摘要代替。
+
+    返回:
+        (session, history_messages): 未使用会话时 session 为 None
+    """
+    session_id = data.get("session_id")
+    if session_id:
+        session = get_session(session_id, user)
+        return session, load_session_messages(session, start=session.summary_upto)
+    return None, convert_client_history(data.get("history", []))
+
+
+def save_chat_turn(session, user_input, ai_reply):
+    """把一轮对话（玩家消息和GM回复）批量追加到会话"""
+    if session is not None:
+        append_session_messages(session, [
+            {"role": "user", "content": user_input},
+            {"role": "assistant", "content": ai_reply},
+        ])
+
+
 @api_view(["POST"])
 def ai_gm_chat(request):
     """API endpoint for interacting with AI GM"""
 
-    # Get user input and conversation history
+    # Get user input; history comes from the server-side session or the request
     user_input = request.data.get("message", "")
-    conversation_history = request.data.get("history", [])
 
     if not user_input:
         return Response({"error": "Message cannot be empty"}, status=400)
 
+    user = get_request_user(request)
+    identity = client_identity(request, user)
     try:
-        # Build message history
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        session, history = load_chat_history(request.data, user)
+    except SessionNotFound:
+        return Response({"error": "Session not found"}, status=404)
+    except (KeyError, TypeError):
+        # 客户端发送的 history 缺少 role / text 字段或不是列表
+        return Response({"error": "Invalid history format"}, status=400)
 
-        # Add conversation history (if any)
-        for msg in conversation_history:
-            role = "assistant" if msg["role"] == "gm" else "user"
-            messages.append({"role": role, "content": msg["text"]})
-
-        # Add current user input
-        messages.append({"role": "user", "content": user_input})
+    try:
+        # Build message history within the token budget
+        messages, context_info = build_chat_messages(
+            user_input, history, session, identity)
 
         # Send message to OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4o",  # Use latest model
+        response = create_chat_completion(
+            identity,
+            endpoint="chat",
             messages=messages,
-            temperature=0.7,  # Moderate creativity
-            max_tokens=800,   # Increased reply length
-            top_p=1,
-            frequency_penalty=0.2,  # Slightly reduce repetition
-            presence_penalty=0.2    # Encourage topic variation
+            **chat_completion_options(context_info)
         )
 
         # Get AI response
         ai_reply = response.choices[0].message.content
+        save_chat_turn(session, user_input, ai_reply)
+
+        result = {"reply": ai_reply, "context": context_info}
+        if session is not None:
+            result["session_id"] = str(session.id)
+        return Response(result, status=200)
 
-        return Response({"reply": ai_reply}, status=200)
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
 
     except Exception as e:
         # Log detailed error information
@@ -78,6 +215,214 @@ def ai_gm_chat(request):
         return Response({"error": f"Error communicating with AI: {str(e)}"}, status=500)
 
 
+@api_view(["GET", "POST"])
+def game_sessions(request):
+    """
+    GET: 列出当前用户的战役会话
+    POST: 创建新会话，可选 title 和 history（旧客户端的历史记录，一次性批量导入）
+    """
+    user = get_request_user(request)
+
+    if request.method == "GET":
+        if user is None:
+            return Response({"error": "Authentication required"}, status=401)
+        sessions = GameSession.objects.filter(user=user).order_by('-updated_at')
+        return Response(GameSessionSerializer(sessions, many=True).data)
+
+    title = request.data.get("title") or ""
+    if not isinstance(title, str):
+        return Response({"error": "title must be a string"}, status=400)
+    history = request.data.get("history", [])
+    try:
+        history_messages = convert_client_history(history)
+    except (KeyError, TypeError):
+        return Response({"error": "Invalid history format"}, status=400)
+
+    session = GameSession.objects.create(user=user, title=title[:200])
+    append_session_messages(session, history_messages)
+    return Response(GameSessionSerializer(session).data, status=201)
+
+
+@api_view(["GET", "DELETE"])
+def game_session_detail(request, session_id):
+    """
+    GET: 返回会话信息和消息，支持 ?after=<seq> 只获取该序号之后的消息
+    DELETE: 删除会话
+    """
+    try:
+        session = get_session(session_id, get_request_user(request))
+    except SessionNotFound:
+        return Response({"error": "Session not found"}, status=404)
+
+    if request.method == "DELETE":
+        session.delete()
+        return Response(status=204)
+
+    try:
+        after = int(request.query_params.get("after", -1))
+    except ValueError:
+        return Response({"error": "after must be an integer"}, status=400)
+
+    rows = session.messages.filter(seq__gt=after).values_list(
+        'seq', 'role', 'content')
+    data = GameSessionSerializer(session).data
+    data["messages"] = [
+        {"seq": seq, "role": client_role(role), "text": content}
+        for seq, role, content in rows
+    ]
+    return Response(data)
+
+
+# 角色背景生成的公共参数
+BACKGROUND_COMPLETION_OPTIONS = {
+    "model": "gpt-4o",
+    "temperature": 0.7,
+    "max_tokens": 1000,
+    "top_p": 1,
+    "frequency_penalty": 0.3,
+    "presence_penalty": 0.3
+}
+
+BACKGROUND_SYSTEM_PROMPT = "你是龙与地下城世界的资深大师，精通D&D 5e的所有官方背景和阵营规则，并擅长创作符合设定的角色背景故事。"
+
+# 角色背景提示词的版本号：修改下面的静态前缀或消息结构时递增，旧的缓存条目随之失效
+BACKGROUND_PROMPT_VERSION = 2
+
+# 角色背景提示词的静态前缀（按语言区分），作为第一条消息逐字节不变地发送，
+# 背景/阵营说明和角色信息等可变内容放在其后的用户消息中。整个提示词不到1024个token，
+# 不会命中上游提示词缓存；不为此填充内容，否则每次调用的输入token反而更多。
+BACKGROUND_INSTRUCTIONS = {
+    "chinese": """作为一位资深《龙与地下城》(D&D 5e)世界设定专家，你将为用户给出的角色创建一个符合官方规则和设定的中文背景故事。
+
+请创作一个内容丰富、合理且符合D&D世界观的角色背景故事。故事应当：
+1. 清晰解释该角色如何获得其职业能力
+2. 符合所选背景的特质和特征
+3. 体现所选阵营的价值观和行为模式
+4. 包含角色的成长历程和动机
+5. 自然融入指定的关键词元素
+6. 符合指定的故事基调
+7. 长度适中(约3-5段)，富有叙事性和情感深度
+
+确保生成的背景能够为玩家提供丰富的角色扮演素材，同时与D&D官方规则书中的设定保持一致。
+必须使用中文回答。""",
+    "english": """As an expert in Dungeons & Dragons (D&D 5e) world-building, you will create an official-style background story in English for the character the user describes.
+
+Please craft a rich, plausible character background story that fits within the D&D universe. The story should:
+1. Clearly explain how the character acquired their class abilities
+2. Reflect the traits and features of their chosen background
+3. Embody the values and behavioral patterns of their alignment
+4. Include the character's journey and motivations
+5. Naturally incorporate the specified key elements
+6. Match the specified story tone
+7. Be of moderate length (about 3-5 paragraphs) with narrative depth and emotional resonance
+
+Ensure the generated background provides rich role-playing material for the player while maintaining consistency with D&D official rulebooks.
+The response must be in English.""",
+}
+
+
+def build_background_messages(character_name, character_race, character_class, background,
+                              alignment, keywords, tone, language):
+    """
+    构建角色背景生成的OpenAI消息列表
+
+    消息顺序为 [静态系统提示词] -> [背景/阵营说明] -> [角色信息]，变化最频繁的内容放在最后。
+    """
+    # 基于D&D背景构建详细提示词
+    background_details = get_background_details(background)
+    alignment_details = get_alignment_details(alignment)
+
+    # 构建关键词列表
+    keywords_text = ", ".join(keywords) if keywords else "none specified"
+
+    # 根据所选语言构建提示词
+    if language == "chinese":
+        instructions = BACKGROUND_INSTRUCTIONS["chinese"]
+        character_prompt = f"""背景详情:
+{background_details}
+
+阵营说明:
+{alignment_details}
+
+基本信息:
+- 姓名: {character_name}
+- 种族: {character_race}
+- 职业: {character_class}
+- 背景: {background}
+- 阵营: {alignment}
+- 故事基调: {tone}
+- 关键元素: {keywords_text}"""
+    else:  # 英文
+        instructions = BACKGROUND_INSTRUCTIONS["english"]
+        character_prompt = f"""Background Details:
+{background_details}
+
+Alignment Details:
+{alignment_details}
+
+Basic Information:
+- Name: {character_name}
+- Race: {character_race}
+- Class: {character_class}
+- Background: {background}
+- Alignment: {alignment}
+- Story Tone: {tone}
+- Key Elements: {keywords_text}"""
+
+    return [
+        {"role": "system", "content": f"{BACKGROUND_SYSTEM_PROMPT}\n\n{instructions}"},
+        {"role": "user", "content": character_prompt}
+    ]
+
+
+# 合并相同的并发生成请求（worker内 + 跨worker锁表）
+background_flight = SingleFlight(
+    "background",
+    lock_ttl=settings.AIGM_SINGLEFLIGHT_LOCK_TTL,
+    result_ttl=settings.AIGM_SINGLEFLIGHT_RESULT_TTL,
+)
+portrait_flight = SingleFlight(
+    "portrait",
+    lock_ttl=settings.AIGM_SINGLEFLIGHT_LOCK_TTL,
+    result_ttl=settings.AIGM_SINGLEFLIGHT_RESULT_TTL,
+)
+
+# 角色背景生成结果缓存（进程内LRU + 数据库）
+background_cache = GenerationCache(
+    "background",
+    ttl=settings.AIGM_BACKGROUND_CACHE_TTL,
+    lru_size=settings.AIGM_BACKGROUND_CACHE_LRU_SIZE,
+    max_entries=settings.AIGM_BACKGROUND_CACHE_MAX_ENTRIES,
+)
+
+
+def background_cache_key(character_name, character_race, character_class, background,
+                         alignment, keywords, tone, language):
+    """根据规范化的角色信息和模型参数计算背景缓存键"""
+    if not isinstance(keywords, (list, tuple)):
+        keywords = [keywords]
+    inputs = {
+        # 姓名保留大小写，因为它会原样出现在生成的故事中
+        "name": normalize_text(character_name),
+        "race": normalize_text(character_race).casefold(),
+        "class": normalize_text(character_class).casefold(),
+        "background": normalize_text(background).casefold(),
+        "alignment": normalize_text(alignment).casefold(),
+        "keywords": sorted({normalize_text(k).casefold() for k in keywords if normalize_text(k)}),
+        "tone": normalize_text(tone).casefold(),
+        "language": normalize_text(language).casefold(),
+    }
+    # 设定资料版本变化时旧缓存自动失效
+    options = dict(BACKGROUND_COMPLETION_OPTIONS, prompt_version=BACKGROUND_PROMPT_VERSION,
+                   lore=lore_registry.version)
+    return make_cache_key("background", inputs, options)
+
+
+def background_flight_key(identity, cache_key):
+    """同一用户、同一背景请求的合并键"""
+    return make_cache_key("flight:background", {"identity": identity, "key": cache_key}, {})
+
+
 @api_view(["POST"])
 def generate_character_background(request):
     """根据D&D规则生成角色背景故事，支持中英文选择"""
@@ -92,96 +437,49 @@ def generate_character_background(request):
     tone = request.data.get("tone", "balanced")
     language = request.data.get("language", "chinese")  # 默认使用中文
 
+    force_regenerate = bool(request.data.get("force_regenerate", False))
+
     if not character_race or not character_class:
         return Response({"error": "角色种族和职业是必需的"}, status=400)
 
+    identity = client_identity(request, get_request_user(request))
+
     try:
-        # 基于D&D背景构建详细提示词
-        background_details = get_background_details(background)
-        alignment_details = get_alignment_details(alignment)
-
-        # 构建关键词列表
-        keywords_text = ", ".join(keywords) if keywords else "none specified"
-
-        # 根据所选语言构建提示词
-        if language == "chinese":
-            background_prompt = f"""作为一位资深《龙与地下城》(D&D 5e)世界设定专家，为以下角色创建一个符合官方规则和设定的中文背景故事：
-            
-            基本信息:
-            - 姓名: {character_name}
-            - 种族: {character_race}
-            - 职业: {character_class}
-            - 背景: {background}
-            - 阵营: {alignment}
-            - 故事基调: {tone}
-            - 关键元素: {keywords_text}
-            
-            背景详情:
-            {background_details}
-            
-            阵营说明:
-            {alignment_details}
-            
-            请创作一个内容丰富、合理且符合D&D世界观的角色背景故事。故事应当：
-            1. 清晰解释该角色如何获得其职业能力
-            2. 符合所选背景的特质和特征
-            3. 体现所选阵营的价值观和行为模式
-            4. 包含角色的成长历程和动机
-            5. 自然融入指定的关键词元素
-            6. 符合指定的故事基调
-            7. 长度适中(约3-5段)，富有叙事性和情感深度
-            
-            确保生成的背景能够为玩家提供丰富的角色扮演素材，同时与D&D官方规则书中的设定保持一致。
-            必须使用中文回答。
-            """
-        else:  # 英文
-            background_prompt = f"""As an expert in Dungeons & Dragons (D&D 5e) world-building, create an official-style background story in English for the following character:
-            
-            Basic Information:
-            - Name: {character_name}
-            - Race: {character_race}
-            - Class: {character_class}
-            - Background: {background}
-            - Alignment: {alignment}
-            - Story Tone: {tone}
-            - Key Elements: {keywords_text}
-            
-            Background Details:
-            {background_details}
-            
-            Alignment Details:
-            {alignment_details}
-            
-            Please craft a rich, plausible character background story that fits within the D&D universe. The story should:
-            1. Clearly explain how the character acquired their class abilities
-            2. Reflect the traits and features of their chosen background
-            3. Embody the values and behavioral patterns of their alignment
-            4. Include the character's journey and motivations
-            5. Naturally incorporate the specified key elements
-            6. Match the specified story tone
-            7. Be of moderate length (about 3-5 paragraphs) with narrative depth and emotional resonance
-            
-            Ensure the generated background provides rich role-playing material for the player while maintaining consistency with D&D official rulebooks.
-            The response must be in English.
-            """
-
-        # 发送请求到OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system",
-                    "content": "你是龙与地下城世界的资深大师，精通D&D 5e的所有官方背景和阵营规则，并擅长创作符合设定的角色背景故事。"},
-                {"role": "user", "content": background_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1000,
-            top_p=1,
-            frequency_penalty=0.3,
-            presence_penalty=0.3
-        )
+        # 相同输入直接返回缓存结果，force_regenerate 时跳过缓存重新生成
+        cache_key = background_cache_key(
+            character_name, character_race, character_class, background,
+            alignment, keywords, tone, language)
+        cached = None
+        if force_regenerate:
+            background_cache.bypass()
+        else:
+            cached = background_cache.get(cache_key)
 
-        # 获取AI响应
-        background_story = response.choices[0].message.content
+        if cached is not None:
+            background_story = cached["background"]
+        else:
+            def generate():
+                messages = build_background_messages(
+                    character_name, character_race, character_class, background,
+                    alignment, keywords, tone, language)
+
+                # 发送请求到OpenAI
+                response = create_chat_completion(
+                    identity,
+                    endpoint="background",
+                    messages=messages,
+                    **BACKGROUND_COMPLETION_OPTIONS
+                )
+
+                # 获取AI响应
+                result = {"background": response.choices[0].message.content}
+                background_cache.set(cache_key, result)
+                return result
+
+            # 相同用户的相同请求同时到达时只调用一次模型
+            result, _ = background_flight.do(
+                background_flight_key(identity, cache_key), generate)
+            background_story = result["background"]
 
         return Response({
             "background": background_story,
@@ -190,101 +488,192 @@ def generate_character_background(request):
             "class": character_class,
             "alignment": alignment,
             "background_type": background,
-            "language": language
+            "language": language,
+            "cached": cached is not None
         }, status=200)
 
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
+
     except Exception as e:
         return Response({"error": f"生成角色背景时出错: {str(e)}"}, status=500)
 
 
 def get_background_details(background):
-    """获取D&D官方背景的详细说明（保持原样，不需要修改）"""
-    background_details = {
-        "侍僧 (Acolyte)": """作为侍僧，你在神殿或修道院中度过了光阴，学习传统、仪式和祷告。你可能是虔诚的牧师，或正在寻找信仰真谛。
-特性：避难所 - 你与同信仰的宗教组织有联系，可在其圣地获得食宿。
-技能熟练：洞悉、宗教
-语言：两种自选语言
-起始装备：圣徽、祷告书、5根蜡烛、普通服饰、腰包和15金币""",
-
-        "罪犯 (Criminal)": """你曾是一名罪犯，通过非法手段谋生。你可能是小偷、杀手、走私犯或欺诈师。
-特性：犯罪联系人 - 你有可靠的情报来源和地下世界联系人，了解犯罪活动和地下网络。
-技能熟练：欺骗、隐匿
-工具熟练：一种游戏组、盗贼工具
-起始装备：撬锁工具、神秘来历的信件、普通服饰、腰包和15金币""",
-
-        "民间英雄 (Folk Hero)": """你来自普通民众，但因某次英勇行为而成为家乡的英雄。你与平民有着深厚联系。
-特性：朴素好客 - 普通人会尽可能地隐藏、保护和收留你，甚至冒险帮助你。
-技能熟练：驯兽、生存
-工具熟练：一种工匠工具、陆上载具
-起始装备：工匠工具、铁锹、铁壶、普通服饰、腰包和10金币""",
-
-        "贵族 (Noble)": """你出生或受邀加入上层阶级，拥有财富和特权，可能有家族纹章或徽章。
-特性：特权地位 - 人们倾向于认为你拥有权力和权威，你在高等社会中能获得优待。
-技能熟练：历史、说服
-工具熟练：一种游戏组
-语言：一种自选语言
-起始装备：精美服饰、纯银戒指、家族身份证明卷轴、腰包和25金币""",
-
-        "贤者 (Sage)": """你一生致力于学习和研究，专注于收集知识和古老的秘密。
-特性：研究员 - 当你不知道某信息时，通常知道可以在哪里找到这些信息。
-技能熟练：奥秘、历史
-语言：两种自选语言
-起始装备：墨水笔、墨水瓶、小刀、研究笔记、普通服饰、腰包和10金币""",
-
-        "士兵 (Soldier)": """你曾是一名职业战士，可能是军队或雇佣兵团的一员，了解战争和战术。
-特性：军衔 - 你拥有前军旅生涯的军衔，战友认可你的权威和影响力。
-技能熟练：运动、威吓
-工具熟练：一种游戏组、陆上载具
-起始装备：徽章或军衔标志、战利品、骰子或卡牌、普通服饰、腰包和10金币""",
-
-        "流浪儿 (Urchin)": """你在城市街头长大，学会了通过聪明才智和敏捷活下去，熟知城市的秘密通道和角落。
-特性：城市秘密 - 你了解城市的秘密通道和小路，能够在城市环境中比他人更快地穿行。
-技能熟练：巧手、隐匿
-工具熟练：盗贼工具、伪装工具包
-起始装备：小刀、城市地图、宠物鼠、家人信物、普通服饰、腰包和10金币""",
-
-        "艺人 (Entertainer)": """你在众人面前表演，以你的音乐、舞蹈、杂耍、讲故事或其他娱乐形式闻名。
-特性：名人粉丝 - 在某些地方会有人认出你，给予你免费食宿和小型表演机会。
-技能熟练：体操、表演
-工具熟练：伪装工具包、一种乐器
-起始装备：乐器、崇拜者的情书、旅行服饰、腰包和15金币""",
-
-        "公会工匠 (Guild Artisan)": """你是制作某种商品的技艺大师，属于工匠公会的成员，享有该公会的支持与保护。
-特性：公会会员 - 公会成员会提供食宿、法律援助和其他必要帮助。
-技能熟练：洞悉、说服
-工具熟练：一种工匠工具
-语言：一种自选语言
-起始装备：工匠工具、公会介绍信、旅行服饰、腰包和15金币""",
-
-        # 可以继续添加其他官方背景
-    }
-
-    return background_details.get(background, "你选择的是自定义背景，请根据你的想象力发挥。")
-
+    """获取D&D官方背景的详细说明（背景名可以是中文名、英文名或 "侍僧 (Acolyte)" 形式）"""
+    return lore_registry["backgrounds"].text(
+        background, "你选择的是自定义背景，请根据你的想象力发挥。")
 
 def get_alignment_details(alignment):
     """获取D&D官方阵营的详细说明"""
-    alignment_details = {
-        "守序善良 (Lawful Good)": """守序善良的角色相信秩序、规则和善良的行为是社会稳定的基础。他们信守诺言，尊重权威，保护弱者，对抗邪恶，但总是遵循法律和传统。这类角色可能是忠诚的骑士、公正的法官或虔诚的牧师，他们将正义与慈悲结合，通过系统性和有组织的方式来实现更大的善。""",
+    return lore_registry["alignments"].text(
+        alignment, "你尚未选择阵营，或选择了自定义阵营。")
 
-        "中立善良 (Neutral Good)": """中立善良的角色根本上关心的是做好事和帮助他人，而不太关心规则或混乱。他们会做最能带来最大善良结果的事情，无论是否符合法律或传统。这类角色可能是治疗者、慈善家或改革者，他们愿意在必要时弯曲规则来实现善良目标。""",
+# DALL-E 3 图像生成的公共参数
+PORTRAIT_IMAGE_OPTIONS = {
+    "model": "dall-e-3",
+    "size": "1024x1024",
+    "quality": "hd",  # 使用高质量设置
+    # b64_json 模式下图像直接随响应返回，其余模式返回URL
+    "response_format": "b64_json" if settings.AIGM_PORTRAIT_TRANSFER == "b64_json" else "url",
+    "n": 1,
+}
 
-        "混乱善良 (Chaotic Good)": """混乱善良的角色遵循自己的道德指南，重视个人自由与善良的行为。他们抵抗压迫，蔑视规则，但总是为了更大的善。这类角色可能是义贼、叛军或独立思想家，他们相信善良应该来自个人良知，而不是外部规则或期望。""",
+# 立绘在Cloudinary上的存储文件夹
+PORTRAIT_FOLDER = "character_portraits"
 
-        "守序中立 (Lawful Neutral)": """守序中立的角色信奉秩序、传统和规则高于一切。他们遵循法律的字面意义而非精神，不偏向善恶任何一方。这类角色可能是不偏不倚的法官、忠诚的士兵或奉行传统的修道士，他们认为只有通过结构和规则才能维持社会稳定。""",
 
-        "绝对中立 (True Neutral)": """绝对中立的角色回避极端，追求自然的平衡，或仅仅关注自己的事务而尽量避免道德困境。他们不会偏向任何阵营，而是基于情况做出最实际的决定。这类角色可能是德鲁伊、隐士或实用主义者，他们视平衡为最高目标，或是谨慎地避免卷入更大的冲突。""",
+def portrait_folder(identity):
+    """
+    立绘的上传文件夹：登录用户使用各自的子文件夹，批量删除时按此前缀检查图片归属
 
-        "混乱中立 (Chaotic Neutral)": """混乱中立的角色珍视自由、本能和冲动高于一切，既不刻意行善也不刻意作恶。他们遵循个人欲望，蔑视规则和期望，追求最大化自由。这类角色可能是放浪形骸的艺术家、无拘无束的游荡者或不可预测的疯子，他们的行动难以预测，但通常出于个人利益或一时兴起。""",
+    匿名请求的立绘放在共用的 anonymous 子文件夹，不能通过删除接口删除。
+    """
+    kind, _, value = identity.partition(":")
+    if kind == "user":
+        return f"{PORTRAIT_FOLDER}/user_{value}"
+    return f"{PORTRAIT_FOLDER}/anonymous"
+
+
+def owns_image(user, public_id):
+    """图片是否位于该用户的立绘文件夹中"""
+    return public_id.startswith(portrait_folder(f"user:{user.pk}") + "/")
+
+
+def build_portrait_prompt(character_name, character_race, character_subrace, character_class,
+                          character_gender, character_style, features):
+    """构建角色立绘的DALL-E提示词"""
+    # 获取详细的种族和职业特征描述
+    race_details = get_race_appearance_details(
+        character_race, character_subrace)
+    class_details = get_class_appearance_details(character_class)
+
+    # 构建详细的图像生成提示词
+    portrait_prompt = f"""Create a detailed portrait of a {character_race} {character_class}, {character_gender}.
+
+    ## Race Features:
+    {race_details}
+    
+    ## Class Features:
+    {class_details}
+    
+    ## Character Details:
+    - Name: {character_name if character_name else 'Unnamed character'}
+    - Style: {character_style} art style
+    - Additional Features: {', '.join(features)}
+    
+    The portrait must accurately represent this D&D character with correct racial and class features.
+    Create a high-quality shoulder-up portrait showing the character's face clearly, 
+    with appropriate clothing, equipment, expressions, and background elements that
+    match both their race and class specialization.
+    
+    ## Important Requirements:
+    - Character must have all canonical racial features as described
+    - Clothing and equipment must clearly represent their class
+    - Face should be expressive and convey personality
+    - Background should subtly hint at character's profession and environment
+    """
 
-        "守序邪恶 (Lawful Evil)": """守序邪恶的角色有条不紊、有计划地追求邪恶目标，同时维持一套荣誉或忠诚准则。他们利用规则和系统为自己谋取利益，往往遵守承诺，但同时不惜牺牲他人来实现目标。这类角色可能是暴君、组织化的罪犯或军阀，他们通过操控现有系统获取权力和控制。""",
+    return portrait_prompt
 
-        "中立邪恶 (Neutral Evil)": """中立邪恶的角色毫无原则地追求自身利益，对他人毫不关心。他们会做任何能获取所需的事，不受忠诚或混乱的约束。这类角色可能是冷血杀手、佣兵或纯粹的机会主义者，他们的唯一准则是自我服务，对伤害他人全然无视。""",
 
-        "混乱邪恶 (Chaotic Evil)": """混乱邪恶的角色由暴力、破坏和残忍的冲动驱使，蔑视规则、传统和他人福祉。他们既不可预测又危险，往往因暴力和毁灭本身而行动。这类角色可能是狂徒、虐待狂或恶魔崇拜者，他们在苦难与混乱中找到快乐，不受任何道德约束。"""
+class PortraitGenerationError(Exception):
+    """立绘生成流程中可预期的失败（图像下载或上传失败）"""
+
+
+def run_portrait_pipeline(identity, character_name, character_race, character_subrace, character_class,
+                          character_gender, character_style, features, on_stage=None):
+    """
+    生成立绘并保存到Cloudinary，返回接口的结果数据
+
+    on_stage: 可选回调，进入每个阶段（generating / downloading / uploading）时调用
+    """
+    on_stage = on_stage or (lambda stage: None)
+    portrait_prompt = build_portrait_prompt(
+        character_name, character_race, character_subrace, character_class,
+        character_gender, character_style, features)
+
+    # 调用OpenAI的DALL-E 3图像生成API
+    on_stage("generating")
+    response = generate_image(
+        identity,
+        endpoint="portrait",
+        prompt=portrait_prompt,
+        **PORTRAIT_IMAGE_OPTIONS
+    )
+
+    upload_result = transfer_portrait_image(response.data[0], on_stage, portrait_folder(identity))
+
+    if not upload_result['success']:
+        raise PortraitGenerationError(
+            f"图像上传到Cloudinary失败: {upload_result['error']}")
+
+    return portrait_result(upload_result, character_name, character_race, character_class)
+
+
+def transfer_portrait_image(image, on_stage, folder=PORTRAIT_FOLDER):
+    """
+    把DALL-E生成的图像保存到Cloudinary的 folder 中，返回 upload_dalle_image 的结果
+
+    图像数据不经过base64编解码：b64_json 直接作为data URI上传，fetch 模式由Cloudinary拉取URL，
+    只有 download 模式（或拉取失败时）才在本地下载原始字节。
+    """
+    if image.b64_json:
+        on_stage("uploading")
+        return upload_dalle_image(image.b64_json, folder=folder)
+
+    if settings.AIGM_PORTRAIT_TRANSFER == "fetch":
+        on_stage("uploading")
+        upload_result = upload_dalle_image(image.url, folder=folder)
+        if upload_result['success']:
+            return upload_result
+        print(f"Cloudinary拉取DALL-E图像失败，改为下载后上传: {upload_result['error']}")
+
+    # 下载图像以便上传到Cloudinary（复用共享连接池）。整张图读入内存：Cloudinary SDK 对文件对象
+    # 也是一次 read() 读完再组装multipart请求体，流式下载不能降低内存占用，图像只有几MB
+    on_stage("downloading")
+    image_response = get_http_client("images").get(image.url)
+    if image_response.status_code != 200:
+        raise PortraitGenerationError(
+            f"无法下载DALL-E生成的图像，状态码: {image_response.status_code}")
+
+    on_stage("uploading")
+    return upload_dalle_image(image_response.content, folder=folder)
+
+
+def portrait_result(upload_result, character_name, character_race, character_class):
+    """把Cloudinary上传结果转换为立绘接口的返回数据"""
+    return {
+        "image_url": upload_result['url'],
+        "public_id": upload_result['public_id'],
+        "name": character_name,
+        "race": character_race,
+        "class": character_class,
+        "image_details": {
+            "width": upload_result.get('width'),
+            "height": upload_result.get('height'),
+            "format": upload_result.get('format'),
+            "size": upload_result.get('bytes')
+        }
     }
 
-    return alignment_details.get(alignment, "你尚未选择阵营，或选择了自定义阵营。")
+
+def portrait_flight_key(identity, character_name, character_race, character_subrace, character_class,
+                        character_gender, character_style, features):
+    """同一用户、同一规范化立绘请求的合并键"""
+    if not isinstance(features, (list, tuple)):
+        features = [features]
+    inputs = {
+        "identity": identity,
+        "name": normalize_text(character_name),
+        "race": normalize_text(character_race).casefold(),
+        "subrace": normalize_text(character_subrace).casefold(),
+        "class": normalize_text(character_class).casefold(),
+        "gender": normalize_text(character_gender).casefold(),
+        "style": normalize_text(character_style).casefold(),
+        "features": [normalize_text(f) for f in features],
+    }
+    return make_cache_key("flight:portrait", inputs, PORTRAIT_IMAGE_OPTIONS)
 
 
 @api_view(["POST"])
@@ -303,85 +692,23 @@ def generate_character_portrait(request):
         return Response({"error": "角色种族和职业是必需的"}, status=400)
 
     try:
-        # 获取详细的种族和职业特征描述
-        race_details = get_race_appearance_details(
-            character_race, character_subrace)
-        class_details = get_class_appearance_details(character_class)
-
-        # 构建详细的图像生成提示词
-        portrait_prompt = f"""Create a detailed portrait of a {character_race} {character_class}, {character_gender}.
-
-        ## Race Features:
-        {race_details}
-        
-        ## Class Features:
-        {class_details}
-        
-        ## Character Details:
-        - Name: {character_name if character_name else 'Unnamed character'}
-        - Style: {character_style} art style
-        - Additional Features: {', '.join(features)}
-        
-        The portrait must accurately represent this D&D character with correct racial and class features.
-        Create a high-quality shoulder-up portrait showing the character's face clearly, 
-        with appropriate clothing, equipment, expressions, and background elements that
-        match both their race and class specialization.
-        
-        ## Important Requirements:
-        - Character must have all canonical racial features as described
-        - Clothing and equipment must clearly represent their class
-        - Face should be expressive and convey personality
-        - Background should subtly hint at character's profession and environment
-        """
-
-        # 调用OpenAI的DALL-E 3图像生成API
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=portrait_prompt,
-            size="1024x1024",
-            quality="hd",  # 使用高质量设置
-            response_format="url",  # 明确指定返回URL
-            n=1,
-        )
+        # 重复点击或客户端重试时，相同的请求共享同一次生成
+        identity = client_identity(request, get_request_user(request))
+        flight_key = portrait_flight_key(
+            identity, character_name, character_race, character_subrace, character_class,
+            character_gender, character_style, features)
+        result, shared = portrait_flight.do(flight_key, lambda: run_portrait_pipeline(
+            identity, character_name, character_race, character_subrace, character_class,
+            character_gender, character_style, features))
 
-        # 获取生成的图像URL
-        image_url = response.data[0].url
-
-        # 下载图像以便上传到Cloudinary
-        import requests
-        image_response = requests.get(image_url)
-        if image_response.status_code != 200:
-            return Response({
-                "error": f"无法下载DALL-E生成的图像，状态码: {image_response.status_code}"
-            }, status=500)
-
-        # 将图像内容转换为base64
-        import base64
-        image_base64 = base64.b64encode(image_response.content).decode('utf-8')
+        # 返回Cloudinary图像URL和相关信息
+        return Response(dict(result, shared=shared), status=200)
 
-        # 使用Cloudinary保存图像
-        folder_name = "character_portraits"
-        upload_result = upload_dalle_image(image_base64, folder=folder_name)
+    except PortraitGenerationError as e:
+        return Response({"error": str(e)}, status=500)
 
-        if not upload_result['success']:
-            return Response({
-                "error": f"图像上传到Cloudinary失败: {upload_result['error']}"
-            }, status=500)
-
-        # 返回Cloudinary图像URL和相关信息
-        return Response({
-            "image_url": upload_result['url'],
-            "public_id": upload_result['public_id'],
-            "name": character_name,
-            "race": character_race,
-            "class": character_class,
-            "image_details": {
-                "width": upload_result.get('width'),
-                "height": upload_result.get('height'),
-                "format": upload_result.get('format'),
-                "size": upload_result.get('bytes')
-            }
-        }, status=200)
+    except GovernorRejected as e:
+        return governor_rejected_response(e)
 
     except Exception as e:
         import traceback
@@ -390,294 +717,125 @@ def generate_character_portrait(request):
         return Response({"error": f"生成角色立绘时出错: {str(e)}"}, status=500)
 
 
-def get_race_appearance_details(race, subrace=""):
-    """获取D&D种族的详细外貌描述，确保图像生成准确反映种族特征"""
+# 每次清理最多处理的过期候选集合数
+VARIANT_PRUNE_BATCH = 100
+
+
+def save_variant_set(variant_set_id, identity, public_ids):
+    """
+    记录一组候选立绘，供选择接口校验请求方并删除未选中的候选
+
+    保存在数据库中，选择请求落到任何worker都能找到；顺便清理已过期的候选集合。
+    """
+    PortraitVariantSet.objects.create(
+        id=variant_set_id, identity=identity, public_ids=list(public_ids),
+        expires_at=timezone.now() + timedelta(seconds=settings.AIGM_PORTRAIT_VARIANT_TTL))
+    prune_variant_sets()
+
+
+def prune_variant_sets():
+    """删除过期未选择的候选集合，并在后台从Cloudinary删除其中的全部图片；返回清理的集合数"""
+    expired = list(PortraitVariantSet.objects.filter(
+        expires_at__lte=timezone.now()).values_list("id", "public_ids")[:VARIANT_PRUNE_BATCH])
+    if not expired:
+        return 0
+    # 先删除记录：只有删除成功的worker负责删除图片，并发清理时不会重复删除
+    deleted, _ = PortraitVariantSet.objects.filter(
+        pk__in=[variant_set_id for variant_set_id, _ in expired]).delete()
+    if deleted:
+        delete_in_background([pid for _, public_ids in expired for pid in public_ids])
+    return deleted
+
 
-    race_appearance = {
-        "龙裔 (Dragonborn)": """
-            Dragonborn have draconic features including:
-            - Scaled body with reptilian appearance
-            - Dragon-like head with elongated snout/muzzle
-            - Strong draconic eyes
-            - Powerful build standing 6'6" tall on average
-            - Scale colors vary by draconic ancestry
-            - Typically have a tapering tail
-            The character is a draconic humanoid with full reptilian features, not a human with dragon accessories.
-        """,
-
-        "提夫林 (Tiefling)": """
-            Tieflings have fiendish features including:
-            - Skin ranging from human tones to red, purple, or blue
-            - Curved horns (various shapes possible)
-            - Solid-colored eyes (typically red, black, white, silver, gold)
-            - Pointed teeth and ears
-            - Long thick tail with a pointed tip
-            - Some have cloven hooves instead of feet
-            - Some have subtle skin patterns resembling sigils
-        """,
-
-        "半兽人 (Half-Orc)": """
-            Half-Orcs blend human and orcish features:
-            - Grayish or greenish skin tones
-            - Jutting lower canines (tusks)
-            - Slightly pointed ears
-            - Heavy brow ridge and receding hairline
-            - Strong jawline
-            - Muscular, imposing physique
-            - Often have facial scars
-            - Coarse dark hair
-        """,
-
-        "半精灵 (Half-Elf)": """
-            Half-Elves combine elven and human traits:
-            - Slightly pointed ears (less pronounced than full elves)
-            - More refined facial features than humans but less angular than elves
-            - Eyes may have unusual colors
-            - More slender than humans but more robust than elves
-            - Smooth skin with subtle features
-            - Various skin tones depending on parentage
-        """,
-
-        "侏儒 (Gnome)": """
-            Gnomes are small beings with distinctive features:
-            - Very small stature (3-4 feet tall)
-            - Large heads relative to their bodies
-            - Pointed or slightly pointed ears
-            - Bright, expressive eyes often with unusual colors
-            - Wide smiles
-            - Often have large noses
-            - Males typically have impressive facial hair
-            - Animated facial expressions
-        """,
-
-        "半身人 (Halfling)": """
-            Halflings are small with distinctive traits:
-            - Very small stature (about 3 feet tall)
-            - Proportions like small adults, not children
-            - Round faces with rosy cheeks
-            - Large, dexterous hands and feet
-            - Often barefoot with hairy tops of feet
-            - Curly hair (usually brown or black)
-            - Warm, friendly expressions
-            - Nimble appearance
-        """,
-
-        "矮人 (Dwarf)": """
-            Dwarves are stout, sturdy beings:
-            - Short, stocky build (4-5 feet tall but broad)
-            - Very robust physique with notable muscle
-            - Long beards for males (often braided or decorated)
-            - Earth-tone skin from pale to deep brown
-            - Broad noses and bushy eyebrows
-            - Deep-set eyes
-            - Practical clothing with geometric patterns
-            - Thick, strong hands
-        """,
-
-        "精灵 (Elf)": """
-            Elves are graceful beings with ethereal beauty:
-            - Slender, graceful build
-            - Distinctly pointed ears
-            - Angular, symmetrical facial features
-            - Almond-shaped eyes that may have unusual colors
-            - No facial hair
-            - Typically taller than humans but more slender
-            - Ageless appearance
-            - Smooth skin without blemishes
-            - Elegant posture
-            - Long, typically straight hair
-        """,
-
-        "人类 (Human)": """
-            Humans in D&D show great diversity:
-            - Variable appearance
-            - Round ears
-            - Standard human proportions
-            - Diverse skin tones, facial features, and body types
-            - Wide range of hairstyles
-            - Facial hair common for males
-            - Clothing varies by region and culture
-            - Most adaptable appearance of any race
-        """
+def delete_in_background(public_ids):
+    """在后台线程中删除图片，不阻塞当前请求"""
+    if public_ids:
+        threading.Thread(target=delete_cloudinary_images, args=(public_ids,),
+                         name="portrait-variant-cleanup", daemon=True).start()
+
+
+@api_view(["POST"])
+def select_portrait_variant(request, variant_set_id):
+    """
+    从一组候选立绘中选定一张，其余候选在后台从Cloudinary删除
+
+    请求体: {"public_id": "<选中的候选>"}
+    """
+    public_id = request.data.get("public_id", "")
+    identity = client_identity(request, get_request_user(request))
+    variant_sets = PortraitVariantSet.objects.filter(
+        pk=variant_set_id, identity=identity, expires_at__gt=timezone.now())
+
+    variant_set = variant_sets.first()
+    if variant_set is None:
+        return Response({"error": "候选立绘不存在或已过期"}, status=404)
+    if public_id not in variant_set.public_ids:
+        return Response({"error": "public_id 不属于该组候选立绘"}, status=400)
+
+    # 同一组候选被并发选择时只有删除成功的请求生效
+    deleted, _ = variant_sets.delete()
+    if not deleted:
+        return Response({"error": "候选立绘不存在或已过期"}, status=404)
+    discarded = [pid for pid in variant_set.public_ids if pid != public_id]
+    delete_in_background(discarded)
+    return Response({"public_id": public_id, "discarded": discarded}, status=200)
+
+
+@api_view(["POST"])
+def submit_portrait_job(request):
+    """
+    提交立绘生成任务，立即返回任务ID (202)
+
+    客户端通过 GET /api/aigm/portrait-jobs/<job_id>/?wait=<秒> 长轮询任务状态，
+    任务成功时 result 与 /character-portrait/ 的返回数据相同。
+    """
+    params = {
+        "name": request.data.get("name", ""),
+        "race": request.data.get("race", ""),
+        "subrace": request.data.get("subrace", ""),
+        "class": request.data.get("class", ""),
+        "gender": request.data.get("gender", ""),
+        "style": request.data.get("style", "fantasy"),
+        "features": request.data.get("features", []),
     }
 
+    if not params["race"] or not params["class"]:
+        return Response({"error": "角色种族和职业是必需的"}, status=400)
+
+    user = get_request_user(request)
+    identity = client_identity(request, user)
+    dedupe_key = portrait_flight_key(
+        identity, params["name"], params["race"], params["subrace"], params["class"],
+        params["gender"], params["style"], params["features"])
+
+    start_inline_workers()
+    job, existing = submit_job(user, identity, dedupe_key, params)
+
+    status_url = f"/api/aigm/portrait-jobs/{job.id}/"
+    response = Response(dict(job_payload(job), status_url=status_url, shared=existing),
+                        status=202)
+    response["Location"] = status_url
+    return response
+
+
+def get_race_appearance_details(race, subrace=""):
+    """获取D&D种族的详细外貌描述，确保图像生成准确反映种族特征"""
+    races = lore_registry["races"]
+
     # 获取基本种族描述
-    base_description = race_appearance.get(
+    base_description = races.text(
         race, "A fantasy character with distinct racial features.")
 
     # 添加亚种特征描述（如果有）
-    subrace_details = ""
-    if subrace:
-        if race == "精灵 (Elf)":
-            if subrace == "高等精灵":
-                subrace_details = "High Elves typically have fair skin, hair in shades of blonde or black, and blue, green, or gold eyes."
-            elif subrace == "木精灵":
-                subrace_details = "Wood Elves typically have copper-colored skin with hints of green, brown or black hair, and green, brown, or hazel eyes."
-            elif subrace == "黑暗精灵":
-                subrace_details = "Drow have obsidian, charcoal, or dark blue skin, white or pale yellow hair, and red, lavender, or blue eyes that glow in dim light."
-        elif race == "矮人 (Dwarf)":
-            if subrace == "山地矮人":
-                subrace_details = "Mountain Dwarves are lighter skinned than Hill Dwarves, with more ruddy complexions and lighter hair."
-            elif subrace == "丘陵矮人":
-                subrace_details = "Hill Dwarves have deep tan or light brown skin, with brown or black hair, and brown or hazel eyes."
-        elif race == "龙裔 (Dragonborn)":
-            dragon_colors = {
-                "黑龙": "Black-scaled with acid resistance",
-                "蓝龙": "Blue-scaled with lightning resistance",
-                "绿龙": "Green-scaled with poison resistance",
-                "红龙": "Red-scaled with fire resistance",
-                "白龙": "White-scaled with cold resistance",
-                "金龙": "Gold-scaled with fire resistance",
-                "银龙": "Silver-scaled with cold resistance",
-                "铜龙": "Copper-scaled with acid resistance",
-                "青铜龙": "Bronze-scaled with lightning resistance",
-                "黄铜龙": "Brass-scaled with fire resistance",
-            }
-            subrace_details = dragon_colors.get(subrace, "")
+    subrace_entry = races.get_subrace(race, subrace)
+    subrace_details = subrace_entry["text"] if subrace_entry else ""
 
     return f"{base_description}\n{subrace_details}".strip()
 
-
 def get_class_appearance_details(character_class):
     """获取D&D职业的视觉特征描述，确保图像生成准确反映职业特征"""
-
-    class_appearance = {
-        "战士 (Fighter)": """
-            Fighter visual elements include:
-            - Well-maintained armor appropriate to their fighting style
-            - Multiple visible weapons showing their combat versatility
-            - Battle scars or callused hands showing experience
-            - Alert, tactical expression and stance
-            - Practical, serviceable equipment with minimal decoration
-            - Possibly a shield or defensive items
-            - Strong, trained physique
-        """,
-
-        "法师 (Wizard)": """
-            Wizard visual elements include:
-            - Robes or clothing with arcane symbols or runes
-            - Spell component pouch or focus item (orb, wand, staff)
-            - Book, scroll or other written materials
-            - Minimal or no physical armor
-            - Perhaps a familiar or magical trinket
-            - Thoughtful, studious expression
-            - Possibly glowing eyes or magical effects
-        """,
-
-        "游荡者 (Rogue)": """
-            Rogue visual elements include:
-            - Light, flexible clothing allowing easy movement
-            - Multiple visible or partially concealed daggers/weapons
-            - Hooded or shadowed face
-            - Lockpicks, thieves' tools, or other specialized equipment
-            - Leather armor or protective gear that doesn't restrict movement
-            - Alert, observant expression with calculating eyes
-            - Possibly trinkets or trophies from past exploits
-        """,
-
-        "牧师 (Cleric)": """
-            Cleric visual elements include:
-            - Religious symbol prominently displayed
-            - Ceremonial clothing or armor showing their faith
-            - Holy book, scroll or prayer beads
-            - Divine focus or implement
-            - Expression of piety, wisdom or conviction
-            - Possibly glowing hands or divine aura
-            - Clothing colors matching their deity's symbolism
-        """,
-
-        "野蛮人 (Barbarian)": """
-            Barbarian visual elements include:
-            - Minimal armor, showing their reliance on natural toughness
-            - Tribal markings, tattoos, or war paint
-            - Large, intimidating weapons
-            - Trophies from defeated enemies (teeth, claws, skulls)
-            - Wild, untamed appearance
-            - Intense, fierce expression
-            - Muscular, powerful physique
-        """,
-
-        "吟游诗人 (Bard)": """
-            Bard visual elements include:
-            - Musical instrument (lute, flute, drums)
-            - Flamboyant, colorful clothing with fine details
-            - Charming expression or charismatic smile
-            - Trinkets or tokens from various cultures
-            - Light, practical armor if any
-            - Possibly a magical focus disguised as jewelry
-            - Elegant or expressive posture
-        """,
-
-        "德鲁伊 (Druid)": """
-            Druid visual elements include:
-            - Natural materials (leather, wood, leaves, vines)
-            - Animal companions or natural creatures nearby
-            - Staff, sickle, or natural focus item
-            - Clothing adorned with natural elements
-            - Tribal tattoos or body paint with nature symbolism
-            - Calm, observant expression
-            - No metal armor or minimal metal items
-        """,
-
-        "武僧 (Monk)": """
-            Monk visual elements include:
-            - Simple, functional clothing allowing full movement
-            - Minimal or no armor
-            - Disciplined posture and controlled expression
-            - Possibly shaved head or simple hairstyle
-            - Ritual scarification or tattoos for some traditions
-            - Focused, meditative expression
-            - Possibly prayer beads or spiritual focus items
-        """,
-
-        "圣武士 (Paladin)": """
-            Paladin visual elements include:
-            - Gleaming, well-maintained armor
-            - Holy symbol prominently displayed
-            - Righteous expression of purpose
-            - Weapon or shield with religious iconography
-            - Aura of authority and conviction
-            - Clean, orderly appearance
-            - Colors and emblems of their oath or order
-        """,
-
-        "游侠 (Ranger)": """
-            Ranger visual elements include:
-            - Practical, weathered clothing in earth tones
-            - Bow, quiver, or hunting weapons
-            - Camouflage elements or forest colors
-            - Animal companion or tracking tools
-            - Alert, watchful expression
-            - Wilderness survival gear
-            - Light or medium armor allowing mobility
-        """,
-
-        "术士 (Sorcerer)": """
-            Sorcerer visual elements include:
-            - Distinctive features hinting at their magical bloodline
-            - Clothing with elements matching their magic source
-            - Minimal physical armor or protection
-            - Confident expression of innate power
-            - Possibly glowing eyes or magical manifestations
-            - Arcane focus item (orb, crystal, rod)
-            - Dynamic, energetic presence
-        """,
-
-        "邪术师 (Warlock)": """
-            Warlock visual elements include:
-            - Eldritch symbols or patron's iconography
-            - Otherworldly features from their pact
-            - Mysterious, arcane accessories
-            - Unusual eyes reflecting their patron
-            - Dark or distinctive clothing
-            - Possibly a familiar or pact weapon
-            - Unsettling or commanding presence
-            - Eldritch focus or strange trinkets
-        """
-    }
-
-    return class_appearance.get(character_class, "A character with distinctive features representing their profession and training.")
-
+    return lore_registry["classes"].text(
+        character_class, "A character with distinctive features representing their profession and training.")
 
 @api_view(["DELETE"])
 def delete_image(request, public_id):
@@ -698,3 +856,141 @@ def delete_image(request, public_id):
 
     except Exception as e:
         return Response({"error": f"删除图片时出错: {str(e)}"}, status=500)
+
+
+def parse_public_ids(data):
+    """
+    从请求体中取出要删除的public_id列表
+
+    返回:
+        (public_ids, error): 格式不正确时 public_ids 为None，error 为错误信息
+    """
+    public_ids = data.get("public_ids")
+    if not isinstance(public_ids, list) or not public_ids:
+        return None, "public_ids 必须是非空列表"
+    if not all(isinstance(public_id, str) and public_id for public_id in public_ids):
+        return None, "public_ids 只能包含非空字符串"
+    if len(public_ids) > settings.AIGM_BULK_DELETE_MAX_IDS:
+        return None, f"一次最多删除 {settings.AIGM_BULK_DELETE_MAX_IDS} 张图片"
+    return public_ids, None
+
+
+def bulk_delete_result(results):
+    """批量删除接口的返回数据"""
+    deleted = sum(1 for status in results.values() if status == "deleted")
+    not_found = sum(1 for status in results.values() if status == "not_found")
+    return {
+        "results": results,
+        "deleted": deleted,
+        "not_found": not_found,
+        "failed": len(results) - deleted - not_found,
+    }
+
+
+def foreign_public_ids(user, public_ids):
+    """返回不属于该用户的public_id"""
+    return [public_id for public_id in public_ids if not owns_image(user, public_id)]
+
+
+def bulk_delete_images(public_ids):
+    """按配置的分组大小和并发数批量删除图片"""
+    return delete_cloudinary_images(
+        public_ids,
+        chunk_size=settings.AIGM_BULK_DELETE_CHUNK_SIZE,
+        max_workers=settings.AIGM_BULK_DELETE_CONCURRENCY,
+    )
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def delete_images(request):
+    """
+    批量从Cloudinary删除当前用户的图片
+
+    请求体: {"public_ids": ["character_portraits/user_<id>/xxx", ...]}
+    返回每个public_id的结果（deleted / not_found / error: ...）；
+    包含不属于当前用户的public_id时整批拒绝 (403)，不删除任何图片。
+    """
+    public_ids, error = parse_public_ids(request.data)
+    if error:
+        return Response({"error": error}, status=400)
+    forbidden = foreign_public_ids(request.user, public_ids)
+    if forbidden:
+        return Response({"error": "不能删除不属于当前用户的图片", "public_ids": forbidden}, status=403)
+
+    try:
+        results = bulk_delete_images(public_ids)
+        return Response(bulk_delete_result(results), status=200)
+
+    except Exception as e:
+        return Response({"error": f"批量删除图片时出错: {str(e)}"}, status=500)
+
+
+def lore_etag(request, kind=None):
+    return lore_registry.etag
+
+
+@etag(lore_etag)
+@api_view(["GET"])
+def lore_detail(request, kind=None):
+    """
+    返回生成提示词所用的D&D设定资料（背景、阵营、种族、职业）
+
+    不带 kind 时返回全部类别；响应带 ETag，客户端可用 If-None-Match 获得 304。
+    """
+    if kind is None:
+        return Response(lore_registry.as_dict())
+    if kind not in lore_registry.tables:
+        return Response({"error": f"未知的资料类别: {kind}"}, status=404)
+    return Response(lore_registry[kind].as_dict())
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def aigm_stats(request):
+    """返回当前worker进程的AIGM运行统计（缓存命中率等）"""
+    return Response({
+        "background_cache": background_cache.stats(),
+        "background_singleflight": background_flight.stats(),
+        "portrait_singleflight": portrait_flight.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "usage_ledger": usage_ledger.stats(),
+        "http_pools": pool_stats(),
+        "governor": governor.stats(),
+    })
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def aigm_usage(request):
+    """
+    按用户、接口、模型和日期汇总AI用量（仅管理员）
+
+    查询参数:
+        group_by: 逗号分隔的分组维度（identity / endpoint / model / day），默认 day,endpoint
+        since / until: 日期范围 YYYY-MM-DD（包含两端），默认最近7天
+        identity / endpoint: 可选的过滤条件
+    """
+    group_by = [field for field in request.GET.get("group_by", "day,endpoint").split(",") if field]
+    unknown = [field for field in group_by if field not in GROUP_FIELDS]
+    if not group_by or unknown:
+        return Response({"error": f"group_by 只能包含: {', '.join(GROUP_FIELDS)}"}, status=400)
+
+    today = timezone.localdate()
+    try:
+        until = parse_date(request.GET["until"]) if "until" in request.GET else today
+        since = parse_date(request.GET["since"]) if "since" in request.GET else until - timedelta(days=6)
+    except ValueError:
+        return Response({"error": "日期格式应为 YYYY-MM-DD"}, status=400)
+
+    # 先写入当前进程缓冲区中的记录
+    usage_ledger.flush()
+    rows = aggregate_usage(group_by, since, until,
+                           identity=request.GET.get("identity"),
+                           endpoint=request.GET.get("endpoint"))
+    return Response({
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "group_by": group_by,
+        "rows": rows,
+    })
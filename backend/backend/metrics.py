@@ -0,0 +1,234 @@
+"""
+Prometheus 监控指标
+
+MetricsMiddleware 为每个请求记录:
+    - http_request_duration_seconds: 按路由（URL模式）和路由分组的请求耗时直方图
+    - http_requests_in_flight: 进行中的请求数
+    - http_request_db_queries / db_query_duration_seconds: 每个请求的数据库查询次数和单次查询耗时
+上游调用由 aigm 在调用 OpenAI 和 Cloudinary 时通过 observe_upstream() 记录，
+aigm 的并发调度器通过 observe_governor_*() 记录名额占用、排队深度、排队时间和拒绝次数。
+
+/metrics 输出 Prometheus 文本格式。gunicorn 多worker运行时设置 PROMETHEUS_MULTIPROC_DIR，
+各worker进程把指标写入该目录，/metrics 汇总所有worker（见 gunicorn.conf.py）。
+未安装 prometheus_client 时中间件不做任何事，/metrics 返回 503。
+"""
+import contextvars
+import os
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+    PROMETHEUS_AVAILABLE = True
+except ImportError:  # 未安装时不收集指标
+    prometheus_client = None
+    PROMETHEUS_AVAILABLE = False
+
+# 请求耗时的分桶（秒），AI接口可能持续数十秒
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+DB_QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# 按URL模式划分的路由分组，按顺序匹配第一个
+ROUTE_GROUPS = (
+    (re.compile(r"^api/aigm/(async/)?chat/"), "chat"),
+    (re.compile(r"^api/aigm/(async/)?character-background/"), "background"),
+    (re.compile(r"^api/aigm/((async/)?character-portrait|portrait-jobs)/"), "portrait"),
+    (re.compile(r"^api/aigm/"), "aigm"),
+    (re.compile(r"^api/rules/pdf/[^/]+/pages/"), "rules_pages"),
+    (re.compile(r"^api/rules/(pdf|download)/"), "rules_pdf"),
+    (re.compile(r"^api/rules/"), "rules"),
+    (re.compile(r"^api/characters/"), "characters"),
+    (re.compile(r"^api/auth/"), "auth"),
+    (re.compile(r"^metrics"), "metrics"),
+    (re.compile(r"^admin/"), "admin"),
+)
+
+# 当前请求的路由分组和数据库查询统计，随 sync_to_async 传递到执行查询的线程
+_current_group = contextvars.ContextVar("metrics_route_group", default="other")
+_current_queries = contextvars.ContextVar("metrics_db_queries", default=None)
+
+if PROMETHEUS_AVAILABLE:
+    REQUEST_DURATION = Histogram(
+        "http_request_duration_seconds", "HTTP request latency",
+        ["group", "route", "method", "status"], buckets=REQUEST_BUCKETS)
+    REQUESTS_IN_FLIGHT = Gauge(
+        "http_requests_in_flight", "HTTP requests currently being processed",
+        ["group"], multiprocess_mode="livesum")
+    REQUEST_DB_QUERIES = Histogram(
+        "http_request_db_queries", "Database queries per HTTP request",
+        ["group"], buckets=DB_QUERY_COUNT_BUCKETS)
+    DB_QUERY_DURATION = Histogram(
+        "db_query_duration_seconds", "Database query latency",
+        ["group"], buckets=DB_BUCKETS)
+    UPSTREAM_DURATION = Histogram(
+        "upstream_request_duration_seconds", "Outbound call latency (OpenAI, Cloudinary)",
+        ["upstream", "operation", "outcome"], buckets=REQUEST_BUCKETS)
+    UPSTREAM_ERRORS = Counter(
+        "upstream_request_errors", "Failed outbound calls",
+        ["upstream", "operation"])
+    GOVERNOR_ACTIVE = Gauge(
+        "aigm_governor_active", "Upstream AI calls currently holding a governor slot",
+        multiprocess_mode="livesum")
+    GOVERNOR_QUEUE_DEPTH = Gauge(
+        "aigm_governor_queue_depth", "Upstream AI calls waiting for a governor slot",
+        multiprocess_mode="livesum")
+    GOVERNOR_QUEUE_WAIT = Histogram(
+        "aigm_governor_queue_wait_seconds", "Time queued before a governor slot was granted",
+        buckets=REQUEST_BUCKETS)
+    GOVERNOR_REJECTIONS = Counter(
+        "aigm_governor_rejections", "Upstream AI calls rejected by the governor",
+        ["reason"])
+
+
+def route_group(route):
+    for pattern, group in ROUTE_GROUPS:
+        if pattern.match(route):
+            return group
+    return "other"
+
+
+def resolve_route(path):
+    """返回请求匹配的URL模式；没有匹配时返回 "unmatched"，避免把任意路径作为标签值"""
+    try:
+        return resolve(path).route or "unmatched"
+    except Resolver404:
+        return "unmatched"
+
+
+def observe_upstream(upstream, operation, duration, outcome="ok"):
+    """记录一次上游调用"""
+    if not PROMETHEUS_AVAILABLE:
+        return
+    UPSTREAM_DURATION.labels(upstream, operation, outcome).observe(duration)
+    if outcome != "ok":
+        UPSTREAM_ERRORS.labels(upstream, operation).inc()
+
+
+def observe_governor_state(active, queued):
+    """记录调度器当前占用的名额数和排队请求数"""
+    if not PROMETHEUS_AVAILABLE:
+        return
+    GOVERNOR_ACTIVE.set(active)
+    GOVERNOR_QUEUE_DEPTH.set(queued)
+
+
+def observe_governor_wait(seconds):
+    """记录一次排队后获得名额的等待时间"""
+    if PROMETHEUS_AVAILABLE:
+        GOVERNOR_QUEUE_WAIT.observe(seconds)
+
+
+def observe_governor_rejection(reason):
+    """记录一次被调度器拒绝的调用（rate_limited / queue_full / queue_timeout）"""
+    if PROMETHEUS_AVAILABLE:
+        GOVERNOR_REJECTIONS.labels(reason).inc()
+
+
+def _db_execute_wrapper(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_DURATION.labels(_current_group.get()).observe(time.perf_counter() - started)
+        queries = _current_queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+def _install_db_wrapper(sender=None, connection=connection, **kwargs):
+    if _db_execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_execute_wrapper)
+
+
+if PROMETHEUS_AVAILABLE:
+    # 每个新建的数据库连接（包括 sync_to_async 线程中的连接）都计时
+    connection_created.connect(_install_db_wrapper, dispatch_uid="metrics_db_wrapper")
+
+
+class MetricsMiddleware:
+    """记录请求耗时、进行中请求数和数据库查询，同时支持同步和异步请求链"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not PROMETHEUS_AVAILABLE:
+            return self.get_response(request)
+
+        # 本线程在信号连接之前建立的连接也加上计时
+        _install_db_wrapper()
+        route, group, tokens, started = self._begin(request)
+        status = "500"
+        try:
+            response = self.get_response(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            self._end(request, route, group, tokens, started, status)
+
+    async def __acall__(self, request):
+        if not PROMETHEUS_AVAILABLE:
+            return await self.get_response(request)
+
+        route, group, tokens, started = self._begin(request)
+        status = "500"
+        try:
+            response = await self.get_response(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            self._end(request, route, group, tokens, started, status)
+
+    @staticmethod
+    def _begin(request):
+        route = resolve_route(request.path_info)
+        group = route_group(route)
+        tokens = (_current_group.set(group), _current_queries.set([0]))
+        REQUESTS_IN_FLIGHT.labels(group).inc()
+        return route, group, tokens, time.perf_counter()
+
+    @staticmethod
+    def _end(request, route, group, tokens, started, status):
+        # 流式响应只统计到开始发送响应的时间
+        REQUEST_DURATION.labels(group, route, request.method, status).observe(
+            time.perf_counter() - started)
+        REQUESTS_IN_FLIGHT.labels(group).dec()
+        REQUEST_DB_QUERIES.labels(group).observe(_current_queries.get()[0])
+        _current_group.reset(tokens[0])
+        _current_queries.reset(tokens[1])
+
+
+def metrics_view(request):
+    """以 Prometheus 文本格式输出指标；设置了 METRICS_AUTH_TOKEN 时需要 Bearer 令牌"""
+    if not PROMETHEUS_AVAILABLE:
+        return HttpResponse("prometheus_client is not installed\n", status=503,
+                            content_type="text/plain")
+
+    token = os.getenv("METRICS_AUTH_TOKEN")
+    if token and request.headers.get("Authorization", "") != f"Bearer {token}":
+        return HttpResponse(status=401)
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # 汇总所有worker进程写入的指标文件
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return HttpResponse(prometheus_client.generate_latest(registry),
+                        content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -57,6 +57,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 最外层：请求耗时包含其余所有中间件
+    "backend.metrics.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
@@ -171,6 +173,142 @@ CORS_ALLOW_CREDENTIALS = True
 # 读取 OpenAI API Key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# AI GM 上下文窗口：提示词token预算、保留的最近对话轮数，以及生成滚动摘要的模型
+AIGM_CONTEXT_TOKEN_BUDGET = int(os.getenv("AIGM_CONTEXT_TOKEN_BUDGET", "6000"))
+AIGM_CONTEXT_MAX_TURNS = int(os.getenv("AIGM_CONTEXT_MAX_TURNS", "20"))
+AIGM_SUMMARY_MODEL = os.getenv("AIGM_SUMMARY_MODEL", "gpt-4o-mini")
+
+# 角色背景生成缓存：有效期（秒）、进程内LRU条数、数据库最大条数
+AIGM_BACKGROUND_CACHE_TTL = int(
+    os.getenv("AIGM_BACKGROUND_CACHE_TTL", str(60 * 60 * 24 * 7)))
+AIGM_BACKGROUND_CACHE_LRU_SIZE = int(
+    os.getenv("AIGM_BACKGROUND_CACHE_LRU_SIZE", "256"))
+AIGM_BACKGROUND_CACHE_MAX_ENTRIES = int(
+    os.getenv("AIGM_BACKGROUND_CACHE_MAX_ENTRIES", "5000"))
+
+# 相同生成请求合并：跨worker锁的最长持有时间、结果对其他worker可见的时间（秒）
+AIGM_SINGLEFLIGHT_LOCK_TTL = int(os.getenv("AIGM_SINGLEFLIGHT_LOCK_TTL", "180"))
+AIGM_SINGLEFLIGHT_RESULT_TTL = int(
+    os.getenv("AIGM_SINGLEFLIGHT_RESULT_TTL", "60"))
+
+# 出站HTTP连接池：连接超时，以及每个上游的连接池大小和读取超时（秒）
+AIGM_HTTP_CONNECT_TIMEOUT = float(os.getenv("AIGM_HTTP_CONNECT_TIMEOUT", "5"))
+AIGM_HTTP_POOLS = {
+    "openai": {
+        "max_connections": int(os.getenv("AIGM_OPENAI_POOL_SIZE", "50")),
+        "read_timeout": float(os.getenv("AIGM_OPENAI_READ_TIMEOUT", "120")),
+    },
+    "images": {
+        "max_connections": int(os.getenv("AIGM_IMAGES_POOL_SIZE", "20")),
+        "read_timeout": float(os.getenv("AIGM_IMAGES_READ_TIMEOUT", "60")),
+    },
+    "cloudinary": {
+        "max_connections": int(os.getenv("AIGM_CLOUDINARY_POOL_SIZE", "20")),
+        "read_timeout": float(os.getenv("AIGM_CLOUDINARY_READ_TIMEOUT", "120")),
+    },
+}
+
+# 上游AI调用并发调度（每个worker进程）：全局并发上限、最大排队数、最长排队时间（秒），
+# 以及每个用户的令牌桶（补充速率 次/秒、容量）
+AIGM_GOVERNOR_MAX_CONCURRENT = int(
+    os.getenv("AIGM_GOVERNOR_MAX_CONCURRENT", "16"))
+AIGM_GOVERNOR_MAX_QUEUE = int(os.getenv("AIGM_GOVERNOR_MAX_QUEUE", "64"))
+AIGM_GOVERNOR_MAX_WAIT = float(os.getenv("AIGM_GOVERNOR_MAX_WAIT", "20"))
+AIGM_GOVERNOR_USER_RATE = float(os.getenv("AIGM_GOVERNOR_USER_RATE", "0.2"))
+AIGM_GOVERNOR_USER_BURST = int(os.getenv("AIGM_GOVERNOR_USER_BURST", "6"))
+# 应用前面的可信反向代理层数，用于从 X-Forwarded-For 取匿名请求的客户端IP（限流按IP计算）；
+# 0 表示直接使用 REMOTE_ADDR。Heroku 路由层为 1，nginx + Heroku 为 2
+AIGM_TRUSTED_PROXY_COUNT = int(os.getenv("AIGM_TRUSTED_PROXY_COUNT", "0"))
+
+# 立绘任务队列：独立worker进程的线程数、web进程内启动的worker线程数（0为不启动）、
+# 任务租约（秒）、最大尝试次数、长轮询最长等待（秒）、轮询间隔（秒）、已结束任务的保留时间（秒）
+AIGM_PORTRAIT_WORKERS = int(os.getenv("AIGM_PORTRAIT_WORKERS", "4"))
+AIGM_PORTRAIT_INLINE_WORKERS = int(
+    os.getenv("AIGM_PORTRAIT_INLINE_WORKERS", "0"))
+AIGM_PORTRAIT_JOB_LEASE = int(os.getenv("AIGM_PORTRAIT_JOB_LEASE", "300"))
+AIGM_PORTRAIT_JOB_MAX_ATTEMPTS = int(
+    os.getenv("AIGM_PORTRAIT_JOB_MAX_ATTEMPTS", "2"))
+AIGM_PORTRAIT_JOB_MAX_WAIT = float(
+    os.getenv("AIGM_PORTRAIT_JOB_MAX_WAIT", "25"))
+AIGM_PORTRAIT_JOB_POLL_INTERVAL = float(
+    os.getenv("AIGM_PORTRAIT_JOB_POLL_INTERVAL", "0.5"))
+AIGM_PORTRAIT_JOB_RETENTION = int(
+    os.getenv("AIGM_PORTRAIT_JOB_RETENTION", str(60 * 60 * 24)))
+
+# 立绘图像从DALL-E传到Cloudinary的方式：
+#   fetch - Cloudinary服务器端直接拉取DALL-E图像URL（失败时回退为download）
+#   b64_json - DALL-E在响应中直接返回base64图像，作为data URI上传
+#   download - 通过共享连接池下载原始图像后上传
+AIGM_PORTRAIT_TRANSFER = os.getenv("AIGM_PORTRAIT_TRANSFER", "fetch")
+
+# 多候选立绘：最多候选数、候选集合等待玩家选择的时间（秒）
+AIGM_PORTRAIT_MAX_VARIANTS = int(os.getenv("AIGM_PORTRAIT_MAX_VARIANTS", "4"))
+AIGM_PORTRAIT_VARIANT_TTL = int(
+    os.getenv("AIGM_PORTRAIT_VARIANT_TTL", str(60 * 60)))
+
+# 批量删除图片：单次请求最多的public_id数、每次Cloudinary调用删除的数量、并发调用数
+AIGM_BULK_DELETE_MAX_IDS = int(os.getenv("AIGM_BULK_DELETE_MAX_IDS", "1000"))
+AIGM_BULK_DELETE_CHUNK_SIZE = int(
+    os.getenv("AIGM_BULK_DELETE_CHUNK_SIZE", "100"))
+AIGM_BULK_DELETE_CONCURRENCY = int(
+    os.getenv("AIGM_BULK_DELETE_CONCURRENCY", "4"))
+
+# 批量生成角色背景：单次请求最多的角色数（其中不同角色的数量另受 AIGM_GOVERNOR_USER_BURST 限制）、
+# 同时进行的生成数
+AIGM_BACKGROUND_BATCH_MAX_ITEMS = int(
+    os.getenv("AIGM_BACKGROUND_BATCH_MAX_ITEMS", "12"))
+AIGM_BACKGROUND_BATCH_CONCURRENCY = int(
+    os.getenv("AIGM_BACKGROUND_BATCH_CONCURRENCY", "6"))
+
+# AI用量记录：批量写入的条数和最长间隔（秒）
+AIGM_USAGE_FLUSH_SIZE = int(os.getenv("AIGM_USAGE_FLUSH_SIZE", "100"))
+AIGM_USAGE_FLUSH_INTERVAL = float(os.getenv("AIGM_USAGE_FLUSH_INTERVAL", "5"))
+# 估算费用用的价格（美元）：文本模型为每百万token的价格，图像模型为每张图片 "<quality>:<size>" 的价格
+AIGM_MODEL_PRICES = {
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "dall-e-3": {
+        "standard:1024x1024": 0.040,
+        "standard:1024x1792": 0.080,
+        "standard:1792x1024": 0.080,
+        "hd:1024x1024": 0.080,
+        "hd:1024x1792": 0.120,
+        "hd:1792x1024": 0.120,
+    },
+}
+
+# AI GM 规则问答检索：是否启用、注入的摘录数、每段摘录的字符数、最低BM25得分、
+# 摘录得分至少为最高分的比例、明确的规则问题回复的最大token数
+AIGM_RULES_RETRIEVAL = os.getenv("AIGM_RULES_RETRIEVAL", "True") == "True"
+AIGM_RULES_PASSAGES = int(os.getenv("AIGM_RULES_PASSAGES", "3"))
+AIGM_RULES_EXCERPT_CHARS = int(os.getenv("AIGM_RULES_EXCERPT_CHARS", "600"))
+AIGM_RULES_MIN_SCORE = float(os.getenv("AIGM_RULES_MIN_SCORE", "6.0"))
+AIGM_RULES_RELATIVE_SCORE = float(os.getenv("AIGM_RULES_RELATIVE_SCORE", "0.6"))
+AIGM_RULES_MAX_TOKENS = int(os.getenv("AIGM_RULES_MAX_TOKENS", "400"))
+
+# 规则书全文索引目录（python manage.py build_rules_index 生成），以及单次检索最多返回的结果数
+RULES_INDEX_DIR = Path(os.getenv("RULES_INDEX_DIR", BASE_DIR / "rules_index"))
+RULES_SEARCH_MAX_RESULTS = int(os.getenv("RULES_SEARCH_MAX_RESULTS", "50"))
+# 规则书目录缓存：检查PDF目录修改时间的最短间隔、完整重新扫描的间隔（秒）
+RULES_CATALOG_POLL_INTERVAL = float(os.getenv("RULES_CATALOG_POLL_INTERVAL", "5"))
+RULES_CATALOG_RESCAN_INTERVAL = float(os.getenv("RULES_CATALOG_RESCAN_INTERVAL", "300"))
+# 规则书PDF响应的缓存时间（秒）；ETag 为文件内容哈希，过期后重新验证通常得到 304
+RULES_PDF_CACHE_MAX_AGE = int(os.getenv("RULES_PDF_CACHE_MAX_AGE", str(7 * 24 * 60 * 60)))
+# 规则书PDF的发送方式：
+#   python - 由Django发送（支持Range；WSGI服务器下使用sendfile，ASGI服务器下在线程池中按块读取）
+#   x-accel - 返回 X-Accel-Redirect，由nginx从 RULES_PDF_ACCEL_PREFIX 对应的 internal location 发送
+#   x-sendfile - 返回 X-Sendfile（文件绝对路径），由 Apache / lighttpd 发送
+RULES_PDF_DELIVERY = os.getenv("RULES_PDF_DELIVERY", "python")
+RULES_PDF_ACCEL_PREFIX = os.getenv("RULES_PDF_ACCEL_PREFIX", "/internal/rulebooks/")
+# 单页PDF：磁盘缓存目录、缓存总大小上限（字节）、一次最多提取的页数
+RULES_PAGE_CACHE_DIR = Path(os.getenv("RULES_PAGE_CACHE_DIR", BASE_DIR / "rules_page_cache"))
+RULES_PAGE_CACHE_MAX_BYTES = int(
+    os.getenv("RULES_PAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+RULES_PAGE_MAX_RANGE = int(os.getenv("RULES_PAGE_MAX_RANGE", "20"))
+# 每个worker为拆分页面保持打开的规则书总大小上限（字节），超过时关闭最久未用的书
+RULES_PAGE_READER_MAX_BYTES = int(
+    os.getenv("RULES_PAGE_READER_MAX_BYTES", str(128 * 1024 * 1024)))
+
 
 CORS_ALLOW_METHODS = [
     'DELETE',
@@ -235,7 +373,9 @@ CLOUDINARY_STORAGE = {
 cloudinary.config(
     cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
     api_key=os.getenv('CLOUDINARY_API_KEY'),
-    api_secret=os.getenv('CLOUDINARY_API_SECRET')
+    api_secret=os.getenv('CLOUDINARY_API_SECRET'),
+    # 压测时指向本地模拟服务（见 benchmarks），未设置时使用Cloudinary官方地址
+    upload_prefix=os.getenv('CLOUDINARY_UPLOAD_PREFIX')
 )
 
 # 可选：默认文件存储配置
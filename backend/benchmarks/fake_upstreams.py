@@ -0,0 +1,350 @@
+"""
+本地模拟的 OpenAI 和 Cloudinary 服务，用于压测时不产生费用、不访问外网
+
+OpenAI（应用通过 OPENAI_BASE_URL 指向这里）:
+    POST /v1/chat/completions     普通和流式（SSE，支持 stream_options.include_usage）
+    POST /v1/images/generations   response_format 为 url 或 b64_json
+    GET  /files/<name>.png        images 返回的图片URL
+
+Cloudinary（应用通过 CLOUDINARY_UPLOAD_PREFIX 指向这里）:
+    POST   /v1_1/<cloud>/image/upload            上传（file 为URL时会像Cloudinary一样去拉取）
+    POST   /v1_1/<cloud>/image/destroy           删除单张
+    DELETE /v1_1/<cloud>/resources/image/upload  delete_resources 批量删除
+
+每类接口的延迟和错误率可以单独配置，见 LatencyProfile。
+"""
+import base64
+import json
+import random
+import re
+import struct
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# 模拟回复中使用的文本，按空格拆分为流式分片
+REPLY_TEXT = (
+    "The torchlight flickers across the damp stone walls as you step into the chamber. "
+    "A hooded figure looks up from a table covered in maps and speaks in a low voice: "
+    "\"You are late, adventurers. The caravan left at dawn, and the road north is not safe.\""
+)
+
+
+def _tiny_png(size=64):
+    """生成一张纯色PNG（size x size）"""
+    raw = b"".join(b"\x00" + b"\x80\x40\x20" * size for _ in range(size))
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+PNG_BYTES = _tiny_png()
+
+
+class LatencyProfile:
+    """
+    一类接口的延迟分布和错误率
+
+    spec 格式:
+        fixed:0.5            固定0.5秒
+        uniform:0.2-1.0      0.2到1.0秒均匀分布
+        lognormal:0.8,0.4    中位数0.8秒、sigma为0.4的对数正态分布
+    error_rate: 返回 error_status 的概率
+    """
+
+    def __init__(self, spec="fixed:0", error_rate=0.0, error_status=500):
+        self.spec = spec
+        self.error_rate = error_rate
+        self.error_status = error_status
+        kind, _, params = spec.partition(":")
+        if kind == "fixed":
+            value = float(params or 0)
+            self._sample = lambda: value
+        elif kind == "uniform":
+            low, high = (float(v) for v in params.split("-"))
+            self._sample = lambda: random.uniform(low, high)
+        elif kind == "lognormal":
+            median, sigma = (float(v) for v in params.split(","))
+            self._sample = lambda: median * random.lognormvariate(0, sigma)
+        else:
+            raise ValueError(f"未知的延迟分布: {spec}")
+
+    @classmethod
+    def parse(cls, value):
+        """解析命令行参数 "<spec>[@<error_rate>[/<status>]]"，例如 lognormal:0.8,0.4@0.02/429"""
+        spec, _, error = value.partition("@")
+        rate, _, status = error.partition("/")
+        return cls(spec, float(rate or 0), int(status or 500))
+
+    def sample(self):
+        return max(self._sample(), 0.0)
+
+    def fails(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def as_dict(self):
+        return {"latency": self.spec, "error_rate": self.error_rate, "error_status": self.error_status}
+
+
+DEFAULT_PROFILES = {
+    "chat": "lognormal:0.8,0.4",
+    "images": "lognormal:3.0,0.3",
+    "download": "fixed:0.05",
+    "upload": "lognormal:0.4,0.3",
+    "destroy": "fixed:0.1",
+}
+
+
+class FakeUpstreams:
+    """
+    在后台线程中运行模拟服务
+
+    参数:
+        profiles: 接口类别（chat / images / download / upload / destroy）到 LatencyProfile 的映射
+        token_delay: 流式回复中每个分片之间的间隔（秒）
+        host / port: 监听地址，port为0时自动分配
+    """
+
+    def __init__(self, profiles=None, token_delay=0.02, host="127.0.0.1", port=0):
+        self.profiles = {name: LatencyProfile(spec) for name, spec in DEFAULT_PROFILES.items()}
+        self.profiles.update(profiles or {})
+        self.token_delay = token_delay
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _handler_class(self):
+        upstreams = self
+
+        class Handler(_FakeHandler):
+            server_state = upstreams
+
+        return Handler
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # ---- 路由 ----
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/files/"):
+            return self._handle("download", self._download)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path == "/v1/chat/completions":
+            return self._handle("chat", self._chat_completion)
+        if path == "/v1/images/generations":
+            return self._handle("images", self._image_generation)
+        if re.fullmatch(r"/v1_1/[^/]+/image/upload", path):
+            return self._handle("upload", self._upload)
+        if re.fullmatch(r"/v1_1/[^/]+/image/destroy", path):
+            return self._handle("destroy", self._destroy)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_DELETE(self):
+        path = urlsplit(self.path).path
+        if re.fullmatch(r"/v1_1/[^/]+/resources/image/upload", path):
+            return self._handle("destroy", self._delete_resources)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    # ---- 通用处理 ----
+
+    def _handle(self, name, handler):
+        state = self.server_state
+        state.count(name)
+        body = self._read_body()
+        profile = state.profiles[name]
+        time.sleep(profile.sample())
+        if profile.fails():
+            state.count(f"{name}_errors")
+            return self._send_json(profile.error_status, {
+                "error": {"message": f"simulated {name} failure", "type": "server_error"}})
+        handler(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ---- OpenAI ----
+
+    def _chat_completion(self, body):
+        request = json.loads(body or b"{}")
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in request.get("messages", []))
+        prompt_tokens = max(prompt_chars // 4, 1)
+        # 模拟上游提示词缓存：超过1024 token的提示词有一半命中
+        cached = (prompt_tokens // 2) // 128 * 128 if prompt_tokens >= 1024 else 0
+        words = REPLY_TEXT.split(" ")
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words),
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "gpt-4o")
+
+        if not request.get("stream"):
+            return self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": REPLY_TEXT}}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None, chunk_usage=None, choices=True):
+            return json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+                "usage": chunk_usage,
+            })
+
+        try:
+            send(chunk({"role": "assistant", "content": ""}))
+            for index, word in enumerate(words):
+                time.sleep(self.server_state.token_delay)
+                send(chunk({"content": word if index == 0 else " " + word}))
+            send(chunk({}, finish_reason="stop"))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send(chunk(None, chunk_usage=usage, choices=False))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开
+            self.close_connection = True
+
+    def _image_generation(self, body):
+        request = json.loads(body or b"{}")
+        if request.get("response_format") == "b64_json":
+            item = {"b64_json": base64.b64encode(PNG_BYTES).decode("ascii")}
+        else:
+            host = self.headers.get("Host")
+            item = {"url": f"http://{host}/files/{uuid.uuid4().hex}.png"}
+        item["revised_prompt"] = request.get("prompt", "")[:200]
+        self._send_json(200, {"created": int(time.time()), "data": [item] * request.get("n", 1)})
+
+    def _download(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(PNG_BYTES)))
+        self.end_headers()
+        self.wfile.write(PNG_BYTES)
+
+    # ---- Cloudinary ----
+
+    def _upload(self, body):
+        fields = _multipart_fields(body, self.headers.get("Content-Type", ""))
+        source = fields.get("file", b"")
+        size = len(source)
+        if source.startswith((b"http://", b"https://")):
+            # 与Cloudinary一样在服务器端拉取远程图片
+            with urllib.request.urlopen(source.decode("utf-8"), timeout=30) as response:
+                size = len(response.read())
+        public_id = fields.get("public_id", uuid.uuid4().hex.encode()).decode("utf-8")
+        folder = fields.get("folder", b"").decode("utf-8")
+        if folder:
+            public_id = f"{folder}/{public_id}"
+        host = self.headers.get("Host")
+        self._send_json(200, {
+            "public_id": public_id,
+            "version": int(time.time()),
+            "format": "png",
+            "resource_type": "image",
+            "width": 1024,
+            "height": 1024,
+            "bytes": size,
+            "url": f"http://{host}/files/{public_id}.png",
+            "secure_url": f"http://{host}/files/{public_id}.png",
+        })
+
+    def _destroy(self, body):
+        self._send_json(200, {"result": "ok"})
+
+    def _delete_resources(self, body):
+        query = parse_qs(urlsplit(self.path).query)
+        public_ids = query.get("public_ids[]", [])
+        if not public_ids and body:
+            try:
+                public_ids = json.loads(body).get("public_ids", [])
+            except ValueError:
+                public_ids = parse_qs(body.decode("utf-8")).get("public_ids[]", [])
+        self._send_json(200, {"deleted": {public_id: "deleted" for public_id in public_ids},
+                              "partial": False})
+
+
+def _multipart_fields(body, content_type):
+    """从 multipart/form-data 或 urlencoded 请求体中取出各字段的原始内容"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        return {key: values[0].encode("utf-8")
+                for key, values in parse_qs(body.decode("utf-8", "replace")).items()}
+
+    fields = {}
+    boundary = b"--" + match.group(1).encode("ascii")
+    for part in body.split(boundary):
+        header, _, value = part.partition(b"\r\n\r\n")
+        name = re.search(rb'name="([^"]+)"', header)
+        if name:
+            fields[name.group(1).decode("utf-8")] = value[:-2] if value.endswith(b"\r\n") else value
+    return fields
@@ -0,0 +1,421 @@
+"""
+AIGM 接口压测
+
+启动本地模拟的 OpenAI / Cloudinary 服务（见 fake_upstreams），用指向它们的环境变量启动应用
+（uvicorn，独立的SQLite数据库），然后以固定并发数运行混合负载，
+输出每个接口的吞吐量和 p50/p95/p99 延迟，并把结果保存为JSON以便在不同提交之间比较。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.loadtest run --concurrency 32 --duration 60
+    python -m benchmarks.loadtest run --mix chat=5,chat_stream=3,background=2 --chat-latency lognormal:1.5,0.5@0.01
+    python -m benchmarks.loadtest run --target http://127.0.0.1:8000   # 压测已启动的应用（需自行配置上游地址）
+    python -m benchmarks.loadtest compare results/a.json results/b.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+from .fake_upstreams import DEFAULT_PROFILES, FakeUpstreams, LatencyProfile
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+DEFAULT_MIX = "chat=4,chat_stream=3,background=2,portrait=1"
+
+RACES = ["精灵 (Elf)", "矮人 (Dwarf)", "人类 (Human)", "半身人 (Halfling)", "龙裔 (Dragonborn)"]
+CLASSES = ["战士 (Fighter)", "法师 (Wizard)", "游荡者 (Rogue)", "牧师 (Cleric)", "游侠 (Ranger)"]
+BACKGROUNDS = ["侍僧 (Acolyte)", "罪犯 (Criminal)", "贤者 (Sage)", "士兵 (Soldier)"]
+ALIGNMENTS = ["守序善良 (Lawful Good)", "混乱中立 (Chaotic Neutral)", "中立邪恶 (Neutral Evil)"]
+PLAYER_MESSAGES = [
+    "I search the room for hidden doors.",
+    "我向酒馆老板打听北方道路的消息。",
+    "I draw my sword and step between the merchant and the bandits.",
+    "Can I try to persuade the guard to let us through?",
+]
+
+
+# ---- 负载场景 ----
+
+class Scenario:
+    """一类请求；build() 返回请求体，distinct 控制不同输入的数量（影响缓存命中率）"""
+
+    name = ""
+    path = ""
+    stream = False
+
+    def __init__(self, distinct):
+        self.distinct = distinct
+
+    def pick(self, rng):
+        return rng.randrange(self.distinct)
+
+    def build(self, rng):
+        raise NotImplementedError
+
+
+class ChatScenario(Scenario):
+    name = "chat"
+    path = "/api/aigm/async/chat/"
+
+    def build(self, rng):
+        turns = rng.randrange(0, 8)
+        history = []
+        for index in range(turns):
+            history.append({"role": "player", "text": rng.choice(PLAYER_MESSAGES)})
+            history.append({"role": "gm", "text": f"The story continues (turn {index})."})
+        return {"message": rng.choice(PLAYER_MESSAGES), "history": history}
+
+
+class ChatStreamScenario(ChatScenario):
+    name = "chat_stream"
+    path = "/api/aigm/chat/stream/"
+    stream = True
+
+
+class BackgroundScenario(Scenario):
+    name = "background"
+    path = "/api/aigm/async/character-background/"
+
+    def build(self, rng):
+        variant = self.pick(rng)
+        return {
+            "name": f"Bench Hero {variant}",
+            "race": RACES[variant % len(RACES)],
+            "class": CLASSES[variant % len(CLASSES)],
+            "background": BACKGROUNDS[variant % len(BACKGROUNDS)],
+            "alignment": ALIGNMENTS[variant % len(ALIGNMENTS)],
+            "keywords": ["bench"],
+            "language": "english" if variant % 2 else "chinese",
+        }
+
+
+class PortraitScenario(Scenario):
+    name = "portrait"
+    path = "/api/aigm/async/character-portrait/"
+
+    def build(self, rng):
+        variant = self.pick(rng)
+        return {
+            "name": f"Bench Hero {variant}",
+            "race": RACES[variant % len(RACES)],
+            "class": CLASSES[variant % len(CLASSES)],
+            "gender": "female" if variant % 2 else "male",
+            "features": [f"feature {variant}"],
+        }
+
+
+SCENARIOS = {cls.name: cls for cls in (ChatScenario, ChatStreamScenario, BackgroundScenario, PortraitScenario)}
+
+
+def parse_mix(value):
+    """解析 "chat=4,portrait=1" 形式的负载权重"""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"未知的场景: {name}（可选: {', '.join(SCENARIOS)}）")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# ---- 统计 ----
+
+def percentile(sorted_values, fraction):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return None
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """samples: [(latency, ttfb, status)]"""
+    latencies = sorted(sample[0] for sample in samples)
+    ttfbs = sorted(sample[1] for sample in samples if sample[1] is not None)
+    statuses = {}
+    for _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items()
+                 if status == "exception" or int(status) >= 400)
+    summary = {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "statuses": statuses,
+    }
+    for label, values in (("latency", latencies), ("ttfb", ttfbs)):
+        if not values:
+            continue
+        summary[label] = {
+            "mean": round(sum(values) / len(values), 4),
+            "p50": round(percentile(values, 0.50), 4),
+            "p95": round(percentile(values, 0.95), 4),
+            "p99": round(percentile(values, 0.99), 4),
+            "max": round(values[-1], 4),
+        }
+    return summary
+
+
+# ---- 负载驱动 ----
+
+async def run_request(client, scenario, rng, headers):
+    payload = scenario.build(rng)
+    started = time.perf_counter()
+    ttfb = None
+    try:
+        if scenario.stream:
+            async with client.stream("POST", scenario.path, json=payload, headers=headers) as response:
+                async for chunk in response.aiter_bytes():
+                    if ttfb is None and chunk:
+                        ttfb = time.perf_counter() - started
+                status = response.status_code
+        else:
+            response = await client.post(scenario.path, json=payload, headers=headers)
+            status = response.status_code
+    except httpx.HTTPError:
+        status = "exception"
+    return time.perf_counter() - started, ttfb, status
+
+
+async def drive(target, mix, concurrency, duration, total_requests, distinct, users, seed, timeout):
+    """以 concurrency 个并发虚拟用户循环发送请求，直到达到时长或请求总数"""
+    scenarios = {name: SCENARIOS[name](distinct) for name in mix}
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    samples = {name: [] for name in names}
+    issued = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as client:
+
+        async def worker(index):
+            nonlocal issued
+            rng = random.Random(seed + index)
+            # 每个虚拟用户使用不同的来源IP，按用户限流时互不影响
+            # （应用以 AIGM_TRUSTED_PROXY_COUNT=1 启动时才采用该头）
+            headers = {"X-Forwarded-For": f"10.77.{index % users // 256}.{index % users % 256}"}
+            while True:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                if total_requests and issued >= total_requests:
+                    return
+                issued += 1
+                name = rng.choices(names, weights)[0]
+                samples[name].append(await run_request(client, scenarios[name], rng, headers))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(index) for index in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    all_samples = [sample for values in samples.values() for sample in values]
+    return {
+        "elapsed": round(elapsed, 3),
+        "overall": summarize(all_samples, elapsed),
+        "endpoints": {name: summarize(values, elapsed) for name, values in samples.items()},
+    }
+
+
+# ---- 应用进程 ----
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_environment(upstreams, database_path, extra_env):
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{upstreams.base_url}/v1",
+        "CLOUDINARY_CLOUD_NAME": "bench",
+        "CLOUDINARY_API_KEY": "bench",
+        "CLOUDINARY_API_SECRET": "bench",
+        "CLOUDINARY_UPLOAD_PREFIX": upstreams.base_url,
+        "DATABASE_URL": f"sqlite:///{database_path}",
+        "DEBUG": "False",
+        # 压测时放宽按用户的限流，避免结果被429主导
+        "AIGM_GOVERNOR_USER_RATE": "1000",
+        "AIGM_GOVERNOR_USER_BURST": "1000",
+        # 压测客户端模拟一层可信代理，用 X-Forwarded-For 区分虚拟用户
+        "AIGM_TRUSTED_PROXY_COUNT": "1",
+    })
+    env.update(extra_env)
+    return env
+
+
+def start_app(env, port, workers):
+    subprocess.run([sys.executable, "manage.py", "migrate", "--noinput"],
+                   cwd=BACKEND_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.asgi:application",
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("应用启动失败")
+        try:
+            if httpx.get(f"{url}/api/aigm/lore/", timeout=2).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("等待应用启动超时")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# ---- 命令 ----
+
+def print_report(result):
+    print(f"\n提交 {result['commit']}，并发 {result['config']['concurrency']}，耗时 {result['elapsed']}s")
+    header = f"{'endpoint':<14}{'reqs':>7}{'err':>6}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfb p50':>10}"
+    print(header)
+    print("-" * len(header))
+    rows = dict(result["endpoints"], overall=result["overall"])
+    for name, summary in rows.items():
+        latency = summary.get("latency", {})
+        ttfb = summary.get("ttfb", {})
+        print(f"{name:<14}{summary['requests']:>7}{summary['errors']:>6}{summary['throughput']:>9}"
+              f"{latency.get('p50', '-'):>9}{latency.get('p95', '-'):>9}{latency.get('p99', '-'):>9}"
+              f"{ttfb.get('p50', '-'):>10}")
+
+
+def command_run(args):
+    profiles = {name: LatencyProfile.parse(getattr(args, f"{name}_latency")) for name in DEFAULT_PROFILES}
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    upstreams = None
+    process = None
+    target = args.target
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            if target is None:
+                upstreams = FakeUpstreams(profiles, token_delay=args.token_delay).start()
+                env = app_environment(upstreams, Path(tmp) / "bench.sqlite3", extra_env)
+                process, target = start_app(env, args.port or free_port(), args.workers)
+
+            result = asyncio.run(drive(
+                target, args.mix, args.concurrency, args.duration, args.requests,
+                args.distinct, args.users, args.seed, args.timeout))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+            if upstreams is not None:
+                upstreams.stop()
+
+    result.update({
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "target": args.target or "spawned",
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "distinct": args.distinct,
+            "users": args.users,
+            "workers": args.workers,
+            "seed": args.seed,
+            "upstreams": {name: profile.as_dict() for name, profile in profiles.items()},
+            "env": extra_env,
+        },
+    })
+    if upstreams is not None:
+        result["upstream_calls"] = dict(upstreams.counters)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / (
+        f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{result['commit']}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print_report(result)
+    print(f"\n结果已保存到 {output}")
+
+
+def command_compare(args):
+    base = json.loads(Path(args.base).read_text(encoding="utf-8"))
+    head = json.loads(Path(args.head).read_text(encoding="utf-8"))
+    print(f"{base['commit']} -> {head['commit']}")
+    header = f"{'endpoint':<14}{'metric':<12}{'base':>10}{'head':>10}{'change':>10}"
+    print(header)
+    print("-" * len(header))
+    names = list(dict.fromkeys(list(base["endpoints"]) + list(head["endpoints"]))) + ["overall"]
+    for name in names:
+        before = base["overall"] if name == "overall" else base["endpoints"].get(name)
+        after = head["overall"] if name == "overall" else head["endpoints"].get(name)
+        if not before or not after:
+            continue
+        metrics = [("throughput", before["throughput"], after["throughput"])]
+        for key in ("p50", "p95", "p99"):
+            metrics.append((f"latency {key}", before.get("latency", {}).get(key),
+                            after.get("latency", {}).get(key)))
+        for metric, old, new in metrics:
+            change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "-"
+            print(f"{name:<14}{metric:<12}{str(old):>10}{str(new):>10}{change:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AIGM 接口压测")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="运行压测")
+    run.add_argument("--target", help="压测已启动的应用，不启动模拟上游和应用进程")
+    run.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                     help=f"负载权重，默认 {DEFAULT_MIX}")
+    run.add_argument("--concurrency", type=int, default=16, help="并发虚拟用户数")
+    run.add_argument("--duration", type=float, default=30, help="压测时长（秒），0为不限")
+    run.add_argument("--requests", type=int, default=0, help="请求总数，0为不限")
+    run.add_argument("--distinct", type=int, default=50, help="背景/立绘请求的不同输入数量")
+    run.add_argument("--users", type=int, default=1000, help="模拟的不同来源IP数量")
+    run.add_argument("--workers", type=int, default=1, help="应用的uvicorn worker数")
+    run.add_argument("--port", type=int, help="应用监听端口，默认自动分配")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--timeout", type=float, default=120, help="单个请求的超时（秒）")
+    run.add_argument("--token-delay", type=float, default=0.02, help="模拟流式回复的分片间隔（秒）")
+    for name, default in DEFAULT_PROFILES.items():
+        run.add_argument(f"--{name}-latency", default=default,
+                         help=f"{name} 接口的延迟分布和错误率，格式 <分布>[@<错误率>[/<状态码>]]，默认 {default}")
+    run.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                     help="传给应用进程的额外环境变量，可重复")
+    run.add_argument("--output", help="结果JSON路径，默认 benchmarks/results/<时间>_<提交>.json")
+    run.set_defaults(func=command_run)
+
+    compare = commands.add_parser("compare", help="比较两次压测结果")
+    compare.add_argument("base")
+    compare.add_argument("head")
+    compare.set_defaults(func=command_compare)
+
+    args = parser.parse_args(argv)
+    if args.command == "run" and not args.duration and not args.requests:
+        parser.error("--duration 和 --requests 至少需要一个")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
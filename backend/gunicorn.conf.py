@@ -0,0 +1,25 @@
+"""
+gunicorn 配置（在 backend 目录下启动时自动加载）
+
+设置了 PROMETHEUS_MULTIPROC_DIR 时，各worker进程把监控指标写入该目录，由 /metrics 汇总；
+启动时清空旧的指标文件，worker退出时标记其进程指标失效。
+"""
+import glob
+import os
+
+
+def on_starting(server):
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
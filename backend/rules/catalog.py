@@ -0,0 +1,112 @@
+"""
+规则书目录缓存
+
+每个worker只在PDF目录变化时重新扫描：两次请求之间至少间隔 poll_interval 秒才 stat 一次目录，
+目录的修改时间（增删、重命名文件时改变）没有变化就继续使用缓存；另外每隔 rescan_interval 秒完整
+重新扫描一次，以发现原地覆盖的文件。
+
+缓存的快照包含已序列化的JSON响应体、ETag（响应体的哈希）和 Last-Modified，
+请求在稳定状态下不访问磁盘，带 If-None-Match / If-Modified-Since 的重复请求直接得到 304。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+# 分类名称映射
+CATEGORY_NAMES = {
+    'core': '核心规则书',
+    'adventure': '冒险模组',
+    'supplement': '补充规则',
+    'other': '其他规则资源'
+}
+
+DEFAULT_METADATA = {
+    'description': '规则书PDF文件',
+    'category': 'other'
+}
+
+
+class CatalogSnapshot:
+    """某一时刻的规则书目录"""
+
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = last_modified
+
+
+class RulebookCatalog:
+    """
+    规则书目录
+
+    参数:
+        pdf_dir: PDF目录
+        metadata: 文件名 -> {"title", "description", "category"}
+        poll_interval: 检查目录修改时间的最短间隔（秒）
+        rescan_interval: 完整重新扫描的间隔（秒）
+    """
+
+    def __init__(self, pdf_dir, metadata, poll_interval, rescan_interval):
+        self.pdf_dir = pdf_dir
+        self.metadata = metadata
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._dir_mtime = None
+        self._checked_at = 0.0
+        self._scanned_at = 0.0
+
+    def get(self):
+        """返回当前的目录快照，必要时重新扫描"""
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is not None and now - self._checked_at < self.poll_interval:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is not None and now - self._checked_at < self.poll_interval:
+                return self._snapshot
+            self._checked_at = now
+
+            if not self.pdf_dir.exists():
+                os.makedirs(self.pdf_dir, exist_ok=True)
+            dir_mtime = self.pdf_dir.stat().st_mtime_ns
+            if (self._snapshot is None or dir_mtime != self._dir_mtime
+                    or now - self._scanned_at >= self.rescan_interval):
+                self._snapshot = self._scan()
+                self._dir_mtime = dir_mtime
+                self._scanned_at = now
+            return self._snapshot
+
+    def _scan(self):
+        rulebooks = {}
+        last_modified = self.pdf_dir.stat().st_mtime
+        for file in sorted(self.pdf_dir.glob('*.pdf')):
+            filename = file.name
+            stat = file.stat()
+            last_modified = max(last_modified, stat.st_mtime)
+            metadata = {**DEFAULT_METADATA, 'title': filename, **self.metadata.get(filename, {})}
+
+            # 按分类组织
+            rulebooks.setdefault(metadata['category'], []).append({
+                'filename': filename,
+                'title': metadata['title'],
+                'description': metadata['description'],
+                'size': stat.st_size,
+                'url': f'/api/rules/pdf/{filename}',
+                'outline_url': f'/api/rules/pdf/{filename}/outline/'
+            })
+
+        result = [
+            {
+                'id': category,
+                'name': CATEGORY_NAMES.get(category, category),
+                'books': books
+            }
+            for category, books in rulebooks.items()
+        ]
+        body = json.dumps({'status': 'success', 'data': result}, ensure_ascii=False).encode('utf-8')
+        return CatalogSnapshot(body, last_modified)
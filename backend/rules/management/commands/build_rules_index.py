@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rules.search import build_index
+from rules.views import PDF_DIR, PDF_METADATA, outline_store, resolve_pdf
+
+
+class Command(BaseCommand):
+    help = "为 PDF 目录中的规则书建立全文检索索引和目录索引（只重新提取内容有变化的书）"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force", action="store_true",
+            help="即使规则书没有变化也重建索引")
+
+    def handle(self, *args, **options):
+        titles = {filename: metadata["title"] for filename, metadata in PDF_METADATA.items()}
+        result = build_index(PDF_DIR, settings.RULES_INDEX_DIR, titles=titles,
+                             force=options["force"], log=self.stdout.write)
+        for path in sorted(PDF_DIR.glob("*.pdf")):
+            # 目录索引按内容哈希缓存，已提取过的书直接跳过
+            try:
+                outline_store.get(resolve_pdf(path.name))
+            except Exception as e:
+                self.stderr.write(f"提取 {path.name} 的目录索引失败: {str(e)}")
+        if not result["changed"]:
+            self.stdout.write(f"规则书没有变化，继续使用索引 {result['generation']}")
+            return
+        self.stdout.write(
+            f"索引 {result['generation']} 已生效: {result['books']} 本书, {result['pages']} 页, "
+            f"{result['terms']} 个词项（新提取 {result['extracted']} 本，沿用 {result['reused']} 本）")
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from rules.pages import PageOutOfRange, most_requested_pages
+from rules.views import page_cache, resolve_pdf
+
+
+class Command(BaseCommand):
+    help = "为请求次数最多的规则书页面预先生成单页PDF缓存"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top", type=int, default=200,
+            help="预热的页面区间数")
+        parser.add_argument(
+            "--interval", type=float, default=0,
+            help="大于0时作为后台任务持续运行，每隔多少秒预热一次")
+
+    def handle(self, *args, **options):
+        while True:
+            self.prewarm(options["top"])
+            if options["interval"] <= 0:
+                return
+            time.sleep(options["interval"])
+            close_old_connections()
+
+    def prewarm(self, top):
+        warmed = 0
+        for request in most_requested_pages(top):
+            source_path = resolve_pdf(request.filename)
+            if source_path is None:
+                continue
+            try:
+                page_cache.get(source_path, request.first_page, request.last_page)
+            except PageOutOfRange:
+                continue
+            except Exception as e:
+                self.stderr.write(f"预热 {request.filename} 第{request.first_page}-{request.last_page}页失败: {str(e)}")
+                continue
+            warmed += 1
+        self.stdout.write(f"已预热 {warmed} 个页面区间")
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RulebookPageRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('first_page', models.PositiveIntegerField()),
+                ('last_page', models.PositiveIntegerField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('last_requested', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-hits'], name='rulebook_page_hits_idx')],
+                'constraints': [models.UniqueConstraint(fields=('filename', 'first_page', 'last_page'), name='rulebook_page_request_unique')],
+            },
+        ),
+    ]
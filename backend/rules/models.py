@@ -1,3 +1,19 @@
 from django.db import models
 
-# Create your models here.
+
+class RulebookPageRequest(models.Model):
+    """规则书单页（或页码区间）的请求次数，预热页面缓存时按次数排序"""
+    filename = models.CharField(max_length=255)
+    first_page = models.PositiveIntegerField()
+    last_page = models.PositiveIntegerField()
+    hits = models.PositiveIntegerField(default=0)
+    last_requested = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['filename', 'first_page', 'last_page'],
+                                    name='rulebook_page_request_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['-hits'], name='rulebook_page_hits_idx'),
+        ]
@@ -0,0 +1,120 @@
+"""
+规则书目录结构和页面偏移索引
+
+每本规则书提取一次（按文件内容哈希缓存在 RULES_INDEX_DIR/outlines/<sha>.json）：
+    - outline: PDF书签（章节标题、页码、子章节）
+    - page_labels: 每页的页码标签（例如前言使用罗马数字）
+    - page_offsets: 每页页面对象在文件中的字节偏移；位于对象流中的页面给出对象流的偏移
+
+前端据此直接跳到某一章，配合 Range 请求只下载需要的部分。
+"""
+import json
+import os
+import threading
+
+from .serving import file_etag
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # 未安装时无法提取，已缓存的索引仍可返回
+    PdfReader = None
+
+# 索引格式版本，格式变化时旧缓存自动失效
+OUTLINE_FORMAT = 1
+
+
+def _outline_entries(reader, items):
+    """把 pypdf 的嵌套书签列表（子列表紧跟在上级书签之后）转换为树"""
+    entries = []
+    for item in items:
+        if isinstance(item, list):
+            children = _outline_entries(reader, item)
+            if entries:
+                entries[-1]["children"].extend(children)
+            else:
+                entries.extend(children)
+            continue
+        try:
+            page = reader.get_destination_page_number(item) + 1
+        except Exception:  # 指向外部文件或无效目标的书签
+            page = None
+        entries.append({"title": str(item.title or "").strip(), "page": page, "children": []})
+    return entries
+
+
+def _page_offsets(reader):
+    offsets = []
+    for number, page in enumerate(reader.pages, start=1):
+        entry = {"page": number, "offset": None}
+        reference = page.indirect_reference
+        if reference is not None:
+            entry["offset"] = reader.xref.get(reference.generation, {}).get(reference.idnum)
+            if entry["offset"] is None and reference.idnum in reader.xref_objStm:
+                stream_number = reader.xref_objStm[reference.idnum][0]
+                entry["offset"] = reader.xref.get(0, {}).get(stream_number)
+                entry["object_stream"] = stream_number
+        offsets.append(entry)
+    return offsets
+
+
+def extract_outline(path):
+    """提取一本规则书的书签、页码标签和页面偏移"""
+    if PdfReader is None:
+        raise RuntimeError("未安装 pypdf，无法提取规则书目录")
+    # 传入文件对象时 pypdf 按需读取，不会把整本书读入内存
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        try:
+            outline = _outline_entries(reader, reader.outline)
+        except Exception as e:  # 书签损坏时仍返回其余信息
+            print(f"提取PDF书签时出错: {str(e)}")
+            outline = []
+        return {
+            "page_count": len(reader.pages),
+            "outline": outline,
+            "page_labels": list(reader.page_labels),
+            "page_offsets": _page_offsets(reader),
+        }
+
+
+class OutlineStore:
+    """
+    目录索引缓存：磁盘上按内容哈希保存，每个worker再缓存已序列化的响应体
+
+    参数:
+        directory: 缓存目录
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._bodies = {}
+
+    def get(self, path):
+        """返回 (etag, JSON响应体)"""
+        content_hash = file_etag(path, path.stat()).strip('"')
+        etag = f'"{content_hash}-outline-{OUTLINE_FORMAT}"'
+        body = self._bodies.get(content_hash)
+        if body is not None:
+            return etag, body
+
+        cache_path = self.directory / f"{content_hash}.json"
+        try:
+            body = cache_path.read_bytes()
+            if json.loads(body).get("format") != OUTLINE_FORMAT:
+                body = None
+        except (OSError, ValueError):
+            body = None
+
+        if body is None:
+            index = extract_outline(path)
+            index = dict(format=OUTLINE_FORMAT, filename=path.name, size=path.stat().st_size, **index)
+            body = json.dumps(index, ensure_ascii=False).encode("utf-8")
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(body)
+            os.replace(tmp_path, cache_path)
+
+        with self._lock:
+            self._bodies[content_hash] = body
+        return etag, body
@@ -0,0 +1,202 @@
+"""
+规则书单页（或页码区间）PDF
+
+从原始规则书中拆出指定页生成独立的小PDF，首次请求时生成并保存在磁盘缓存中：
+    - 缓存键为原始文件的内容哈希和页码区间，规则书更新后自动使用新的缓存文件
+    - 缓存总大小超过上限时按最近使用时间（命中时更新文件修改时间）淘汰最旧的文件
+    - 各页的请求次数记录在 RulebookPageRequest 中，
+      python manage.py prewarm_rule_pages 为请求最多的页面预先生成缓存
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import RulebookPageRequest
+from .serving import file_etag
+
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.errors import PyPdfError
+    # 损坏或不规范的PDF除了 pypdf 自己的异常，也可能在解析数值时抛出 ValueError
+    PDF_PARSE_ERRORS = (PyPdfError, ValueError)
+except ImportError:  # 未安装时无法拆分页面，已缓存的页面仍可返回
+    PdfReader = PdfWriter = None
+    PDF_PARSE_ERRORS = ()
+
+PAGE_RANGE_RE = re.compile(r"^(\d+)(?:-(\d+))?$")
+
+
+class PageExtractionError(Exception):
+    """规则书PDF无法解析，不能拆出页面"""
+
+
+class PageOutOfRange(Exception):
+    """请求的页码超出规则书页数"""
+
+    def __init__(self, page_count):
+        super().__init__(f"页码超出范围（共 {page_count} 页）")
+        self.page_count = page_count
+
+
+def parse_page_range(spec):
+    """解析 "12" 或 "12-15"，返回 (first, last)；格式不正确时返回 None"""
+    match = PAGE_RANGE_RE.match(spec)
+    if not match:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    if first < 1 or last < first:
+        return None
+    return first, last
+
+
+class _OpenReader:
+    """保持打开的一本规则书：PdfReader 从文件对象按需读取，淘汰时关闭文件"""
+
+    def __init__(self, source_path, size):
+        self.file = open(source_path, "rb")
+        try:
+            self.reader = PdfReader(self.file)
+        except Exception:
+            self.file.close()
+            raise
+        self.size = size
+        # PdfReader 不是线程安全的
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.close()
+
+
+class PageCache:
+    """
+    单页PDF的磁盘LRU缓存
+
+    参数:
+        cache_dir: 缓存目录
+        max_bytes: 缓存总大小上限（字节）
+        max_reader_bytes: 每个worker保持打开的规则书的总大小上限（字节）；解析大文件的交叉引用表较慢，
+            因此最近使用的书保持打开，PdfReader 按需从文件读取，已解析的对象大致与文件大小成正比
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_reader_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_reader_bytes = max_reader_bytes
+        self._lock = threading.Lock()
+        self._readers = OrderedDict()
+        self._reader_bytes = 0
+
+    def get(self, source_path, first, last):
+        """返回缓存的页面文件路径，不存在时生成"""
+        content_hash = file_etag(source_path, source_path.stat()).strip('"')
+        path = self.cache_dir / f"{content_hash}-{first}-{last}.pdf"
+        try:
+            # 更新修改时间作为最近使用时间
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            self._split(source_path, content_hash, first, last, path)
+        except PDF_PARSE_ERRORS as e:
+            raise PageExtractionError(f"规则书PDF无法解析: {str(e)}") from e
+        self._evict()
+        return path
+
+    def _reader(self, source_path, content_hash):
+        if PdfReader is None:
+            raise RuntimeError("未安装 pypdf，无法拆分规则书页面")
+        evicted = []
+        with self._lock:
+            entry = self._readers.get(content_hash)
+            if entry is None:
+                entry = _OpenReader(source_path, source_path.stat().st_size)
+                self._readers[content_hash] = entry
+                self._reader_bytes += entry.size
+                # 至少保留刚打开的这本书
+                while self._reader_bytes > self.max_reader_bytes and len(self._readers) > 1:
+                    _, stale = self._readers.popitem(last=False)
+                    self._reader_bytes -= stale.size
+                    evicted.append(stale)
+            else:
+                self._readers.move_to_end(content_hash)
+        # 在全局锁外关闭：等待正在使用该书的线程拆分完成
+        for stale in evicted:
+            stale.close()
+        return entry
+
+    def _split(self, source_path, content_hash, first, last, path):
+        while True:
+            entry = self._reader(source_path, content_hash)
+            with entry.lock:
+                if entry.closed:
+                    # 取得后、加锁前被其他线程淘汰，重新打开
+                    continue
+                reader = entry.reader
+                page_count = len(reader.pages)
+                if last > page_count:
+                    raise PageOutOfRange(page_count)
+                writer = PdfWriter()
+                for index in range(first - 1, last):
+                    writer.add_page(reader.pages[index])
+
+                # 写出时可能还要从原文件读取对象，因此在书被淘汰关闭之前完成
+                # 先写临时文件再原子替换，其他worker不会读到写了一半的文件
+                tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                try:
+                    with open(tmp_path, "wb") as f:
+                        writer.write(f)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    # 写出或替换失败时不留下临时文件（_evict 只统计 .pdf 文件，不会清理它们）
+                    try:
+                        os.remove(tmp_path)
+                    except FileNotFoundError:
+                        pass
+                    raise
+                return
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def record_page_request(filename, first, last):
+    """累计页面请求次数，供预热使用"""
+    updated = RulebookPageRequest.objects.filter(
+        filename=filename, first_page=first, last_page=last
+    ).update(hits=F("hits") + 1, last_requested=timezone.now())
+    if not updated:
+        RulebookPageRequest.objects.get_or_create(
+            filename=filename, first_page=first, last_page=last,
+            defaults={"hits": 1, "last_requested": timezone.now()})
+
+
+def most_requested_pages(limit):
+    """请求次数最多的页面区间"""
+    return RulebookPageRequest.objects.order_by("-hits", "-last_requested")[:limit]
@@ -0,0 +1,444 @@
+"""
+规则书全文检索
+
+build_index() 逐页提取 PDF_DIR 中每本规则书的文本，建立磁盘上的倒排索引；RulebookIndex 以 mmap
+打开索引文件，同一台机器上的所有worker共享操作系统页缓存，查询时不把索引读入进程内存。
+
+索引目录 (settings.RULES_INDEX_DIR):
+    pages/<sha256>.json   每本书按内容哈希缓存的逐页文本，内容未变的书重建时不再提取
+    <generation>/         一次构建的索引文件（见下）
+    CURRENT               当前生效的 generation 名称，构建完成后原子替换
+
+每个 generation 包含:
+    manifest.json   书目（文件名、标题、哈希、页数）、文档数、平均文档长度
+    docs.bin        每页一条: 书序号、页码、词数、文本偏移、文本长度
+    terms.bin       按UTF-8字节排序后拼接的词项
+    lexicon.bin     每个词项一条: 词项偏移、词项长度、倒排表偏移、文档频率（二分查找）
+    postings.bin    倒排表: (文档号, 词频)
+    text.bin        逐页文本，用于生成摘要
+
+分词（双语）: 英文按字母数字切分、转小写、去停用词并做简单的复数还原；中文按连续汉字切成二元组
+（单个汉字保留为一元）。排序使用 BM25。
+
+构建: python manage.py build_rules_index
+"""
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import time
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # 未安装时无法提取文本，已建立的索引仍可查询
+    PdfReader = None
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 摘要长度（字符）及匹配位置之前保留的字符数
+SNIPPET_CHARS = 200
+SNIPPET_LEAD = 60
+
+DOC_RECORD = struct.Struct("<IIIQI")
+LEXICON_RECORD = struct.Struct("<QIQI")
+POSTING_RECORD = struct.Struct("<II")
+
+INDEX_FORMAT = 1
+
+TOKEN_RE = re.compile(r"[0-9a-z]+|[㐀-䶿一-鿿豈-﫿]+")
+CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have if in into is it its of on or that the their
+then there these this to was were which with you your
+""".split())
+
+
+class IndexNotBuilt(Exception):
+    """索引目录中还没有可用的索引"""
+
+
+def normalize(text):
+    """NFKC规范化（全角转半角等）并转小写"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def stem(word):
+    """简单的英文复数还原，索引和查询使用同一规则"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """把文本切分为词项列表（可能重复）"""
+    tokens = []
+    for match in TOKEN_RE.finditer(normalize(text)):
+        run = match.group()
+        if CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif run not in STOPWORDS:
+            tokens.append(stem(run))
+    return tokens
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clean_page_text(text):
+    """合并行尾连字符断词和连续空白"""
+    text = re.sub(r"(\w)-\s*\n\s*(\w)", r"\1\2", text or "")
+    return " ".join(text.split())
+
+
+def extract_page_texts(path):
+    """逐页提取PDF文本，返回字符串列表（页码从1开始对应下标0）"""
+    if PdfReader is None:
+        raise RuntimeError("未安装 pypdf，无法提取规则书文本")
+    pages = []
+    # 传入文件对象时 pypdf 按需读取；传入路径会先把整个文件读入内存
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            try:
+                pages.append(clean_page_text(page.extract_text()))
+            except Exception as e:  # 个别页面解析失败时留空，不影响整本书
+                print(f"提取PDF页面文本时出错: {str(e)}")
+                pages.append("")
+    return pages
+
+
+def read_manifest(index_dir):
+    """返回当前生效索引的 (generation, manifest)，没有索引时返回 (None, None)"""
+    try:
+        generation = (index_dir / "CURRENT").read_text().strip()
+        manifest = json.loads((index_dir / generation / "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None, None
+    if manifest.get("format") != INDEX_FORMAT:
+        return None, None
+    return generation, manifest
+
+
+def build_index(pdf_dir, index_dir, titles=None, force=False, log=print):
+    """
+    为 pdf_dir 中的规则书建立索引
+
+    参数:
+        pdf_dir: PDF目录
+        index_dir: 索引目录
+        titles: 文件名 -> 标题
+        force: 即使所有书的内容都没有变化也重建
+        log: 输出进度的函数
+
+    返回 {"changed", "generation", "books", "pages", "terms", "extracted", "reused"}
+    """
+    pdf_dir, index_dir = Path(pdf_dir), Path(index_dir)
+    titles = titles or {}
+    page_cache_dir = index_dir / "pages"
+    page_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    old_generation, old_manifest = read_manifest(index_dir)
+    old_books = {book["filename"]: book for book in (old_manifest or {}).get("books", [])}
+
+    # 大小和修改时间未变的文件沿用上次计算的哈希，不必重新读取整本书
+    books = []
+    for path in sorted(pdf_dir.glob("*.pdf")):
+        stat = path.stat()
+        old = old_books.get(path.name)
+        if old and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            sha256 = old["sha256"]
+        else:
+            sha256 = file_sha256(path)
+        books.append({
+            "filename": path.name,
+            "title": titles.get(path.name, path.name),
+            "sha256": sha256,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        })
+
+    fingerprint = [(book["filename"], book["sha256"], book["title"]) for book in books]
+    if not force and old_manifest is not None and fingerprint == [
+            (book["filename"], book["sha256"], book["title"]) for book in old_manifest["books"]]:
+        return {"changed": False, "generation": old_generation, "books": len(books),
+                "pages": old_manifest["documents"], "terms": old_manifest["terms"],
+                "extracted": 0, "reused": len(books)}
+
+    extracted = reused = 0
+    book_pages = []
+    for book in books:
+        cache_path = page_cache_dir / f"{book['sha256']}.json"
+        if cache_path.exists():
+            pages = json.loads(cache_path.read_text(encoding="utf-8"))
+            reused += 1
+        else:
+            log(f"提取文本: {book['filename']}")
+            pages = extract_page_texts(pdf_dir / book["filename"])
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(pages, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp_path, cache_path)
+            extracted += 1
+        book["pages"] = len(pages)
+        book_pages.append(pages)
+
+    generation = f"gen-{time.time_ns()}"
+    stats = write_generation(index_dir / generation, books, book_pages)
+
+    tmp_current = index_dir / "CURRENT.tmp"
+    tmp_current.write_text(generation)
+    os.replace(tmp_current, index_dir / "CURRENT")
+
+    prune(index_dir, keep={generation, old_generation}, books=books)
+    return dict(stats, changed=True, generation=generation, books=len(books),
+                extracted=extracted, reused=reused)
+
+
+def write_generation(directory, books, book_pages):
+    """把逐页文本写成一个 generation 的索引文件"""
+    directory.mkdir(parents=True)
+    postings = {}
+    total_length = 0
+    doc_id = 0
+
+    with open(directory / "docs.bin", "wb") as docs, open(directory / "text.bin", "wb") as text_file:
+        text_offset = 0
+        for book_id, pages in enumerate(book_pages):
+            for page_number, text in enumerate(pages, start=1):
+                tokens = tokenize(text)
+                frequencies = {}
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+                for token, tf in frequencies.items():
+                    postings.setdefault(token, []).append((doc_id, tf))
+
+                encoded = text.encode("utf-8")
+                text_file.write(encoded)
+                docs.write(DOC_RECORD.pack(book_id, page_number, len(tokens), text_offset, len(encoded)))
+                text_offset += len(encoded)
+                total_length += len(tokens)
+                doc_id += 1
+
+    with open(directory / "terms.bin", "wb") as terms_file, \
+            open(directory / "lexicon.bin", "wb") as lexicon, \
+            open(directory / "postings.bin", "wb") as postings_file:
+        term_offset = postings_offset = 0
+        for term in sorted(postings, key=lambda t: t.encode("utf-8")):
+            encoded = term.encode("utf-8")
+            entries = postings[term]
+            terms_file.write(encoded)
+            lexicon.write(LEXICON_RECORD.pack(term_offset, len(encoded), postings_offset, len(entries)))
+            postings_file.write(b"".join(POSTING_RECORD.pack(*entry) for entry in entries))
+            term_offset += len(encoded)
+            postings_offset += POSTING_RECORD.size * len(entries)
+
+    manifest = {
+        "format": INDEX_FORMAT,
+        "books": books,
+        "documents": doc_id,
+        "terms": len(postings),
+        "avg_length": total_length / doc_id if doc_id else 0.0,
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2))
+    return {"pages": doc_id, "terms": len(postings)}
+
+
+def prune(index_dir, keep, books):
+    """删除旧的 generation 和不再使用的逐页文本缓存（已打开旧索引的worker在重新打开前仍可读取）"""
+    for path in index_dir.glob("gen-*"):
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    hashes = {book["sha256"] for book in books}
+    for path in (index_dir / "pages").glob("*.json"):
+        if path.stem not in hashes:
+            path.unlink(missing_ok=True)
+
+
+def make_snippet(text, query, length=SNIPPET_CHARS):
+    """以第一个命中的查询词为中心截取摘要（length 个字符）"""
+    lowered = normalize(text)
+    positions = []
+    for match in TOKEN_RE.finditer(normalize(query)):
+        word = match.group()
+        if not CJK_RE.match(word) and word in STOPWORDS:
+            continue
+        # 英文词去掉复数词尾后匹配，以便 "spells" 也能定位到 "spell"
+        position = lowered.find(word if CJK_RE.match(word) else stem(word))
+        if position >= 0:
+            positions.append(position)
+
+    start = max(min(positions) - SNIPPET_LEAD, 0) if positions else 0
+    snippet = text[start:start + length]
+    if start > 0:
+        snippet = "…" + snippet
+    if start + length < len(text):
+        snippet += "…"
+    return snippet
+
+
+class Generation:
+    """以 mmap 打开的一个 generation"""
+
+    def __init__(self, directory):
+        self.name = directory.name
+        self.manifest = json.loads((directory / "manifest.json").read_text())
+        self._files = []
+        self.docs = self._map(directory / "docs.bin")
+        self.terms = self._map(directory / "terms.bin")
+        self.lexicon = self._map(directory / "lexicon.bin")
+        self.postings = self._map(directory / "postings.bin")
+        self.text = self._map(directory / "text.bin")
+        self.term_count = len(self.lexicon) // LEXICON_RECORD.size
+
+    def _map(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._files:
+            mapped.close()
+
+    def _term_at(self, position):
+        offset, length, _, _ = LEXICON_RECORD.unpack_from(self.lexicon, position * LEXICON_RECORD.size)
+        return self.terms[offset:offset + length]
+
+    def lookup(self, term):
+        """二分查找词项，返回 (倒排表偏移, 文档频率)，不存在时返回 None"""
+        encoded = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term_at(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self._term_at(low) == encoded:
+            _, _, offset, df = LEXICON_RECORD.unpack_from(self.lexicon, low * LEXICON_RECORD.size)
+            return offset, df
+        return None
+
+    def postings_for(self, offset, df):
+        return POSTING_RECORD.iter_unpack(self.postings[offset:offset + POSTING_RECORD.size * df])
+
+    def document(self, doc_id):
+        """返回 (书序号, 页码, 词数)"""
+        book_id, page, length, _, _ = DOC_RECORD.unpack_from(self.docs, doc_id * DOC_RECORD.size)
+        return book_id, page, length
+
+    def page_text(self, doc_id):
+        _, _, _, offset, length = DOC_RECORD.unpack_from(self.docs, doc_id * DOC_RECORD.size)
+        return self.text[offset:offset + length].decode("utf-8")
+
+
+class RulebookIndex:
+    """
+    规则书索引的只读查询接口
+
+    每次查询前检查 CURRENT，索引重建后自动切换到新的 generation。
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        self._generation = None
+        self._current_mtime = None
+
+    def _current(self):
+        try:
+            mtime = (self.index_dir / "CURRENT").stat().st_mtime_ns
+        except FileNotFoundError:
+            raise IndexNotBuilt("规则书索引尚未建立")
+
+        if self._generation is None or mtime != self._current_mtime:
+            name, manifest = read_manifest(self.index_dir)
+            if manifest is None:
+                raise IndexNotBuilt("规则书索引尚未建立")
+            if self._generation is None or self._generation.name != name:
+                # 旧的 mmap 不主动关闭：可能仍有其他线程正在读取，由垃圾回收释放
+                self._generation = Generation(self.index_dir / name)
+            self._current_mtime = mtime
+        return self._generation
+
+    def books(self):
+        return self._current().manifest["books"]
+
+    def search(self, query, limit=10, book=None, snippet_chars=SNIPPET_CHARS):
+        """
+        BM25 检索
+
+        参数:
+            query: 查询文本（中英文均可）
+            limit: 返回的最多结果数
+            book: 只检索指定文件名的规则书
+            snippet_chars: 摘要长度（字符）
+
+        返回按得分降序的 [{"book", "title", "page", "score", "snippet"}]
+        """
+        generation = self._current()
+        manifest = generation.manifest
+        books = manifest["books"]
+        book_id = None
+        if book is not None:
+            book_id = next((i for i, entry in enumerate(books) if entry["filename"] == book), None)
+            if book_id is None:
+                return []
+
+        documents = manifest["documents"]
+        avg_length = manifest["avg_length"] or 1.0
+        scores = {}
+        lengths = {}
+        for term in set(tokenize(query)):
+            found = generation.lookup(term)
+            if found is None:
+                continue
+            offset, df = found
+            idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+            for doc_id, tf in generation.postings_for(offset, df):
+                if doc_id not in lengths:
+                    doc_book, _, length = generation.document(doc_id)
+                    lengths[doc_id] = length if book_id is None or doc_book == book_id else None
+                length = lengths[doc_id]
+                if length is None:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        results = []
+        for doc_id, score in heapq.nlargest(limit, scores.items(), key=lambda item: item[1]):
+            doc_book, page, _ = generation.document(doc_id)
+            results.append({
+                "book": books[doc_book]["filename"],
+                "title": books[doc_book]["title"],
+                "page": page,
+                "score": round(score, 4),
+                "snippet": make_snippet(generation.page_text(doc_id), query, snippet_chars),
+            })
+        return results
+
+
+# 共享的索引实例：规则书检索接口和 AI GM 的规则检索都使用它
+rulebook_index = RulebookIndex(settings.RULES_INDEX_DIR)
@@ -0,0 +1,283 @@
+"""
+规则书PDF的文件响应
+
+支持 PDF.js 的渐进加载和断点续传：
+    - Accept-Ranges: bytes，单个 Range 返回 206，多个 Range 返回 multipart/byteranges
+    - 无法满足的 Range 返回 416 和 Content-Range: bytes */<size>
+    - If-Range 与 ETag（强比较）或 Last-Modified 不一致时忽略 Range，返回整个文件
+    - ETag 为文件内容的 SHA-256（强校验），If-None-Match / If-Modified-Since 命中时返回 304，
+      If-Match / If-Unmodified-Since 不满足时返回 412
+    - 长期缓存头 Cache-Control: public, max-age=...
+
+ETag 按 (路径, 大小, 修改时间) 在每个worker中缓存，文件未变时只在第一次请求时计算哈希。
+在WSGI服务器（gunicorn sync/gthread worker）下，整个文件和单个区间都以文件对象交给
+wsgi.file_wrapper，由服务器用 sendfile 在内核中发送。ASGI没有 sendfile：Django会把同步迭代器
+整个读入内存再发送，因此在ASGI服务器（uvicorn worker）下改用异步生成器，在线程池中按块读取文件，
+内存占用只有一个块；大量下载时仍建议交给前端代理。
+
+也可以把传输交给前端代理（settings.RULES_PDF_DELIVERY）：视图只做路径校验和权限检查，
+返回 X-Accel-Redirect（nginx）或 X-Sendfile（Apache / lighttpd）头，Range、条件请求和慢客户端
+都由代理处理，不占用Python worker。nginx 配置示例:
+
+    location /internal/rulebooks/ {
+        internal;
+        alias /srv/app/backend/pdfs/;
+    }
+    location /api/ {
+        proxy_pass http://127.0.0.1:8000;
+    }
+
+此时 ETag 由代理根据修改时间和大小生成。
+"""
+import hashlib
+import secrets
+import threading
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+# 读取文件的块大小
+CHUNK_SIZE = 256 * 1024
+
+# 单个请求最多的区间数，超过时忽略 Range 返回整个文件
+MAX_RANGES = 32
+
+_etag_lock = threading.Lock()
+_etags = {}
+
+
+def file_etag(path, stat):
+    """返回文件内容哈希形式的强ETag"""
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    etag = _etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        etag = '"%s"' % digest.hexdigest()[:32]
+        with _etag_lock:
+            # 同一路径只保留最新版本
+            for stale in [k for k in _etags if k[0] == key[0]]:
+                del _etags[stale]
+            _etags[key] = etag
+    return etag
+
+
+def parse_range_header(header, size):
+    """
+    解析 Range 请求头
+
+    返回按起点排序并合并了重叠部分的 [(start, end)]（闭区间）；
+    格式不正确或区间过多时返回 None（按规范忽略 Range），所有区间都无法满足时返回 []
+    """
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+        elif last:
+            # 后缀区间：最后 N 个字节
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+        else:
+            return None
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag, last_modified):
+    """If-Range 不存在或与当前文件一致时返回True"""
+    value = request.headers.get("If-Range")
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        # 强比较：弱ETag永远不匹配
+        return value == etag
+    return parse_http_date_safe(value) == last_modified
+
+
+class FileRange:
+    """
+    只读文件的一个区间
+
+    read() 不会越过区间末尾；fileno() 指向已定位到区间起点的文件，
+    WSGI服务器据此用 sendfile 发送 Content-Length 个字节（仅在WSGI下使用）。
+    """
+
+    def __init__(self, path, start, end):
+        self._file = open(path, "rb")
+        self._file.seek(start)
+        self._remaining = end - start + 1
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+def iter_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_multipart(path, ranges, parts, closing):
+    for (start, end), header in zip(ranges, parts):
+        yield header
+        yield from iter_file_range(path, start, end)
+    yield closing
+
+
+async def aiter_file_range(path, start, end):
+    """iter_file_range 的异步版本：在线程池中读取，不阻塞事件循环"""
+    f = await sync_to_async(open, thread_sensitive=False)(path, "rb")
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await sync_to_async(f.read, thread_sensitive=False)(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+async def aiter_multipart(path, ranges, parts, closing):
+    for (start, end), header in zip(ranges, parts):
+        yield header
+        async for chunk in aiter_file_range(path, start, end):
+            yield chunk
+    yield closing
+
+
+def is_asgi_request(request):
+    """请求是否来自ASGI服务器（request 也可以是 DRF 的 Request）"""
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+def serve_file(request, path, content_type, max_age):
+    """
+    返回文件响应（200 / 206 / 304 / 412 / 416）
+
+    参数:
+        path: 文件路径（调用方已确认存在）
+        content_type: 文件的MIME类型
+        max_age: Cache-Control 的 max-age（秒）
+    """
+    stat = path.stat()
+    size = stat.st_size
+    etag = file_etag(path, stat)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        ranges = None
+        range_header = request.headers.get("Range")
+        if range_header and if_range_matches(request, etag, last_modified):
+            ranges = parse_range_header(range_header, size)
+
+        asgi = is_asgi_request(request)
+        if ranges is None and asgi:
+            response = StreamingHttpResponse(
+                aiter_file_range(path, 0, size - 1), content_type=content_type)
+            response["Content-Length"] = str(size)
+        elif ranges is None:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+        elif not ranges:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            if asgi:
+                response = StreamingHttpResponse(
+                    aiter_file_range(path, start, end), status=206, content_type=content_type)
+            else:
+                response = FileResponse(
+                    FileRange(path, start, end), status=206, content_type=content_type)
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(end - start + 1)
+        else:
+            boundary = secrets.token_hex(16)
+            parts = [
+                ("%s--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (
+                    "\r\n" if i else "", boundary, content_type, start, end, size)).encode("ascii")
+                for i, (start, end) in enumerate(ranges)
+            ]
+            closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+            length = sum(len(part) for part in parts) + len(closing) + sum(
+                end - start + 1 for start, end in ranges)
+            iter_parts = aiter_multipart if asgi else iter_multipart
+            response = StreamingHttpResponse(
+                iter_parts(path, ranges, parts, closing),
+                status=206, content_type=f"multipart/byteranges; boundary={boundary}")
+            response["Content-Length"] = str(length)
+
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = f"public, max-age={max_age}"
+    return response
+
+
+def offload_file(path, relative_name, content_type, mode, accel_prefix=""):
+    """
+    返回由前端代理发送文件的空响应
+
+    参数:
+        path: 文件的绝对路径（X-Sendfile 使用）
+        relative_name: 文件相对代理内部路径的名称（X-Accel-Redirect 使用）
+        mode: "x-accel" 或 "x-sendfile"
+        accel_prefix: nginx internal location 的路径前缀
+    """
+    response = HttpResponse(content_type=content_type)
+    if mode == "x-accel":
+        response["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + quote(relative_name)
+    else:
+        response["X-Sendfile"] = str(path)
+    return response
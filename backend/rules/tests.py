@@ -1,3 +1,403 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.http import FileResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase
+from django.utils.http import http_date
+from pypdf import PdfReader, PdfWriter
+
+from .catalog import RulebookCatalog
+from .pages import PageCache, PageExtractionError, PageOutOfRange, parse_page_range
+from .search import IndexNotBuilt, RulebookIndex, build_index, file_sha256, make_snippet, tokenize
+from .serving import MAX_RANGES, parse_range_header, serve_file
+
+BOOKS = {
+    "PlayersHandbook.pdf": [
+        "Casting a spell requires spell slots. Wizards prepare spells after a long rest.",
+        "Grappling: the target must be no more than one size larger than you.",
+        "火球术在施法者选定的一点爆炸，范围内的生物进行敏捷豁免。",
+    ],
+    "MonsterManual.pdf": [
+        "Dragons are ancient creatures. A dragon hoards treasure and casts spells.",
+        "Goblins are small, black-hearted humanoids.",
+    ],
+}
+
+
+def write_books(pdf_dir, index_dir, books):
+    """写入假的PDF文件并预先填好逐页文本缓存，建立索引时不需要解析PDF"""
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    pages_dir = index_dir / "pages"
+    pages_dir.mkdir(parents=True, exist_ok=True)
+    for filename, pages in books.items():
+        path = pdf_dir / filename
+        path.write_bytes(f"%PDF-fake {filename} {pages!r}".encode("utf-8"))
+        (pages_dir / f"{file_sha256(path)}.json").write_text(
+            json.dumps(pages, ensure_ascii=False), encoding="utf-8")
+
+
+class TokenizeTests(SimpleTestCase):
+    def test_english_is_lowercased_stemmed_and_stopwords_removed(self):
+        self.assertEqual(tokenize("The Wizards cast Spells of the ABYSS"),
+                         ["wizard", "cast", "spell", "abyss"])
+
+    def test_plural_ies(self):
+        self.assertEqual(tokenize("abilities"), ["ability"])
+
+    def test_cjk_bigrams(self):
+        self.assertEqual(tokenize("火球术"), ["火球", "球术"])
+        self.assertEqual(tokenize("龙"), ["龙"])
+
+    def test_mixed_and_fullwidth(self):
+        # 全角字母按 NFKC 规范化为半角
+        self.assertEqual(tokenize("ＤＣ 15 豁免"), ["dc", "15", "豁免"])
+
+
+class SnippetTests(SimpleTestCase):
+    def test_snippet_centres_on_first_match(self):
+        text = "x" * 300 + " grappling rules " + "y" * 300
+
+        snippet = make_snippet(text, "grapple Grappling", length=100)
+
+        self.assertTrue(snippet.startswith("…"))
+        self.assertTrue(snippet.endswith("…"))
+        self.assertIn("grappling", snippet)
+
+
+class RulebookIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.pdf_dir = self.root / "pdfs"
+        self.index_dir = self.root / "index"
+        write_books(self.pdf_dir, self.index_dir, BOOKS)
+        self.result = build_index(self.pdf_dir, self.index_dir,
+                                  titles={"PlayersHandbook.pdf": "PHB"}, log=lambda message: None)
+        self.index = RulebookIndex(self.index_dir)
+
+    def test_build_reports_counts(self):
+        self.assertTrue(self.result["changed"])
+        self.assertEqual(self.result["books"], 2)
+        self.assertEqual(self.result["pages"], 5)
+        self.assertEqual(self.result["reused"], 2)
+
+    def test_search_ranks_matching_pages(self):
+        results = self.index.search("spell slots")
+
+        self.assertEqual(results[0]["book"], "PlayersHandbook.pdf")
+        self.assertEqual(results[0]["title"], "PHB")
+        self.assertEqual(results[0]["page"], 1)
+        self.assertEqual({(r["book"], r["page"]) for r in results},
+                         {("PlayersHandbook.pdf", 1), ("MonsterManual.pdf", 1)})
+        self.assertGreater(results[0]["score"], results[1]["score"])
+
+    def test_search_chinese(self):
+        results = self.index.search("火球")
+
+        self.assertEqual([(r["book"], r["page"]) for r in results], [("PlayersHandbook.pdf", 3)])
+        self.assertIn("火球术", results[0]["snippet"])
+
+    def test_search_filters_by_book_and_limit(self):
+        self.assertEqual(
+            [r["book"] for r in self.index.search("spells", book="MonsterManual.pdf")],
+            ["MonsterManual.pdf"])
+        self.assertEqual(self.index.search("spells", book="Missing.pdf"), [])
+        self.assertEqual(len(self.index.search("spells", limit=1)), 1)
+
+    def test_unknown_terms_return_nothing(self):
+        self.assertEqual(self.index.search("beholder"), [])
+        self.assertEqual(self.index.search("the of"), [])
+
+    def test_unchanged_books_are_not_rebuilt(self):
+        again = build_index(self.pdf_dir, self.index_dir,
+                            titles={"PlayersHandbook.pdf": "PHB"}, log=lambda message: None)
+
+        self.assertFalse(again["changed"])
+        self.assertEqual(again["generation"], self.result["generation"])
+
+    def test_index_switches_to_new_generation(self):
+        self.assertEqual(self.index.search("owlbear"), [])
+        write_books(self.pdf_dir, self.index_dir, {"Volo.pdf": ["The owlbear is a monstrosity."]})
+
+        result = build_index(self.pdf_dir, self.index_dir, log=lambda message: None)
+
+        self.assertNotEqual(result["generation"], self.result["generation"])
+        self.assertEqual([r["book"] for r in self.index.search("owlbear")], ["Volo.pdf"])
+
+    def test_missing_index_raises(self):
+        with self.assertRaises(IndexNotBuilt):
+            RulebookIndex(self.root / "empty").search("spell")
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header("bytes=0-99", 1000), [(0, 99)])
+        self.assertEqual(parse_range_header("bytes=900-", 1000), [(900, 999)])
+        self.assertEqual(parse_range_header("bytes=-100", 1000), [(900, 999)])
+        # 终点超出文件大小时截断
+        self.assertEqual(parse_range_header("bytes=990-2000", 1000), [(990, 999)])
+        self.assertEqual(parse_range_header("bytes=-5000", 1000), [(0, 999)])
+
+    def test_multiple_ranges_are_sorted_and_merged(self):
+        self.assertEqual(parse_range_header("bytes=500-599, 0-99", 1000), [(0, 99), (500, 599)])
+        self.assertEqual(parse_range_header("bytes=0-99,50-149,150-199", 1000), [(0, 199)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header("bytes=2000-", 1000), [])
+        self.assertEqual(parse_range_header("bytes=-0", 1000), [])
+        self.assertEqual(parse_range_header("bytes=2000-3000,-0", 1000), [])
+
+    def test_invalid_headers_are_ignored(self):
+        for header in ["items=0-1", "bytes=", "bytes=a-b", "bytes=5-1", "bytes=-", "bytes=1"]:
+            self.assertIsNone(parse_range_header(header, 1000), header)
+        too_many = ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(MAX_RANGES + 1))
+        self.assertIsNone(parse_range_header(f"bytes={too_many}", 1000))
+
+
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root)
+        self.path = root / "book.pdf"
+        self.content = bytes(range(256)) * 40
+        self.path.write_bytes(self.content)
+        self.factory = RequestFactory()
+
+    def serve(self, **headers):
+        return serve_file(self.factory.get("/", headers=headers), self.path,
+                          "application/pdf", max_age=60)
+
+    def body(self, response):
+        try:
+            return b"".join(response.streaming_content)
+        finally:
+            response.close()
+
+    def test_full_file(self):
+        response = self.serve()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Cache-Control"], "public, max-age=60")
+        self.assertEqual(self.body(response), self.content)
+
+    def test_single_range(self):
+        response = self.serve(Range="bytes=100-199")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.content)}")
+        self.assertEqual(response["Content-Length"], "100")
+        self.assertEqual(self.body(response), self.content[100:200])
+
+    def test_multiple_ranges(self):
+        response = self.serve(Range="bytes=0-9,-10")
+
+        self.assertEqual(response.status_code, 206)
+        boundary = response["Content-Type"].split("boundary=")[1]
+        body = self.body(response)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        parts = body.split(f"--{boundary}".encode("ascii"))
+        self.assertIn(b"Content-Range: bytes 0-9/10240\r\n\r\n" + self.content[:10], parts[1])
+        self.assertIn(b"Content-Range: bytes 10230-10239/10240\r\n\r\n" + self.content[-10:],
+                      parts[2])
+        self.assertEqual(parts[3], b"--\r\n")
+
+    def test_unsatisfiable_range(self):
+        response = self.serve(Range="bytes=20000-")
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.content)}")
+
+    def test_if_range_with_current_etag(self):
+        etag = self.serve()["ETag"]
+
+        response = self.serve(Range="bytes=0-9", **{"If-Range": etag})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.content[:10])
+
+    def test_if_range_mismatch_returns_whole_file(self):
+        for value in ['"stale"', "W/" + self.serve()["ETag"], http_date(0)]:
+            response = self.serve(Range="bytes=0-9", **{"If-Range": value})
+            self.assertEqual(response.status_code, 200, value)
+            self.assertEqual(self.body(response), self.content)
+
+    def test_if_range_with_last_modified(self):
+        last_modified = self.serve()["Last-Modified"]
+
+        response = self.serve(Range="bytes=0-9", **{"If-Range": last_modified})
+
+        self.assertEqual(response.status_code, 206)
+
+    def test_etag_is_content_hash(self):
+        etag = self.serve()["ETag"]
+        self.path.write_bytes(self.content[::-1])
+
+        self.assertNotEqual(self.serve()["ETag"], etag)
+
+    def test_conditional_requests(self):
+        first = self.serve()
+        etag = first["ETag"]
+
+        self.assertEqual(self.serve(**{"If-None-Match": etag}).status_code, 304)
+        self.assertEqual(
+            self.serve(**{"If-Modified-Since": first["Last-Modified"]}).status_code, 304)
+        self.assertEqual(self.serve(**{"If-Match": '"other"'}).status_code, 412)
+        self.assertEqual(self.serve(Range="bytes=0-9", **{"If-Match": etag}).status_code, 206)
+
+    async def test_asgi_streams_without_file_wrapper(self):
+        async def serve(**headers):
+            response = serve_file(AsyncRequestFactory().get("/", headers=headers), self.path,
+                                  "application/pdf", max_age=60)
+            self.assertTrue(response.is_async)
+            return response, b"".join([chunk async for chunk in response])
+
+        response, body = await serve()
+        self.assertEqual((response.status_code, response["Content-Length"]), (200, "10240"))
+        self.assertEqual(body, self.content)
+
+        response, body = await serve(Range="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[100:200])
+
+        response, body = await serve(Range="bytes=0-9,-10")
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(self.content[-10:], body)
+
+
+def write_pdf(path, pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=100, height=100)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+class RulebookCatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        write_pdf(self.root / "PlayersHandbook.pdf", 1)
+        catalog = RulebookCatalog(self.root, {}, poll_interval=0, rescan_interval=0)
+        patcher = mock.patch("rules.views.rulebook_catalog", catalog)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_if_none_match_gets_304(self):
+        response = self.client.get("/api/rules/books/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+        repeated = self.client.get("/api/rules/books/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(repeated.status_code, 304)
+        self.assertEqual(repeated.content, b"")
+
+        by_date = self.client.get("/api/rules/books/", HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(by_date.status_code, 304)
+
+    def test_new_rulebook_changes_etag(self):
+        etag = self.client.get("/api/rules/books/")["ETag"]
+        write_pdf(self.root / "MonsterManual.pdf", 2)
+
+        response = self.client.get("/api/rules/books/", HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("MonsterManual.pdf", response.content.decode())
+
+
+class PageCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        # 页数不同，内容哈希也不同
+        self.books = []
+        for index, pages in enumerate([3, 4, 5]):
+            path = self.root / f"book{index}.pdf"
+            write_pdf(path, pages)
+            self.books.append(path)
+
+    def make_cache(self, max_reader_bytes):
+        cache = PageCache(self.root / "cache", max_bytes=10 ** 9, max_reader_bytes=max_reader_bytes)
+        self.addCleanup(lambda: [entry.close() for entry in cache._readers.values()])
+        return cache
+
+    def test_parse_page_range(self):
+        self.assertEqual(parse_page_range("12"), (12, 12))
+        self.assertEqual(parse_page_range("12-15"), (12, 15))
+        for spec in ["0", "5-3", "a", "1-", "-2"]:
+            self.assertIsNone(parse_page_range(spec), spec)
+
+    def test_extracts_requested_pages(self):
+        cache = self.make_cache(10 ** 9)
+
+        path = cache.get(self.books[2], 2, 4)
+
+        self.assertEqual(len(PdfReader(path).pages), 3)
+        # 再次请求直接返回缓存文件
+        self.assertEqual(cache.get(self.books[2], 2, 4), path)
+
+    def test_page_out_of_range(self):
+        cache = self.make_cache(10 ** 9)
+
+        with self.assertRaises(PageOutOfRange) as error:
+            cache.get(self.books[0], 3, 4)
+        self.assertEqual(error.exception.page_count, 3)
+
+    def test_open_readers_are_bounded_by_bytes(self):
+        sizes = [path.stat().st_size for path in self.books]
+        cache = self.make_cache(sizes[0] + sizes[1])
+
+        cache.get(self.books[0], 1, 1)
+        cache.get(self.books[1], 1, 1)
+        self.assertEqual(len(cache._readers), 2)
+        first = next(iter(cache._readers.values()))
+
+        cache.get(self.books[2], 1, 1)
+
+        # 最久未用的书被淘汰并关闭文件
+        self.assertTrue(first.closed)
+        self.assertTrue(first.file.closed)
+        self.assertLessEqual(cache._reader_bytes, sizes[0] + sizes[1])
+        self.assertEqual(cache._reader_bytes, sum(entry.size for entry in cache._readers.values()))
+
+    def test_single_book_larger_than_limit_stays_open(self):
+        cache = self.make_cache(1)
+
+        cache.get(self.books[0], 1, 1)
+        cache.get(self.books[1], 1, 2)
+
+        self.assertEqual(len(cache._readers), 1)
+
+    def write_corrupt_pdf(self):
+        path = self.root / "broken.pdf"
+        path.write_bytes(b"%PDF-1.7\nnot really a pdf")
+        return path
+
+    def test_corrupt_pdf_raises_extraction_error(self):
+        cache = self.make_cache(10 ** 9)
+
+        with self.assertRaises(PageExtractionError):
+            cache.get(self.write_corrupt_pdf(), 1, 1)
+
+    def test_failed_write_removes_temp_file(self):
+        cache = self.make_cache(10 ** 9)
+
+        with mock.patch("rules.pages.PdfWriter.write", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                cache.get(self.books[0], 1, 1)
+
+        self.assertEqual(list((self.root / "cache").iterdir()), [])
+
+    def test_view_maps_corrupt_pdf_to_json_error(self):
+        broken = self.write_corrupt_pdf()
+        with mock.patch("rules.views.PDF_DIR", self.root), \
+                mock.patch("rules.views.page_cache", self.make_cache(10 ** 9)):
+            response = self.client.get(f"/api/rules/pdf/{broken.name}/pages/1/")
+
+        self.assertEqual(response.status_code, 422)
+        self.assertIn("error", response.json())
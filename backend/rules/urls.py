@@ -1,9 +1,14 @@
 # backend/rules/urls.py
 from django.urls import path
-from .views import get_rulebooks, view_pdf, download_pdf
+from .views import get_rulebooks, view_pdf, download_pdf, pdf_outline, pdf_pages, search_rules
 
 urlpatterns = [
     path("books/", get_rulebooks),  # 获取所有规则书
     path("pdf/<str:filename>/", view_pdf),  # 查看指定PDF
+    # 提取指定页（N 或 N-M）为独立的小PDF
+    path("pdf/<str:filename>/pages/<str:pages>/", pdf_pages),
+    # 书签目录、页码标签和每页的字节偏移
+    path("pdf/<str:filename>/outline/", pdf_outline),
     path("download/<str:filename>/", download_pdf),  # 下载指定PDF
+    path("search/", search_rules),  # 全文检索规则书，例如 /api/rules/search/?q=借机攻击
 ]
@@ -1,9 +1,23 @@
 # backend/rules/views.py
-from django.http import FileResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.conf import settings
-import os
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import condition
+import time
+from datetime import datetime, timezone
 from rest_framework.decorators import api_view
 from pathlib import Path
+from .catalog import RulebookCatalog
+from .outline import OutlineStore
+from .pages import (
+    PageCache,
+    PageExtractionError,
+    PageOutOfRange,
+    parse_page_range,
+    record_page_request,
+)
+from .search import IndexNotBuilt, rulebook_index
+from .serving import offload_file, serve_file
 
 # PDF 文件目录路径 - 您需要在此位置存储PDF文件
 PDF_DIR = Path(settings.BASE_DIR) / 'pdfs'
@@ -28,103 +42,184 @@ PDF_METADATA = {
 }
 
 
-@api_view(['GET'])
-def get_rulebooks(request):
-    """返回所有可用的规则书分类及PDF文件"""
-    # 确保目录存在
-    if not PDF_DIR.exists():
-        os.makedirs(PDF_DIR, exist_ok=True)
-
-    # 扫描目录并构建分类列表
-    rulebooks = {}
-    for file in PDF_DIR.glob('*.pdf'):
-        filename = file.name
-
-        # 获取元数据或使用默认值
-        metadata = PDF_METADATA.get(filename, {
-            'title': filename,
-            'description': '规则书PDF文件',
-            'category': 'other'
-        })
-
-        # 添加文件信息
-        file_info = {
-            'filename': filename,
-            'title': metadata['title'],
-            'description': metadata['description'],
-            'size': file.stat().st_size,
-            'url': f'/api/rules/pdf/{filename}'
-        }
+# 规则书目录：每个worker缓存，目录变化时才重新扫描
+rulebook_catalog = RulebookCatalog(
+    PDF_DIR, PDF_METADATA,
+    poll_interval=settings.RULES_CATALOG_POLL_INTERVAL,
+    rescan_interval=settings.RULES_CATALOG_RESCAN_INTERVAL)
 
-        # 按分类组织
-        category = metadata.get('category', 'other')
-        if category not in rulebooks:
-            rulebooks[category] = []
+# 单页PDF的磁盘缓存
+page_cache = PageCache(settings.RULES_PAGE_CACHE_DIR, settings.RULES_PAGE_CACHE_MAX_BYTES,
+                       settings.RULES_PAGE_READER_MAX_BYTES)
 
-        rulebooks[category].append(file_info)
+# 规则书目录索引，与全文索引放在同一目录下
+outline_store = OutlineStore(settings.RULES_INDEX_DIR / 'outlines')
 
-    # 分类名称映射
-    category_names = {
-        'core': '核心规则书',
-        'adventure': '冒险模组',
-        'supplement': '补充规则',
-        'other': '其他规则资源'
-    }
 
-    # 构建最终响应
-    result = []
-    for category, books in rulebooks.items():
-        result.append({
-            'id': category,
-            'name': category_names.get(category, category),
-            'books': books
-        })
+def rulebooks_etag(request):
+    return rulebook_catalog.get().etag
 
-    return JsonResponse({
-        'status': 'success',
-        'data': result
-    })
+
+def rulebooks_last_modified(request):
+    return datetime.fromtimestamp(rulebook_catalog.get().last_modified, tz=timezone.utc)
 
 
+@condition(etag_func=rulebooks_etag, last_modified_func=rulebooks_last_modified)
 @api_view(['GET'])
-def view_pdf(request, filename):
-    """提供PDF文件预览服务"""
-    file_path = PDF_DIR / filename
+def get_rulebooks(request):
+    """返回所有可用的规则书分类及PDF文件（响应体预先序列化，带 ETag 和 Last-Modified）"""
+    response = HttpResponse(rulebook_catalog.get().body, content_type='application/json')
+    # 允许缓存，但每次使用前都要向服务器确认（通常得到 304）
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def resolve_pdf(filename):
+    """返回 PDF_DIR 中对应的PDF文件路径；不在目录内、不是PDF或不存在时返回None"""
+    pdf_dir = PDF_DIR.resolve()
+    file_path = (pdf_dir / filename).resolve()
+    if file_path.parent != pdf_dir or file_path.suffix.lower() != '.pdf' or not file_path.is_file():
+        return None
+    return file_path
+
+
+def pdf_response(request, filename, disposition):
+    """返回PDF文件（支持 Range 和条件请求），disposition 为 inline 或 attachment"""
+    file_path = resolve_pdf(filename)
 
     # 检查文件是否存在
-    if not file_path.exists():
+    if file_path is None:
         return JsonResponse({'error': 'PDF文件未找到'}, status=404)
 
-    # 提供文件用于内嵌预览
-    response = FileResponse(open(file_path, 'rb'),
-                            content_type='application/pdf')
-    response['Content-Disposition'] = f'inline; filename="{filename}"'
+    if settings.RULES_PDF_DELIVERY in ('x-accel', 'x-sendfile'):
+        # 由前端代理发送文件
+        response = offload_file(file_path, file_path.name, 'application/pdf',
+                                settings.RULES_PDF_DELIVERY, settings.RULES_PDF_ACCEL_PREFIX)
+        response['Cache-Control'] = f'public, max-age={settings.RULES_PDF_CACHE_MAX_AGE}'
+    else:
+        response = serve_file(request, file_path, 'application/pdf',
+                              max_age=settings.RULES_PDF_CACHE_MAX_AGE)
+    response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+    return add_pdf_cors_headers(response)
+
 
-    # 添加跨域头
+def add_pdf_cors_headers(response):
+    """添加跨域头；PDF.js 跨域分段加载需要发送 Range 并读取 Content-Range 等响应头"""
     response["Access-Control-Allow-Origin"] = "*"
     response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-    response["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-
+    response["Access-Control-Allow-Headers"] = "Content-Type, Authorization, Range, If-Range"
+    response["Access-Control-Expose-Headers"] = "Accept-Ranges, Content-Range, Content-Length, ETag"
     return response
 
 
+@api_view(['GET'])
+def view_pdf(request, filename):
+    """提供PDF文件预览服务"""
+    return pdf_response(request, filename, 'inline')
+
+
 @api_view(['GET'])
 def download_pdf(request, filename):
-    """提供PDF文件下载服务"""
-    file_path = PDF_DIR / filename
+    """提供PDF文件下载服务（支持断点续传）"""
+    return pdf_response(request, filename, 'attachment')
 
-    # 检查文件是否存在
-    if not file_path.exists():
+
+@api_view(['GET'])
+def pdf_pages(request, filename, pages):
+    """
+    返回规则书中单页或页码区间拆出的独立PDF，例如 /api/rules/pdf/MonsterManual.pdf/pages/12-13/
+
+    生成结果缓存在磁盘上，重复请求直接返回缓存文件（支持 Range 和条件请求）。
+    """
+    file_path = resolve_pdf(filename)
+    if file_path is None:
         return JsonResponse({'error': 'PDF文件未找到'}, status=404)
 
-    # 提供文件 - 使用 attachment 下载
-    response = FileResponse(open(file_path, 'rb'),
-                            content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    page_range = parse_page_range(pages)
+    if page_range is None:
+        return JsonResponse({'error': '页码格式应为 N 或 N-M'}, status=400)
+    first, last = page_range
+    if last - first + 1 > settings.RULES_PAGE_MAX_RANGE:
+        return JsonResponse({
+            'error': f'一次最多提取 {settings.RULES_PAGE_MAX_RANGE} 页'
+        }, status=400)
+
+    try:
+        page_path = page_cache.get(file_path, first, last)
+    except PageOutOfRange as e:
+        return JsonResponse({'error': str(e), 'pages': e.page_count}, status=404)
+    except PageExtractionError as e:
+        return JsonResponse({'error': str(e)}, status=422)
+    except RuntimeError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    record_page_request(file_path.name, first, last)
+
+    response = serve_file(request, page_path, 'application/pdf',
+                          max_age=settings.RULES_PDF_CACHE_MAX_AGE)
+    response['Content-Disposition'] = f'inline; filename="{file_path.stem}-p{pages}.pdf"'
+    return add_pdf_cors_headers(response)
 
-    # 添加跨域头
-    response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-    response["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
 
+@api_view(['GET'])
+def pdf_outline(request, filename):
+    """
+    返回规则书的书签目录、页码标签和每页的字节偏移
+
+    按文件内容哈希提取一次并缓存；响应带 ETag，客户端可用 If-None-Match 获得 304。
+    """
+    file_path = resolve_pdf(filename)
+    if file_path is None:
+        return JsonResponse({'error': 'PDF文件未找到'}, status=404)
+
+    try:
+        etag, body = outline_store.get(file_path)
+    except RuntimeError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
     return response
+
+
+@api_view(['GET'])
+def search_rules(request):
+    """
+    全文检索规则书
+
+    查询参数:
+        q: 查询文本（中英文均可）
+        limit: 返回的最多结果数（默认10）
+        book: 只检索指定文件名的规则书
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': '缺少查询参数 q'}, status=400)
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        return JsonResponse({'error': 'limit 必须是整数'}, status=400)
+    limit = min(max(limit, 1), settings.RULES_SEARCH_MAX_RESULTS)
+
+    started = time.perf_counter()
+    try:
+        results = rulebook_index.search(query, limit=limit, book=request.GET.get('book') or None)
+    except IndexNotBuilt:
+        return JsonResponse({
+            'error': '规则书索引尚未建立，请先运行 python manage.py build_rules_index'
+        }, status=503)
+
+    # 浏览器内置的PDF查看器支持 #page= 直接跳到对应页
+    for result in results:
+        result['url'] = f"/api/rules/pdf/{result['book']}#page={result['page']}"
+
+    return JsonResponse({
+        'status': 'success',
+        'data': {
+            'query': query,
+            'results': results,
+            'took_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+    })